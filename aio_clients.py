@@ -0,0 +1,545 @@
+"""
+非同期I/Oクライアント（S3ダウンロード / Supabase PostgREST）
+
+aiohttpのコネクションプール（keep-alive）を使い、S3とPostgRESTへの通信を
+イベントループ上で実行する。同時接続数とタイムアウトは環境変数で設定できる。
+
+- IO_CONCURRENCY: ホストごとの最大同時接続数（デフォルト: 8）
+- IO_TIMEOUT_SECONDS: 1リクエストあたりのタイムアウト秒数（デフォルト: 60）
+- IO_KEEPALIVE_SECONDS: アイドル接続を保持する秒数（デフォルト: 30）
+- S3_CACHE_DIR: S3オブジェクトのローカルキャッシュを置くディレクトリ（空の場合は無効）
+- S3_CACHE_MAX_MB: キャッシュの上限サイズ（MB、デフォルト: 1024）。超えた分は最後に使ってから
+  最も時間が経ったものから削除する（LRU）
+
+S3はboto3で署名付きURL（ローカルで計算、通信なし）を生成し、本体の取得を
+aiohttpで行う。エラー時はboto3と同じ botocore.exceptions.ClientError を送出する。
+キャッシュが有効な場合は、キャッシュ済みのETagを If-None-Match に付けた条件付きGETを送り、
+304（変更なし）ならS3から本体を転送せずにキャッシュからコピーする。
+音声はdownload_audioで受信しながらデコードできる（FLAC / Opus等の圧縮形式に対応、audio_decode.py）。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from xml.etree import ElementTree
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+import aiohttp
+import numpy as np
+from botocore.exceptions import ClientError
+
+from audio_decode import decode_stream
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+class IOConfig:
+    """非同期I/Oの接続プール設定"""
+
+    def __init__(self, concurrency: int = 8, timeout_seconds: float = 60.0, keepalive_seconds: float = 30.0):
+        self.concurrency = concurrency
+        self.timeout_seconds = timeout_seconds
+        self.keepalive_seconds = keepalive_seconds
+
+    @classmethod
+    def from_env(cls) -> "IOConfig":
+        return cls(
+            concurrency=_env_int('IO_CONCURRENCY', 8),
+            timeout_seconds=_env_float('IO_TIMEOUT_SECONDS', 60.0),
+            keepalive_seconds=_env_float('IO_KEEPALIVE_SECONDS', 30.0),
+        )
+
+    def create_session(self, headers: Optional[Dict[str, str]] = None) -> aiohttp.ClientSession:
+        """keep-alive付きのコネクションプールを持つセッションを作成（イベントループ内で呼ぶこと）"""
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.concurrency,
+            keepalive_timeout=self.keepalive_seconds,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+            headers=headers,
+        )
+
+
+class S3ObjectCache:
+    """S3オブジェクトのローカルキャッシュ（サイズ上限付きLRU、ETagで検証）
+
+    1オブジェクトにつき本体（<hash>.bin）とメタデータ（<hash>.json: key / etag / size）を保存する。
+    LRUの順序は本体ファイルの更新時刻で管理し、再起動後もディレクトリを走査して復元する。
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()  # key -> {"etag", "size"}（古い順）
+        self.hits = 0  # 304（変更なし）でキャッシュから返した件数
+        self.misses = 0  # キャッシュになかった件数
+        self.stale = 0  # キャッシュはあったがETagが変わっていた件数
+        self.evictions = 0
+        self.bytes_saved = 0  # S3から転送せずに済んだバイト数
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    @classmethod
+    def from_env(cls) -> Optional["S3ObjectCache"]:
+        cache_dir = os.getenv('S3_CACHE_DIR', '')
+        if not cache_dir:
+            return None
+        return cls(cache_dir, int(_env_float('S3_CACHE_MAX_MB', 1024) * 1024 * 1024))
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + suffix)
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, name), 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                found.append((os.path.getmtime(self._path(meta['key'], '.bin')), meta))
+            except (OSError, ValueError, KeyError):
+                continue
+        for _, meta in sorted(found, key=lambda item: item[0]):
+            self._entries[meta['key']] = {'etag': meta['etag'], 'size': meta['size']}
+        with self._lock:
+            self._evict()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry['size'] for entry in self._entries.values())
+
+    def etag(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['etag'] if entry else None
+
+    def copy_to(self, key: str, file_path: str) -> Optional[int]:
+        """キャッシュの本体をfile_pathにコピーし、LRUの順序を更新する（304を受け取った後に呼ぶ）
+
+        その間にキャッシュから削除されていた場合はNoneを返す。
+        """
+        source = self._path(key, '.bin')
+        try:
+            shutil.copyfile(source, file_path)
+            os.utime(source)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry['size']
+            return entry['size']
+
+    def open(self, key: str):
+        """キャッシュの本体を読み込み用に開き、LRUの順序を更新する（304を受け取った後に呼ぶ）
+
+        その間にキャッシュから削除されていた場合はNoneを返す。開いたファイルは削除されても読める。
+        """
+        source = self._path(key, '.bin')
+        try:
+            f = open(source, 'rb')
+            os.utime(source)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                f.close()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry['size']
+            return f
+
+    def store(self, key: str, etag: Optional[str], file_path: str, revalidated: bool):
+        """ダウンロードしたファイルをキャッシュに保存する（ETagがない場合は保存しない）"""
+        self._store(key, etag, os.path.getsize(file_path), revalidated,
+                    lambda tmp_path: shutil.copyfile(file_path, tmp_path))
+
+    def store_bytes(self, key: str, etag: Optional[str], data: bytes, revalidated: bool):
+        """ダウンロードしたオブジェクトの本体（メモリ上のバイト列）をキャッシュに保存する"""
+        def write(tmp_path: str):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        self._store(key, etag, len(data), revalidated, write)
+
+    def _store(self, key: str, etag: Optional[str], size: int, revalidated: bool, write: Callable[[str], None]):
+        with self._lock:
+            if revalidated:
+                self.stale += 1
+            else:
+                self.misses += 1
+        if not etag or size > self.max_bytes:
+            return
+        # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+        data_path = self._path(key, '.bin')
+        tmp_path = f'{data_path}.{threading.get_ident()}.tmp'
+        write(tmp_path)
+        os.replace(tmp_path, data_path)
+        with open(self._path(key, '.json'), 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'etag': etag, 'size': size}, f)
+        with self._lock:
+            self._entries[key] = {'etag': etag, 'size': size}
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        total = self.total_bytes
+        while total > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            total -= entry['size']
+            self.evictions += 1
+            for suffix in ('.bin', '.json'):
+                try:
+                    os.unlink(self._path(key, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            requests = self.hits + self.misses + self.stale
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_ratio": round(self.hits / requests, 3) if requests else None,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+class AsyncS3Client:
+    """署名付きURL + aiohttpによるS3ダウンロードクライアント"""
+
+    # ダウンロード時に一度に読み込むバイト数
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, s3_client, bucket_name: str, config: Optional[IOConfig] = None, presign_expires: int = 300,
+                 cache: Optional[S3ObjectCache] = None):
+        # s3_client（boto3）は署名付きURLの生成にのみ使用する
+        self._s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.config = config or IOConfig.from_env()
+        self.presign_expires = presign_expires
+        self.cache = cache
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def start(self):
+        if self._session is None:
+            self._session = self.config.create_session()
+            self._semaphore = asyncio.Semaphore(self.config.concurrency)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def presigned_url(self, key: str, method: str = 'get_object') -> str:
+        return self._s3_client.generate_presigned_url(
+            method,
+            Params={'Bucket': self.bucket_name, 'Key': key},
+            ExpiresIn=self.presign_expires,
+        )
+
+    @staticmethod
+    async def _raise_for_status(response: aiohttp.ClientResponse, operation: str):
+        if response.status < 400:
+            return
+        body = await response.text()
+        raise ClientError(
+            {
+                'Error': {'Code': str(response.status), 'Message': body[:200] or response.reason},
+                'ResponseMetadata': {'HTTPStatusCode': response.status},
+            },
+            operation,
+        )
+
+    async def download_file(self, key: str, file_path: str) -> int:
+        """S3オブジェクトをローカルファイルに保存し、書き込んだバイト数を返す"""
+        await self.start()
+        url = self.presigned_url(key)
+        cached_etag = self.cache.etag(key) if self.cache else None
+        if cached_etag:
+            async with self._semaphore:
+                async with self._session.get(url, headers={'If-None-Match': cached_etag}) as response:
+                    if response.status != 304:
+                        return await self._save_response(response, key, file_path, revalidated=True)
+            copied = await asyncio.to_thread(self.cache.copy_to, key, file_path)
+            if copied is not None:
+                return copied
+            # 検証の直後にキャッシュから削除された場合は条件なしで取得し直す
+        async with self._semaphore:
+            async with self._session.get(url) as response:
+                return await self._save_response(response, key, file_path, revalidated=False)
+
+    async def _save_response(self, response: aiohttp.ClientResponse, key: str, file_path: str, revalidated: bool) -> int:
+        await self._raise_for_status(response, 'GetObject')
+        written = 0
+        with open(file_path, 'wb') as f:
+            async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+        if self.cache:
+            await asyncio.to_thread(self.cache.store, key, response.headers.get('ETag'), file_path, revalidated)
+        return written
+
+
+    async def list_objects(self, prefix: str) -> Dict[str, int]:
+        """prefixで始まるオブジェクトのキーとサイズ（バイト）を返す（ListObjectsV2、1000件ずつ）"""
+        await self.start()
+        sizes = {}
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        while True:
+            url = self._s3_client.generate_presigned_url('list_objects_v2', Params=params, ExpiresIn=self.presign_expires)
+            async with self._semaphore:
+                async with self._session.get(url) as response:
+                    await self._raise_for_status(response, 'ListObjectsV2')
+                    root = ElementTree.fromstring(await response.read())
+            namespace = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+            for contents in root.iter(f'{namespace}Contents'):
+                sizes[contents.findtext(f'{namespace}Key')] = int(contents.findtext(f'{namespace}Size'))
+            token = root.findtext(f'{namespace}NextContinuationToken')
+            if root.findtext(f'{namespace}IsTruncated') != 'true' or not token:
+                return sizes
+            params['ContinuationToken'] = token
+
+    async def read_range(self, key: str, start: int, end: int) -> bytes:
+        """オブジェクトのstart〜endバイト目（endを含む）を取得する"""
+        await self.start()
+        async with self._semaphore:
+            async with self._session.get(self.presigned_url(key), headers={'Range': f'bytes={start}-{end}'}) as response:
+                await self._raise_for_status(response, 'GetObject')
+                return await response.read()
+
+    async def download_audio(self, key: str) -> np.ndarray:
+        """S3オブジェクトを受信しながらデコードし、16kHzモノラルの音声配列を返す（audio_decode.py）
+
+        WAV / FLAC / Ogg(Opus) / MP3等は受信したチャンクをそのままffmpegに渡すため、中間ファイルを作らない。
+        キャッシュが有効な場合はdownload_fileと同じく条件付きGETで検証し、304ならキャッシュの本体をデコードする。
+        """
+        await self.start()
+        url = self.presigned_url(key)
+        cached_etag = self.cache.etag(key) if self.cache else None
+        if cached_etag:
+            async with self._semaphore:
+                async with self._session.get(url, headers={'If-None-Match': cached_etag}) as response:
+                    if response.status != 304:
+                        return await self._decode_response(response, key, revalidated=True)
+            cached = await asyncio.to_thread(self.cache.open, key)
+            if cached is not None:
+                with cached:
+                    return await decode_stream(key, self._iter_file(cached))
+            # 検証の直後にキャッシュから削除された場合は条件なしで取得し直す
+        async with self._semaphore:
+            async with self._session.get(url) as response:
+                return await self._decode_response(response, key, revalidated=False)
+
+    async def _decode_response(self, response: aiohttp.ClientResponse, key: str, revalidated: bool) -> np.ndarray:
+        await self._raise_for_status(response, 'GetObject')
+        # キャッシュが有効な場合は、デコードと並行して本体をメモリに残し、デコード後に保存する
+        body = bytearray() if self.cache else None
+
+        async def chunks() -> AsyncIterator[bytes]:
+            async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                if body is not None:
+                    body.extend(chunk)
+                yield chunk
+
+        audio = await decode_stream(key, chunks())
+        if self.cache:
+            await asyncio.to_thread(self.cache.store_bytes, key, response.headers.get('ETag'), bytes(body), revalidated)
+        return audio
+
+    async def _iter_file(self, f) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await asyncio.to_thread(f.read, self.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class PostgrestError(Exception):
+    """PostgRESTがエラー応答を返した場合の例外"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"PostgREST {status}: {message}")
+        self.status = status
+
+
+Filter = Tuple[str, str, object]
+
+
+def _quote(value) -> str:
+    return '"' + str(value).replace('"', '\\"') + '"'
+
+
+def _format_filter(op: str, value) -> str:
+    """PostgRESTのフィルタ表現（eq.x, in.("a","b") など）を生成"""
+    if op == 'in':
+        return f'in.({",".join(_quote(v) for v in value)})'
+    if op == 'logic':
+        # or / and の論理式はそのまま渡す（例: "(a.eq.1,b.gt.2)"）
+        return value
+    return f'{op}.{value}'
+
+
+def keyset_filter(keyset: Sequence[str], cursor: Sequence) -> Filter:
+    """keysetの直前の値（cursor）より後ろの行を表す or フィルタを生成
+
+    keyset=('recorded_at', 'file_path') の場合:
+        or=(recorded_at.gt.X,and(recorded_at.eq.X,file_path.gt.Y))
+    """
+    conditions = []
+    for i, column in enumerate(keyset):
+        terms = [f'{keyset[j]}.eq.{_quote(cursor[j])}' for j in range(i)]
+        terms.append(f'{column}.gt.{_quote(cursor[i])}')
+        conditions.append(terms[0] if len(terms) == 1 else f'and({",".join(terms)})')
+    return ('or', 'logic', f'({",".join(conditions)})')
+
+
+def _format_logic_term(column: str, op: str, value) -> str:
+    # 論理式の中では値にカンマ等が含まれても壊れないようにダブルクォートで囲む
+    if op == 'in':
+        return f'{column}.{_format_filter(op, value)}'
+    return f'{column}.{op}.{_quote(value)}'
+
+
+def any_of_filter(groups: Sequence[Sequence[Filter]]) -> Filter:
+    """「いずれかのグループの条件をすべて満たす」行を表すフィルタを生成
+
+    groups=[[('device_id', 'eq', 'A'), ('local_date', 'eq', 'D')], ...] の場合:
+        and=(or(and(device_id.eq."A",local_date.eq."D"),...))
+    keyset_filterが使う or パラメータと衝突しないよう、and パラメータの中に置く。
+    """
+    conditions = []
+    for group in groups:
+        terms = [_format_logic_term(column, op, value) for column, op, value in group]
+        conditions.append(terms[0] if len(terms) == 1 else f'and({",".join(terms)})')
+    return ('and', 'logic', f'(or({",".join(conditions)}))')
+
+
+class AsyncPostgrestClient:
+    """Supabase PostgREST（/rest/v1）への非同期クライアント
+
+    filtersは (列名, 演算子, 値) のリスト。例: [('device_id', 'eq', 'xxx'), ('time_block', 'in', ['09-30'])]
+    """
+
+    def __init__(self, supabase_url: str, supabase_key: str, config: Optional[IOConfig] = None):
+        self.base_url = supabase_url.rstrip('/') + '/rest/v1'
+        self._headers = {
+            'apikey': supabase_key,
+            'Authorization': f'Bearer {supabase_key}',
+            'Content-Type': 'application/json',
+        }
+        self.config = config or IOConfig.from_env()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def start(self):
+        if self._session is None:
+            self._session = self.config.create_session(headers=self._headers)
+            self._semaphore = asyncio.Semaphore(self.config.concurrency)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method: str, table: str, params: List[Tuple[str, str]],
+                       json_body=None, prefer: Optional[str] = None) -> List[Dict]:
+        await self.start()
+        headers = {'Prefer': prefer} if prefer else None
+        async with self._semaphore:
+            async with self._session.request(
+                method, f'{self.base_url}/{table}', params=params, json=json_body, headers=headers
+            ) as response:
+                if response.status >= 400:
+                    raise PostgrestError(response.status, (await response.text())[:500])
+                if response.status == 204:
+                    return []
+                return await response.json(content_type=None) or []
+
+    @staticmethod
+    def _filter_params(filters: Sequence[Filter]) -> List[Tuple[str, str]]:
+        return [(column, _format_filter(op, value)) for column, op, value in filters]
+
+    async def select(self, table: str, columns: str, filters: Sequence[Filter] = (),
+                     order: Optional[str] = None, limit: Optional[int] = None) -> List[Dict]:
+        params = [('select', columns)] + self._filter_params(filters)
+        if order:
+            params.append(('order', order))
+        if limit is not None:
+            params.append(('limit', str(limit)))
+        return await self._request('GET', table, params)
+
+    async def select_pages(self, table: str, columns: str, filters: Sequence[Filter],
+                           keyset: Sequence[str], page_size: int) -> AsyncIterator[List[Dict]]:
+        """keysetページネーションで1ページずつ取得する（keysetの列の昇順）
+
+        OFFSETではなく直前のページの最後の行を起点にするため、取得中に行の状態が
+        更新されて検索条件から外れても、行の取りこぼしや重複が起きない。
+        keysetの列はcolumnsに含めること。最後の列は一意である必要がある。
+
+        先頭の列がNULLの行はgt/eqの比較に一致せず、カーソルにもできないため、
+        先頭の列がNULLでない行を取得した後に、NULLの行を残りの列のkeysetで取得する
+        （PostgreSQLの昇順と同じくNULLは最後になる）。
+        """
+        passes = [(list(filters), keyset)]
+        if len(keyset) > 1:
+            passes = [
+                (list(filters) + [(keyset[0], 'not.is', 'null')], keyset),
+                (list(filters) + [(keyset[0], 'is', 'null')], keyset[1:]),
+            ]
+        for pass_filters, pass_keyset in passes:
+            async for rows in self._select_keyset_pages(table, columns, pass_filters, pass_keyset, page_size):
+                yield rows
+
+    async def _select_keyset_pages(self, table: str, columns: str, filters: List[Filter],
+                                   keyset: Sequence[str], page_size: int) -> AsyncIterator[List[Dict]]:
+        order = ','.join(f'{column}.asc' for column in keyset)
+        cursor = None
+        while True:
+            page_filters = list(filters)
+            if cursor is not None:
+                page_filters.append(keyset_filter(keyset, cursor))
+            rows = await self.select(table, columns, page_filters, order=order, limit=page_size)
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            cursor = tuple(rows[-1][column] for column in keyset)
+
+    async def upsert(self, table: str, rows, on_conflict: Optional[str] = None) -> List[Dict]:
+        params = [('on_conflict', on_conflict)] if on_conflict else []
+        return await self._request(
+            'POST', table, params, json_body=rows,
+            prefer='return=representation,resolution=merge-duplicates',
+        )
+
+    async def update(self, table: str, values: Dict, filters: Sequence[Filter]) -> List[Dict]:
+        return await self._request(
+            'PATCH', table, self._filter_params(filters), json_body=values,
+            prefer='return=representation',
+        )
@@ -0,0 +1,145 @@
+"""
+圧縮音声（FLAC / Opus等）のストリーミングデコード
+
+S3から受信したチャンクをそのままffmpegの標準入力に渡し、Whisperの入力形式
+（16kHz / モノラル / float32）の配列に変換する。ダウンロードとデコードが並行して進み、
+中間ファイル（一時WAV等）は作らない。
+
+フォーマットは先頭バイト（マジックナンバー）で判定し、判定できない場合はキーの拡張子で判定する。
+先頭から順に読めない形式（MP4 / M4A等、moovが末尾にある場合がある）と判定できない形式は、
+一時ファイルに保存してからデコードする（従来と同じ方法）。
+"""
+
+import asyncio
+import os
+import tempfile
+from typing import AsyncIterator, List, Optional
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+# 判定に使う先頭バイト数（OggのOpusHeadは最初のページに含まれる）
+HEADER_BYTES = 64
+
+# 判定したフォーマット -> ffmpegの入力フォーマット（パイプから順に読める形式のみ）
+STREAMABLE_FORMATS = {
+    "wav": "wav",
+    "flac": "flac",
+    "opus": "ogg",
+    "ogg": "ogg",
+    "mp3": "mp3",
+    "webm": "matroska",
+}
+
+EXTENSIONS = {
+    ".wav": "wav",
+    ".flac": "flac",
+    ".opus": "opus",
+    ".ogg": "ogg",
+    ".oga": "ogg",
+    ".mp3": "mp3",
+    ".webm": "webm",
+    ".m4a": "mp4",
+    ".mp4": "mp4",
+}
+
+
+class AudioDecodeError(Exception):
+    """ffmpegで音声をデコードできなかった場合の例外"""
+
+
+def detect_format(key: str, header: bytes) -> str:
+    """先頭バイトとキーの拡張子から音声フォーマットを判定する（不明な場合は"unknown"）"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return "wav"
+    if header[:4] == b'fLaC':
+        return "flac"
+    if header[:4] == b'OggS':
+        return "opus" if b'OpusHead' in header else "ogg"
+    if header[:3] == b'ID3' or (len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if header[4:8] == b'ftyp':
+        return "mp4"
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return "webm"
+    return EXTENSIONS.get(os.path.splitext(key)[1].lower(), "unknown")
+
+
+def _ffmpeg_command(source: str, input_format: Optional[str] = None) -> List[str]:
+    # whisper.audio.load_audioと同じ変換（16kHz / モノラル / 16bit PCM）
+    command = ["ffmpeg", "-nostdin", "-threads", "0"]
+    if input_format:
+        command += ["-f", input_format]
+    return command + ["-i", source, "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"]
+
+
+def _to_array(pcm: bytes) -> np.ndarray:
+    return np.frombuffer(pcm, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+async def _run_ffmpeg(command: List[str], chunks: Optional[AsyncIterator[bytes]] = None) -> np.ndarray:
+    """ffmpegを実行し、chunksを標準入力に書き込みながら標準出力のPCMを読み込む"""
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE if chunks is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def feed():
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpegが先に終了した（不正なデータ等）。終了コードでエラーにする
+        finally:
+            process.stdin.close()
+
+    tasks = [process.stdout.read(), process.stderr.read()]
+    if chunks is not None:
+        tasks.append(feed())
+    try:
+        pcm, stderr, *_ = await asyncio.gather(*tasks)
+        returncode = await process.wait()
+    finally:
+        # ダウンロードのエラーや取り消しで中断した場合
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if returncode != 0:
+        message = stderr.decode(errors='replace').strip().splitlines()
+        raise AudioDecodeError(f"音声のデコードに失敗: {message[-1] if message else f'ffmpeg終了コード {returncode}'}")
+    return _to_array(pcm)
+
+
+async def decode_stream(key: str, chunks: AsyncIterator[bytes]) -> np.ndarray:
+    """受信中のチャンクを16kHzモノラルのfloat32配列にデコードする
+
+    keyはフォーマットの判定（先頭バイトで判定できない場合の拡張子）にのみ使う。
+    """
+    header = b''
+    async for chunk in chunks:
+        header += chunk
+        if len(header) >= HEADER_BYTES:
+            break
+    audio_format = detect_format(key, header)
+
+    async def rest() -> AsyncIterator[bytes]:
+        yield header
+        async for chunk in chunks:
+            yield chunk
+
+    if audio_format in STREAMABLE_FORMATS:
+        return await _run_ffmpeg(_ffmpeg_command("pipe:0", STREAMABLE_FORMATS[audio_format]), rest())
+
+    # 順に読めない形式は一時ファイルに保存し、ffmpegにシークさせる
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(key)[1], delete=False) as tmp_file:
+        tmp_file_path = tmp_file.name
+        async for chunk in rest():
+            tmp_file.write(chunk)
+    try:
+        return await _run_ffmpeg(_ffmpeg_command(tmp_file_path))
+    finally:
+        os.unlink(tmp_file_path)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+過去データの一括文字起こし（バックフィル）
+
+APIサーバーを経由せずに、指定したデバイス・期間（またはマニフェストファイル）の音声を
+全コアを使って文字起こしする。ダウンロード・分析・文字起こし・保存にはAPIサーバーと
+同じ処理（aio_clients / transcription / pipeline）を使う。
+
+- 推論はプロセスプール（--workers、デフォルト: CPUコア数）で並列に実行する。
+  ワーカーは読み込み済みのモデルをforkでコピーオンライト共有する
+- ダウンロードは推論と並行してイベントループ上で行う
+- vibe_whisperへの保存とaudio_filesのステータス更新は--batch-size件ごとにまとめて行う
+- 保存が完了したファイルはチェックポイントファイル（JSONL）に追記する。中断しても
+  同じコマンドを再実行すれば、成功済みのファイルを飛ばして続きから処理する
+- 処理件数・スループット・残り時間の見込みを定期的に表示する
+
+使用例:
+    python3 backfill.py --devices d067d407-cf73-4174-a9c1-d91fb60d64d0 --from-date 2025-07-01 --to-date 2025-07-31
+    python3 backfill.py --manifest file_paths.txt --workers 4 --checkpoint july.checkpoint.jsonl
+
+マニフェストファイルは1行に1つのfile_path（S3のキー）を書いたテキストファイル。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import torch
+import whisper
+from dotenv import load_dotenv
+
+from aio_clients import IOConfig, AsyncS3Client, AsyncPostgrestClient, S3ObjectCache
+from pipeline import AUDIO_FILE_COLUMNS, AUDIO_FILE_KEYSET, create_s3_client_from_env, parse_file_path, save_transcriptions
+from prefilter import Prefilter, PrefilterConfig
+from transcription import transcribe_audio
+
+logger = logging.getLogger("backfill")
+
+# ワーカープロセスで使うモデルと設定（fork前に親プロセスで設定し、子プロセスに引き継ぐ）
+_worker_model = None
+_worker_no_speech_gate: Optional[float] = None
+
+
+def _init_worker(threads: int):
+    # ワーカー数 x スレッド数がコア数を超えないようにする
+    torch.set_num_threads(threads)
+
+
+def _transcribe(audio: np.ndarray) -> Dict:
+    """（ワーカープロセス）デコード済みの1ファイルを分析・文字起こしする"""
+    return transcribe_audio(audio, _worker_model, no_speech_gate=_worker_no_speech_gate)
+
+
+class Checkpoint:
+    """処理済みのファイルを記録するJSONLファイル（1行 = 1ファイルの結果）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.succeeded: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 中断時に書きかけだった行
+                    if entry.get('status') == 'success':
+                        self.succeeded.add(entry['file_path'])
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def is_done(self, file_path: str) -> bool:
+        return file_path in self.succeeded
+
+    def record(self, file_path: str, status: str, **fields):
+        entry = {'file_path': file_path, 'status': status, 'at': datetime.now(timezone.utc).isoformat(), **fields}
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+        if status == 'success':
+            self.succeeded.add(file_path)
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    """処理件数・スループット・残り時間の見込み"""
+
+    def __init__(self, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.succeeded = 0
+        self.failed = 0
+        self.started = time.time()
+
+    def line(self) -> str:
+        done = self.succeeded + self.failed
+        elapsed = time.time() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - done
+        eta = f"約{remaining / rate / 60:.1f}分" if rate > 0 else "不明"
+        percent = done / self.total * 100 if self.total else 100.0
+        return (f"[backfill] {done}/{self.total}件 ({percent:.1f}%)  成功={self.succeeded}  失敗={self.failed}  "
+                f"スキップ済み={self.skipped}  スループット={rate:.2f}件/s  残り時間={eta}")
+
+
+def read_manifest(path: str) -> List[Dict]:
+    files = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            file_path = line.strip()
+            if not file_path or file_path.startswith('#'):
+                continue
+            audio_file = parse_file_path(file_path)
+            if audio_file is None:
+                logger.warning(f"⚠️ マニフェストの形式が不正な行をスキップ: {file_path}")
+                continue
+            files.append(audio_file)
+    return files
+
+
+async def list_audio_files(supabase: AsyncPostgrestClient, args) -> List[Dict]:
+    """処理対象のファイルをaudio_filesからrecorded_at順に取得する"""
+    filters = [
+        ('device_id', 'in', args.devices),
+        ('local_date', 'gte', args.from_date),
+        ('local_date', 'lte', args.to_date),
+    ]
+    if args.only_pending:
+        filters.append(('transcriptions_status', 'eq', 'pending'))
+    files = []
+    async for page in supabase.select_pages('audio_files', AUDIO_FILE_COLUMNS, filters, AUDIO_FILE_KEYSET, args.page_size):
+        files.extend(page)
+    return files
+
+
+async def run_backfill(args, pool: ProcessPoolExecutor) -> Progress:
+    io_config = IOConfig.from_env()
+    supabase = AsyncPostgrestClient(os.environ['SUPABASE_URL'], os.environ['SUPABASE_KEY'], io_config)
+    s3 = AsyncS3Client(create_s3_client_from_env(), os.getenv('S3_BUCKET_NAME', 'watchme-vault'), io_config,
+                       cache=S3ObjectCache.from_env())
+    prefilter_config = PrefilterConfig.from_env()
+    prefilter = Prefilter(s3, prefilter_config) if prefilter_config.enabled else None
+    checkpoint = Checkpoint(args.checkpoint)
+    loop = asyncio.get_running_loop()
+
+    try:
+        files = read_manifest(args.manifest) if args.manifest else await list_audio_files(supabase, args)
+        todo = [audio_file for audio_file in files if not checkpoint.is_done(audio_file['file_path'])]
+        progress = Progress(len(todo), skipped=len(files) - len(todo))
+        print(f"[backfill] 対象{len(files)}件（チェックポイントで完了済み{progress.skipped}件）、"
+              f"ワーカー{args.workers}、{args.batch_size}件ごとに保存")
+
+        pending: List[Tuple[Dict, str]] = []
+        write_lock = asyncio.Lock()
+
+        async def flush():
+            async with write_lock:
+                batch = pending[:]
+                del pending[:]
+                if not batch:
+                    return
+                try:
+                    await save_transcriptions(supabase, batch)
+                except Exception as e:
+                    logger.error(f"❌ {len(batch)}件の保存に失敗: {str(e)}")
+                    for audio_file, _ in batch:
+                        checkpoint.record(audio_file['file_path'], 'error', error=f"保存エラー: {str(e)}")
+                    progress.failed += len(batch)
+                    return
+                for audio_file, _ in batch:
+                    checkpoint.record(audio_file['file_path'], 'success')
+                progress.succeeded += len(batch)
+
+        async def handle(audio_file: Dict):
+            file_path = audio_file['file_path']
+            try:
+                # 空・ヘッダーのみ・短すぎるファイルはダウンロードせずに空の文字起こし結果にする（PREFILTER_MIN_SECONDS）
+                if prefilter and await prefilter.check(file_path):
+                    transcription = ""
+                else:
+                    # 受信しながらデコードし、16kHzモノラルの配列をワーカーに渡す（WAV / FLAC / Opus等）
+                    audio = await s3.download_audio(file_path)
+                    transcription = (await loop.run_in_executor(pool, _transcribe, audio))['transcription']
+            except Exception as e:
+                logger.error(f"❌ {file_path}: {str(e)}")
+                checkpoint.record(file_path, 'error', error=str(e))
+                progress.failed += 1
+                return
+            pending.append((audio_file, transcription))
+            if len(pending) >= args.batch_size:
+                await flush()
+
+        # ワーカー数の2倍のファイルを同時に扱う（推論中のファイル + ダウンロード済みで待機中のファイル）
+        queue = iter(todo)
+
+        async def consume():
+            for audio_file in queue:
+                await handle(audio_file)
+
+        async def report():
+            while True:
+                await asyncio.sleep(args.report_interval)
+                print(progress.line(), flush=True)
+
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(*(consume() for _ in range(args.workers * 2)))
+        finally:
+            # 中断された場合も、文字起こし済みの結果は保存してチェックポイントに残す
+            reporter.cancel()
+            await flush()
+            print(progress.line(), flush=True)
+        return progress
+    finally:
+        checkpoint.close()
+        await s3.close()
+        await supabase.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="過去データの一括文字起こし（再開可能なバックフィル）")
+    parser.add_argument('--devices', type=lambda value: [v for v in value.split(',') if v],
+                        help="対象のdevice_id（カンマ区切り）")
+    parser.add_argument('--from-date', help="対象期間の開始日（YYYY-MM-DD、local_date）")
+    parser.add_argument('--to-date', help="対象期間の終了日（YYYY-MM-DD、local_date、この日を含む）")
+    parser.add_argument('--manifest', help="対象のfile_pathを1行ずつ書いたファイル（--devicesの代わりに指定）")
+    parser.add_argument('--only-pending', action='store_true', help="transcriptions_statusがpendingのファイルだけを対象にする")
+    parser.add_argument('--checkpoint', default='backfill.checkpoint.jsonl', help="チェックポイントファイル（JSONL）")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="推論を行うワーカープロセス数")
+    parser.add_argument('--threads-per-worker', type=int, default=1, help="ワーカー1つあたりのPyTorchのスレッド数")
+    parser.add_argument('--batch-size', type=int, default=20, help="DBにまとめて書き込む件数")
+    parser.add_argument('--page-size', type=int, default=500, help="audio_filesの検索で1ページあたりに取得する件数")
+    parser.add_argument('--model', default='base', help="Whisperモデル（baseより大きいモデルはメモリに注意）")
+    parser.add_argument('--no-speech-gate', type=float,
+                        default=float(os.environ['NO_SPEECH_GATE_THRESHOLD']) if os.getenv('NO_SPEECH_GATE_THRESHOLD') else None,
+                        help="無音ゲートの閾値（デフォルト: NO_SPEECH_GATE_THRESHOLD）")
+    parser.add_argument('--report-interval', type=float, default=10.0, help="進捗を表示する間隔（秒）")
+    args = parser.parse_args()
+
+    if not args.manifest and not (args.devices and args.from_date and args.to_date):
+        parser.error("--manifest、または --devices / --from-date / --to-date を指定してください")
+    if not os.getenv('SUPABASE_URL') or not os.getenv('SUPABASE_KEY'):
+        parser.error("SUPABASE_URLおよびSUPABASE_KEYが設定されていません")
+
+    global _worker_model, _worker_no_speech_gate
+    print(f"Whisper {args.model}モデルを読み込み中...")
+    _worker_model = whisper.load_model(args.model)
+    _worker_no_speech_gate = args.no_speech_gate
+
+    # ワーカーはforkで作成するため、イベントループやスレッドを起動する前に全ワーカーを起動しておく
+    pool = ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_worker,
+        initargs=(args.threads_per_worker,),
+    )
+    pool.submit(int).result()
+
+    try:
+        progress = asyncio.run(run_backfill(args, pool))
+    except KeyboardInterrupt:
+        print(f"[backfill] 中断しました。同じコマンドを再実行すると続きから処理します（{args.checkpoint}）")
+        raise SystemExit(130)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    if progress.failed:
+        print(f"[backfill] {progress.failed}件が失敗しました。再実行すると失敗したファイルを再処理します")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    load_dotenv()
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+カスケード（tinyモデルによる一次判定）のベンチマーク
+
+ベンチマーク用コーパス（WAVファイルのディレクトリ）の各ブロックを
+baseモデルのみの場合とカスケードありの場合で文字起こしし、以下を比較する。
+
+- tinyモデルの判定だけで確定したブロック数（割合）
+- 処理時間の合計とスループットの向上率
+- 見逃し: カスケードで空文字と判定したが、baseモデルのみでは文字起こし結果があったブロック
+- 不一致: 文字起こし結果がbaseモデルのみの場合と異なるブロック数と、
+  baseモデルのみの結果を正解とした文字誤り率（CER）
+
+先に実行した方だけが初回の推論・ファイル読み込みのコストを負担しないよう、
+計測前に先頭の--warmup件を両方の設定で処理し（計測には含めない）、
+各ブロックで2つの設定の実行順を交互に入れ替える。
+最後にREADMEの計測結果の表に追記できる行を出力する。
+
+使用例:
+    python3 bench_cascade.py --corpus ./corpus --model base --cascade-model tiny
+"""
+
+import argparse
+import logging
+import time
+from pathlib import Path
+from typing import Sequence
+
+import whisper
+
+from transcription import CascadeConfig, CascadeStats, transcribe_audio_file
+import transcription
+
+
+def edit_distance(reference: Sequence, hypothesis: Sequence) -> int:
+    """レーベンシュタイン距離（文字単位）"""
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref in enumerate(reference, 1):
+        current = [i]
+        for j, hyp in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref != hyp)))
+        previous = current
+    return previous[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="カスケード（tiny → base）のベンチマーク")
+    parser.add_argument('--corpus', required=True, help="WAVファイルを含むディレクトリ（再帰的に検索）")
+    parser.add_argument('--model', default='base')
+    parser.add_argument('--cascade-model', default='tiny')
+    parser.add_argument('--no-speech-threshold', type=float, default=0.6)
+    parser.add_argument('--logprob-threshold', type=float, default=-1.0)
+    parser.add_argument('--limit', type=int, help="先頭から指定件数だけ処理")
+    parser.add_argument('--warmup', type=int, default=1, help="計測前に両方の設定で処理する件数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    files = sorted(Path(args.corpus).rglob('*.wav'))[:args.limit]
+    if not files:
+        print(f"❌ WAVファイルが見つかりません: {args.corpus}")
+        return
+
+    print(f"コーパス: {len(files)}件, モデル: {args.model}, カスケード: {args.cascade_model}")
+    base_model = whisper.load_model(args.model)
+    cascade_model = whisper.load_model(args.cascade_model)
+    config = CascadeConfig(args.cascade_model, args.no_speech_threshold, args.logprob_threshold)
+
+    def run_base_only(path):
+        return transcribe_audio_file(str(path), base_model)
+
+    def run_cascade(path):
+        return transcribe_audio_file(str(path), base_model, cascade_model, config)
+
+    for path in files[:args.warmup]:
+        run_base_only(path)
+        run_cascade(path)
+
+    # ベンチマーク中の集計はサーバーの集計と分けて記録する
+    transcription.cascade_stats = CascadeStats()
+
+    seconds = {run_base_only: 0.0, run_cascade: 0.0}
+    resolved_by = {"rms": 0, "cascade": 0, "whisper": 0}
+    misses = []
+    mismatches = 0
+    errors = 0
+    reference_chars = 0
+
+    for index, path in enumerate(files):
+        # 実行順を交互に入れ替える
+        order = (run_base_only, run_cascade) if index % 2 == 0 else (run_cascade, run_base_only)
+        results = {}
+        for run in order:
+            started = time.perf_counter()
+            results[run] = run(path)
+            seconds[run] += time.perf_counter() - started
+        base_only, cascaded = results[run_base_only], results[run_cascade]
+
+        resolved_by[cascaded["resolved_by"]] += 1
+        if cascaded["resolved_by"] == "cascade" and base_only["transcription"]:
+            misses.append((path, base_only["transcription"]))
+        if cascaded["transcription"] != base_only["transcription"]:
+            mismatches += 1
+        errors += edit_distance(base_only["transcription"], cascaded["transcription"])
+        reference_chars += len(base_only["transcription"])
+
+    base_seconds = seconds[run_base_only]
+    cascade_seconds = seconds[run_cascade]
+    resolved_ratio = resolved_by['cascade'] / len(files)
+    gain = base_seconds / cascade_seconds
+    cer = errors / reference_chars if reference_chars else 0.0
+
+    print("")
+    print(f"RMSで無音判定:           {resolved_by['rms']}件")
+    print(f"tinyモデルで確定:        {resolved_by['cascade']}件（{resolved_ratio:.1%}）")
+    print(f"baseモデルで文字起こし:  {resolved_by['whisper']}件")
+    print(f"処理時間（baseのみ）:    {base_seconds:.1f}秒（{len(files) / base_seconds:.2f}件/秒）")
+    print(f"処理時間（カスケード）:  {cascade_seconds:.1f}秒（{len(files) / cascade_seconds:.2f}件/秒）")
+    print(f"スループット向上率:      {gain:.2f}倍")
+    print(f"見逃し:                  {len(misses)}件")
+    for path, text in misses:
+        print(f"  - {path}: {text[:60]}")
+    print(f"不一致:                  {mismatches}件（CER {cer:.1%}）")
+    print("")
+    print("READMEの計測結果の表に追記する行:")
+    print(f"| {args.corpus} | {len(files)}件 | {resolved_by['cascade']}件（{resolved_ratio:.1%}） | "
+          f"{len(files) / base_seconds:.2f}件/秒 | {len(files) / cascade_seconds:.2f}件/秒 | {gain:.2f}倍 | "
+          f"{len(misses)}件 | {mismatches}件（CER {cer:.1%}） |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+I/Oレイテンシ比較ベンチマーク（同期クライアント vs 非同期クライアント）
+
+ローカルのS3 / PostgRESTスタンドイン（standins.py）に対して、1ファイルあたりのI/O
+（S3ダウンロード + vibe_whisperへのupsert + audio_filesのステータス更新）に
+かかる時間を計測する。
+
+- sync: 従来のboto3 download_file + supabase（同期）クライアント
+- async: aio_clients.py の AsyncS3Client + AsyncPostgrestClient（1件ずつ）
+- async-concurrent: 同じ非同期クライアントで複数ファイルを同時に処理
+- async-cached: --cache-dir を指定した場合、S3オブジェクトキャッシュを有効にして2回処理する
+  （1回目はキャッシュへの保存、2回目はETagの検証のみでS3からの転送なし）
+- --formats を指定した場合は、音声フォーマットごとにダウンロード + 16kHzモノラルへのデコードの
+  時間とオブジェクトサイズを計測する（wav-file: 従来の一時ファイル + whisper.load_audio、
+  それ以外: download_audioによるストリーミングデコード）。音声は発話を模した合成音声
+
+使用例:
+    python3 bench_io.py --files 48 --latency-ms 20 --concurrency 8
+    python3 bench_io.py --files 48 --bandwidth-mbps 100 --formats wav,flac,opus
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import boto3
+import numpy as np
+import soundfile as sf
+from botocore.config import Config
+from supabase import create_client
+from whisper.audio import load_audio
+
+from aio_clients import IOConfig, AsyncS3Client, AsyncPostgrestClient, S3ObjectCache
+from standins import create_s3_app, create_postgrest_app, start_app
+
+BUCKET = 'watchme-vault'
+DEVICE_ID = 'bench-device'
+LOCAL_DATE = '2025-01-01'
+# PostgRESTスタンドインはキーを検証しないが、supabaseクライアントはJWT形式を要求する
+DUMMY_KEY = 'bench.standin.key'
+
+
+def audio_file_row(device_id: str, local_date: str, time_block: str) -> Dict:
+    """S3のキーと同じ規則でaudio_filesの行を作成する（status=pending）"""
+    return {
+        'file_path': f"files/{device_id}/{local_date}/{time_block}/audio.wav",
+        'device_id': device_id,
+        'local_date': local_date,
+        'time_block': time_block,
+        'recorded_at': f"{local_date}T{time_block.replace('-', ':')}:00+00:00",
+        'transcriptions_status': 'pending',
+    }
+
+
+def write_audio(root: str, key: str, seconds: float, rng: np.random.Generator):
+    """root配下のkeyにノイズのWAVファイル（16kHz / 16bit）を書き込む"""
+    sample_rate = 16000
+    path = os.path.join(root, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sf.write(path, rng.normal(0, 0.05, int(sample_rate * seconds)), sample_rate, subtype='PCM_16')
+
+
+def speech_like(seconds: float, rng: np.random.Generator, sample_rate: int = 16000) -> np.ndarray:
+    """発話を模した合成音声（音節ごとに基本周波数が変わる倍音 + 息継ぎの無音 + 小さな背景雑音）"""
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    signal = np.zeros_like(t)
+    position = 0.0
+    while position < seconds:
+        length = rng.uniform(0.1, 0.3)
+        if rng.random() < 0.8:
+            f0 = rng.uniform(100, 250)
+            mask = (t >= position) & (t < position + length)
+            envelope = np.sin(np.pi * (t[mask] - position) / length)
+            signal[mask] = envelope * sum(np.sin(2 * np.pi * f0 * k * t[mask]) / k for k in range(1, 6))
+        position += length + (rng.uniform(0.3, 1.0) if rng.random() < 0.1 else 0.0)
+    return 0.1 * signal / max(np.max(np.abs(signal)), 1e-9) + rng.normal(0, 0.002, len(t))
+
+
+FORMAT_ENCODERS = {
+    'flac': ['-c:a', 'flac'],
+    'opus': ['-c:a', 'libopus', '-b:a', '24k'],
+}
+
+
+def build_format_corpus(root: str, count: int, seconds: float, formats: List[str]) -> Dict[str, List[str]]:
+    """同じ音声をフォーマットごとに保存し、フォーマット -> キーのリストを返す"""
+    rng = np.random.default_rng(0)
+    keys = {audio_format: [] for audio_format in formats}
+    for i in range(count):
+        time_block = f"{i // 2:02d}-{(i % 2) * 30:02d}"
+        wav_key = f"files/{DEVICE_ID}/{LOCAL_DATE}/{time_block}/audio.wav"
+        wav_path = os.path.join(root, wav_key)
+        os.makedirs(os.path.dirname(wav_path), exist_ok=True)
+        sf.write(wav_path, speech_like(seconds, rng), 16000, subtype='PCM_16')
+        for audio_format in formats:
+            key = wav_key[:-len('wav')] + audio_format
+            if audio_format != 'wav':
+                subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', wav_path,
+                                *FORMAT_ENCODERS[audio_format], os.path.join(root, key)], check=True)
+            keys[audio_format].append(key)
+    return keys
+
+
+def build_corpus(root: str, count: int, seconds: float) -> List[Dict]:
+    """1分ブロック相当のWAVファイルを生成し、audio_filesの行を返す"""
+    rows = []
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        row = audio_file_row(DEVICE_ID, LOCAL_DATE, f"{i // 2:02d}-{(i % 2) * 30:02d}")
+        write_audio(root, row['file_path'], seconds, rng)
+        rows.append(row)
+    return rows
+
+
+class StandinServers:
+    """スタンドインを別スレッドのイベントループで起動する（同期クライアントから呼ぶため）"""
+
+    def __init__(self, audio_dir: str, rows: List[Dict], latency_ms: float, bandwidth_mbps: float = 0.0):
+        self.s3_app = create_s3_app(audio_dir, latency_ms, bandwidth_mbps)
+        self.postgrest_app = create_postgrest_app({'audio_files': rows}, latency_ms)
+        self._loop = asyncio.new_event_loop()
+        self._runners = []
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        for app in (self.s3_app, self.postgrest_app):
+            future = asyncio.run_coroutine_threadsafe(start_app(app, '127.0.0.1', 0), self._loop)
+            self._runners.append(future.result())
+        return self
+
+    def __exit__(self, *exc):
+        for runner in self._runners:
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    @property
+    def s3_url(self) -> str:
+        return f"http://127.0.0.1:{self.s3_app['port']}"
+
+    @property
+    def supabase_url(self) -> str:
+        return f"http://127.0.0.1:{self.postgrest_app['port']}"
+
+
+def make_boto3_client(endpoint_url: str):
+    return boto3.client(
+        's3',
+        aws_access_key_id='bench',
+        aws_secret_access_key='bench',
+        region_name='us-east-1',
+        endpoint_url=endpoint_url,
+        config=Config(s3={'addressing_style': 'path'}),
+    )
+
+
+def transcription_row(row: Dict) -> Dict:
+    return {'device_id': row['device_id'], 'date': row['local_date'], 'time_block': row['time_block'], 'transcription': ''}
+
+
+def bench_sync(servers: StandinServers, rows: List[Dict], tmp_dir: str) -> List[float]:
+    s3_client = make_boto3_client(servers.s3_url)
+    supabase = create_client(servers.supabase_url, DUMMY_KEY)
+    latencies = []
+    for row in rows:
+        started = time.perf_counter()
+        path = os.path.join(tmp_dir, 'sync.wav')
+        s3_client.download_file(BUCKET, row['file_path'], path)
+        supabase.table('vibe_whisper').upsert(transcription_row(row)).execute()
+        supabase.table('audio_files').update({'transcriptions_status': 'completed'}).eq('file_path', row['file_path']).execute()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def _async_file_io(s3: AsyncS3Client, db: AsyncPostgrestClient, row: Dict, path: str) -> float:
+    started = time.perf_counter()
+    await s3.download_file(row['file_path'], path)
+    await db.upsert('vibe_whisper', transcription_row(row))
+    await db.update('audio_files', {'transcriptions_status': 'completed'}, [('file_path', 'eq', row['file_path'])])
+    return time.perf_counter() - started
+
+
+async def bench_async(servers: StandinServers, rows: List[Dict], tmp_dir: str, concurrency: int,
+                      cache: S3ObjectCache = None) -> Tuple[List[float], float]:
+    config = IOConfig(concurrency=max(concurrency, 1))
+    s3 = AsyncS3Client(make_boto3_client(servers.s3_url), BUCKET, config, cache=cache)
+    db = AsyncPostgrestClient(servers.supabase_url, DUMMY_KEY, config)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(i: int, row: Dict) -> float:
+        async with semaphore:
+            return await _async_file_io(s3, db, row, os.path.join(tmp_dir, f'async-{i}.wav'))
+
+    started = time.perf_counter()
+    try:
+        latencies = await asyncio.gather(*(run(i, row) for i, row in enumerate(rows)))
+    finally:
+        await s3.close()
+        await db.close()
+    return list(latencies), time.perf_counter() - started
+
+
+async def bench_decode(servers: StandinServers, keys: List[str], tmp_dir: str, streaming: bool) -> Tuple[List[float], float]:
+    """1件ずつダウンロードして16kHzモノラルの配列にデコードするまでの時間"""
+    s3 = AsyncS3Client(make_boto3_client(servers.s3_url), BUCKET, IOConfig(concurrency=1))
+    path = os.path.join(tmp_dir, 'decode.wav')
+    latencies = []
+    started = time.perf_counter()
+    try:
+        for key in keys:
+            file_started = time.perf_counter()
+            if streaming:
+                await s3.download_audio(key)
+            else:
+                await s3.download_file(key, path)
+                load_audio(path)
+            latencies.append(time.perf_counter() - file_started)
+    finally:
+        await s3.close()
+    return latencies, time.perf_counter() - started
+
+
+def report(label: str, latencies: List[float], wall_seconds: float):
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{label:<18} 平均={statistics.mean(latencies) * 1000:7.1f}ms  "
+          f"p50={statistics.median(latencies) * 1000:7.1f}ms  p95={p95 * 1000:7.1f}ms  "
+          f"合計={wall_seconds:6.2f}s  スループット={len(latencies) / wall_seconds:6.1f}件/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同期 / 非同期I/Oクライアントのレイテンシ比較")
+    parser.add_argument('--files', type=int, default=48, help="ファイル数（1日分 = 48）")
+    parser.add_argument('--seconds', type=float, default=60.0, help="1ファイルの音声長（秒）")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="スタンドインの応答遅延（ミリ秒）")
+    parser.add_argument('--concurrency', type=int, default=8, help="async-concurrent の同時処理数")
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help="S3スタンドインの転送帯域（Mbps、0は無制限）")
+    parser.add_argument('--cache-dir', help="S3オブジェクトキャッシュのディレクトリ（指定時のみ async-cached を計測）")
+    parser.add_argument('--formats', help="ダウンロード + デコードを比較する音声フォーマット（例: wav,flac,opus）")
+    args = parser.parse_args()
+
+    if args.formats:
+        bench_formats(args)
+        return
+
+    with tempfile.TemporaryDirectory() as corpus_dir, tempfile.TemporaryDirectory() as tmp_dir:
+        rows = build_corpus(corpus_dir, args.files, args.seconds)
+        print(f"コーパス: {args.files}件 x {args.seconds:.0f}秒, スタンドイン遅延: {args.latency_ms}ms, "
+              f"S3帯域: {f'{args.bandwidth_mbps:g}Mbps' if args.bandwidth_mbps else '無制限'}")
+
+        with StandinServers(corpus_dir, rows, args.latency_ms, args.bandwidth_mbps) as servers:
+            started = time.perf_counter()
+            sync_latencies = bench_sync(servers, rows, tmp_dir)
+            report('sync', sync_latencies, time.perf_counter() - started)
+
+            async_latencies, wall = asyncio.run(bench_async(servers, rows, tmp_dir, 1))
+            report('async', async_latencies, wall)
+
+            concurrent_latencies, wall = asyncio.run(bench_async(servers, rows, tmp_dir, args.concurrency))
+            report('async-concurrent', concurrent_latencies, wall)
+
+            if args.cache_dir:
+                cache = S3ObjectCache(args.cache_dir, 1024 * 1024 * 1024)
+                for label in ('async-cached(1)', 'async-cached(2)'):
+                    cached_latencies, wall = asyncio.run(bench_async(servers, rows, tmp_dir, 1, cache))
+                    report(label, cached_latencies, wall)
+                print(f"キャッシュ: {cache.snapshot()}")
+
+
+def bench_formats(args):
+    formats = [audio_format for audio_format in args.formats.split(',') if audio_format]
+    with tempfile.TemporaryDirectory() as corpus_dir, tempfile.TemporaryDirectory() as tmp_dir:
+        keys = build_format_corpus(corpus_dir, args.files, args.seconds, formats)
+        print(f"コーパス: {args.files}件 x {args.seconds:.0f}秒（合成音声）, スタンドイン遅延: {args.latency_ms}ms, "
+              f"S3帯域: {f'{args.bandwidth_mbps:g}Mbps' if args.bandwidth_mbps else '無制限'}")
+        with StandinServers(corpus_dir, [], args.latency_ms, args.bandwidth_mbps) as servers:
+            runs = [('wav-file', 'wav', False)] if 'wav' in formats else []
+            runs += [(audio_format, audio_format, True) for audio_format in formats]
+            for label, audio_format, streaming in runs:
+                latencies, wall = asyncio.run(bench_decode(servers, keys[audio_format], tmp_dir, streaming))
+                size = statistics.mean(os.path.getsize(os.path.join(corpus_dir, key)) for key in keys[audio_format])
+                report(label, latencies, wall)
+                print(f"{'':<18} 1件あたり {size / 1024:8.1f}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+推論エンジンと推論サイドカー（Unixソケット）
+
+- InferenceEngine: Whisperモデル（レジストリ・カスケード・無音ゲート・長時間録音モード）を持ち、
+  16kHzモノラルの音声配列を文字起こしする。INFERENCE_SOCKETを指定しない場合はmain.pyの
+  プロセス内で使う（従来通り）
+- 推論サイドカー: このファイルを単独で起動すると、InferenceEngineを持つ長寿命のプロセスとして
+  Unixソケットで文字起こしを受け付ける。main.pyにINFERENCE_SOCKETを指定すると、main.pyは
+  モデルを読み込まずにInferenceClient（inference_client.py）で推論を依頼するだけになる。APIサーバーを再起動・再デプロイしても
+  モデルは読み込み済みのまま残り、推論のメモリ使用量の増加がHTTPの処理に影響しない
+
+起動例:
+    python3 inference.py --socket /run/whisper-inference/inference.sock
+    INFERENCE_SOCKET=/run/whisper-inference/inference.sock python3 main.py
+
+プロトコル（1接続で複数回のやりとりが可能）:
+    要求: [4バイト: ヘッダー長][ヘッダー（JSON）][本体（ヘッダーのpayload_bytesバイト）]
+    応答: [4バイト: ヘッダー長][ヘッダー（JSON）]
+    ヘッダーのop: transcribe（本体はfloat32のリトルエンディアン配列、device_idはノイズプロファイル用） / check / stats
+    1分の音声は約3.8MBで、Unixソケットでのコピーは数ミリ秒のため共有メモリは使わない
+
+Whisper / torchを使うモジュール（transcription / long_audio）は、推論を行うプロセス（サイドカー、または
+INFERENCE_SOCKETを指定しないAPIサーバー）だけが読み込むよう、InferenceEngineの中で読み込む。
+"""
+
+import argparse
+import asyncio
+import grp
+import json
+import logging
+import os
+import signal
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from inference_client import LENGTH, encode_frame
+from model_registry import ModelBudgetError, ModelRegistry
+from noise_profile import NoiseProfileConfig, NoiseProfiles, extract_features
+
+logger = logging.getLogger(__name__)
+
+class InferenceEngine:
+    """Whisperモデルを持ち、音声配列を文字起こしする（APIサーバー内、または推論サイドカー内で使う）"""
+
+    def __init__(self, model_registry: ModelRegistry, cascade_config, cascade_model=None,
+                 no_speech_gate: Optional[float] = None, long_audio=None,
+                 noise_profiles: Optional[NoiseProfiles] = None):
+        self.model_registry = model_registry
+        self.cascade_config = cascade_config
+        self.cascade_model = cascade_model
+        self.no_speech_gate = no_speech_gate
+        self.long_audio = long_audio
+        self.noise_profiles = noise_profiles
+        self.started_at = time.time()
+
+    @classmethod
+    def from_env(cls) -> "InferenceEngine":
+        """環境変数に従ってモデルを読み込む（長時間録音モードのワーカーをforkするため、スレッドを起動する前に呼ぶ）"""
+        from long_audio import LongAudioConfig, LongAudioTranscriber
+        from transcription import CascadeConfig
+
+        print("Whisperモデルを読み込み中...")
+        # モデルは初回利用時に読み込み、MODEL_MEMORY_BUDGET_MBを超える場合は最後に使ってから
+        # 最も時間が経ったモデルから削除する（推論中のモデルは削除しない）
+        # ⚠️ 警告: デフォルトの予算（600MB）はEC2（t4g.small）でbase + tinyまでしか読み込めません
+        # より大きなモデルを使う場合は、EC2インスタンスのスケールアップとセットで予算を増やしてください
+        # - small以上: t3.medium（4GB RAM）以上が必要
+        # - medium以上: t3.large（8GB RAM）以上が必要
+        # - large: t3.xlarge（16GB RAM）以上が必要
+        model_registry = ModelRegistry.from_env()
+        for preload_model_name in [name.strip() for name in os.getenv('WHISPER_PRELOAD_MODELS', 'base').split(',') if name.strip()]:
+            model_registry.get(preload_model_name)
+            print(f"Whisper {preload_model_name}モデル読み込み完了")
+
+        # カスケード（オプション）: 軽量モデルで発話の有無を先に判定し、発話がありそうなブロックだけbaseモデルで処理する
+        # tinyモデルはbaseモデルと合わせてもt4g.small（2GB RAM）に収まる（tiny: 約75MB）
+        cascade_model_name = os.getenv('CASCADE_MODEL', '')
+        cascade_config = CascadeConfig(
+            model_name=cascade_model_name,
+            no_speech_threshold=float(os.getenv('CASCADE_NO_SPEECH_THRESHOLD', '0.6')),
+            logprob_threshold=float(os.getenv('CASCADE_LOGPROB_THRESHOLD', '-1.0'))
+        )
+        cascade_model = None
+        if cascade_model_name:
+            print(f"カスケード用Whisper {cascade_model_name}モデルを読み込み中...")
+            # カスケード用モデルは常に使うため、レジストリに固定して削除されないようにする
+            cascade_model = model_registry.get(cascade_model_name, pin=True)
+            print(f"カスケード用Whisper {cascade_model_name}モデル読み込み完了")
+
+        # 無音ゲート（オプション）: 30秒ウィンドウごとにエンコーダーとno_speechトークンの確率だけを先に計算し、
+        # 無音確率がこの値を超えるウィンドウはデコードを省略する。空の場合は従来通りwhisper.transcribeを使用
+        no_speech_gate = float(os.environ['NO_SPEECH_GATE_THRESHOLD']) if os.getenv('NO_SPEECH_GATE_THRESHOLD') else None
+
+        # 長時間録音モード（オプション）: LONG_AUDIO_MIN_SECONDSより長い録音を無音区間で分割し、
+        # LONG_AUDIO_WORKERS個のワーカープロセスで並列に文字起こしする
+        long_audio_config = LongAudioConfig.from_env()
+        long_audio = None
+        if long_audio_config.workers > 0:
+            # ワーカーはbaseモデルをforkで共有するため、親プロセスでも削除しないよう固定する
+            long_audio = LongAudioTranscriber(model_registry.get("base", pin=True), long_audio_config, no_speech_gate)
+            # ワーカーはforkで作成するため、サーバーがスレッドを起動する前（モデル読み込み直後）に起動する
+            long_audio.start()
+            print(f"長時間録音モード有効: {long_audio_config.workers}ワーカー（{long_audio_config.min_seconds:.0f}秒超の録音が対象）")
+
+        # ノイズプロファイル（オプション）: Whisperが空の結果を返したブロックからデバイスごとのノイズを学習し、
+        # そのデバイスのノイズの範囲内のブロックは推論の前に発話なしと判定する
+        noise_profile_config = NoiseProfileConfig.from_env()
+        noise_profiles = None
+        if noise_profile_config.enabled:
+            noise_profiles = NoiseProfiles(noise_profile_config)
+            print(f"ノイズプロファイル有効: {noise_profile_config.path}（{noise_profile_config.min_samples}件の学習後に判定）")
+
+        return cls(model_registry, cascade_config, cascade_model, no_speech_gate, long_audio, noise_profiles)
+
+    def check(self, model_name: str) -> None:
+        """モデルを使えるかを読み込まずに確認する（未対応はKeyError、予算超過はModelBudgetError）"""
+        try:
+            self.model_registry.check(model_name)
+        except KeyError:
+            raise KeyError(f"サポートされていないモデル: {model_name}. 対応モデル: {', '.join(sorted(self.model_registry.allowed))}")
+
+    def transcribe(self, audio: np.ndarray, model_name: str, device_id: Optional[str] = None) -> Dict:
+        """レジストリからモデルを取得して（未読み込みなら読み込んで）文字起こしする（スレッドで実行）
+
+        device_idを指定し、ノイズプロファイルが有効な場合は、推論の前にデバイスのノイズの範囲内かを判定する。
+        """
+        from transcription import SILENCE_THRESHOLD
+
+        # 共通の閾値で無音のブロックはtranscribe_audioがRMSで判定するため、プロファイルの対象にしない
+        if self.noise_profiles is None or device_id is None or not len(audio) \
+                or np.sqrt(np.mean(audio ** 2)) < SILENCE_THRESHOLD:
+            return self._transcribe(audio, model_name)
+        features = extract_features(audio)
+        if features is None:
+            return self._transcribe(audio, model_name)
+        decision = self.noise_profiles.classify(device_id, features)
+        if decision == "skip":
+            logger.info(f"🔈 ノイズプロファイル: device={device_id}のノイズの範囲内と判定、Whisperをスキップ")
+            return {"transcription": "", "silent": True, "hallucinated": False, "resolved_by": "noise_profile"}
+        transcribe_start = time.time()
+        analysis = self._transcribe(audio, model_name)
+        # 監査の対象にしたブロックはWhisperの結果をそのまま使い、誤判定かどうかを記録する
+        self.noise_profiles.observe(device_id, features, analysis, time.time() - transcribe_start,
+                                    audited=decision == "audit")
+        return analysis
+
+    def _transcribe(self, audio: np.ndarray, model_name: str) -> Dict:
+        from transcription import transcribe_audio
+
+        with self.model_registry.use(model_name) as whisper_model:
+            # 長時間録音のワーカーはbaseモデルのコピーを持つため、同じモデルの場合のみ使う
+            long_audio = self.long_audio if self.long_audio and self.long_audio.whisper_model is whisper_model else None
+            return transcribe_audio(
+                audio, whisper_model, self.cascade_model, self.cascade_config, self.no_speech_gate, long_audio
+            )
+
+    def stats(self) -> Dict:
+        """/cascade/stats・/gating/stats・/models・/inference/statsの内容"""
+        from transcription import cascade_stats, gating_stats
+
+        return {
+            "cascade": {
+                "enabled": self.cascade_model is not None,
+                "model": self.cascade_config.model_name or None,
+                "no_speech_threshold": self.cascade_config.no_speech_threshold,
+                "logprob_threshold": self.cascade_config.logprob_threshold,
+                **cascade_stats.snapshot()
+            },
+            "gating": {
+                "enabled": self.no_speech_gate is not None,
+                "no_speech_threshold": self.no_speech_gate,
+                **gating_stats.snapshot()
+            },
+            "models": self.model_registry.snapshot(),
+            "noise_profile": {
+                "enabled": self.noise_profiles is not None,
+                **(self.noise_profiles.snapshot() if self.noise_profiles else {})
+            },
+            "engine": {
+                "pid": os.getpid(),
+                "started_at": self.started_at,
+                "uptime_seconds": round(time.time() - self.started_at, 1),
+            },
+        }
+
+    def close(self):
+        if self.long_audio:
+            self.long_audio.close()
+        if self.noise_profiles:
+            self.noise_profiles.close()
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[Dict, bytes]]:
+    try:
+        length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    except asyncio.IncompleteReadError:
+        return None  # クライアントが接続を閉じた
+    header = json.loads(await reader.readexactly(length))
+    payload = await reader.readexactly(header.get("payload_bytes", 0))
+    return header, payload
+
+
+def _handle(engine: InferenceEngine, header: Dict, payload: bytes):
+    op = header.get("op")
+    if op == "transcribe":
+        audio = np.frombuffer(payload, dtype='<f4').astype(np.float32)
+        return engine.transcribe(audio, header["model"], header.get("device_id"))
+    if op == "check":
+        return engine.check(header["model"])
+    if op == "stats":
+        return engine.stats()
+    raise ValueError(f"不明な操作: {op}")
+
+
+async def serve(engine: InferenceEngine, socket_path: str):
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    return
+                header, payload = request
+                try:
+                    # 推論はスレッドで実行する（同時に届いた依頼はtranscription.whisper_lockで1件ずつ処理される）
+                    result = await asyncio.to_thread(_handle, engine, header, payload)
+                    response = {"ok": True, "result": result}
+                except Exception as e:
+                    error = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+                    response = {"ok": False, "error_type": type(e).__name__, "error": error}
+                    if not isinstance(e, (KeyError, ModelBudgetError)):
+                        logger.error(f"❌ 推論エラー: {error}")
+                writer.write(encode_frame(response))
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+
+    # 前回の起動で残ったソケットファイルを削除してから待ち受ける
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o750, exist_ok=True)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # 推論を依頼できるのはソケットの所有者とグループだけにする（作成した時点から0660にする）
+    previous_umask = os.umask(0o117)
+    try:
+        server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+    finally:
+        os.umask(previous_umask)
+    # APIサーバーが別のユーザーで動く場合は、そのユーザーが属するグループをINFERENCE_SOCKET_GROUPに指定する
+    socket_group = os.getenv('INFERENCE_SOCKET_GROUP', '')
+    if socket_group:
+        gid = int(socket_group) if socket_group.isdigit() else grp.getgrnam(socket_group).gr_gid
+        os.chown(socket_path, -1, gid)
+    print(f"推論サイドカー起動: {socket_path}（pid={os.getpid()}）")
+    # docker stop（SIGTERM）でも終了処理（ワーカーの停止・ノイズプロファイルの保存）を行う
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    async with server:
+        await stop.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whisperモデルを読み込んだまま文字起こしを受け付ける推論サイドカー")
+    parser.add_argument('--socket', default=os.getenv('INFERENCE_SOCKET', '/run/whisper-inference/inference.sock'),
+                        help="待ち受けるUnixソケットのパス（デフォルト: INFERENCE_SOCKET）")
+    args = parser.parse_args()
+
+    engine = InferenceEngine.from_env()
+    try:
+        asyncio.run(serve(engine, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    main()
@@ -0,0 +1,90 @@
+"""
+推論サイドカー（inference.py）のクライアントとプロトコル
+
+INFERENCE_SOCKETを指定したAPIサーバーは、このモジュールだけを使って推論を依頼する。
+Whisper / torchを読み込まないため、APIサーバーのプロセスはモデル関連のメモリを使わない。
+プロトコルはinference.pyを参照。
+"""
+
+import json
+import os
+import socket
+import struct
+from typing import Dict, Optional
+
+import numpy as np
+
+from model_registry import ModelBudgetError
+
+LENGTH = struct.Struct('>I')
+
+
+class InferenceUnavailableError(Exception):
+    """推論サイドカーに接続できない場合の例外"""
+
+
+class InferenceError(Exception):
+    """推論サイドカーで推論が失敗した場合の例外"""
+
+
+def encode_frame(header: Dict, payload: bytes = b'') -> bytes:
+    """[4バイト: ヘッダー長][ヘッダー（JSON）][本体] の1フレームを作る"""
+    body = json.dumps({**header, "payload_bytes": len(payload)}, ensure_ascii=False).encode('utf-8')
+    return LENGTH.pack(len(body)) + body + payload
+
+
+class InferenceClient:
+    """推論サイドカーに文字起こしを依頼するクライアント（InferenceEngineと同じメソッドを持つ）
+
+    呼び出しごとに接続するため、サイドカーを再起動しても次の呼び出しからそのまま使える。
+    timeoutは文字起こし、control_timeoutはモデルの確認・集計（推論を待たない呼び出し）を待つ秒数。
+    """
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None, control_timeout: Optional[float] = None):
+        self.socket_path = socket_path
+        self.timeout = timeout if timeout is not None else float(os.getenv('INFERENCE_TIMEOUT_SECONDS', '600'))
+        self.control_timeout = (control_timeout if control_timeout is not None
+                                else float(os.getenv('INFERENCE_CONTROL_TIMEOUT_SECONDS', '10')))
+
+    def _recv_exactly(self, sock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(min(size - len(data), 1024 * 1024))
+            if not chunk:
+                # 応答の途中でサイドカーが終了した（フレームが途中で切れた）
+                raise InferenceUnavailableError(f"推論サイドカー（{self.socket_path}）との接続が応答の途中で切断されました")
+            data.extend(chunk)
+        return bytes(data)
+
+    def _call(self, header: Dict, payload: bytes = b'', timeout: Optional[float] = None) -> Dict:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout if timeout is not None else self.timeout)
+                sock.connect(self.socket_path)
+                sock.sendall(encode_frame(header, payload))
+                length, = LENGTH.unpack(self._recv_exactly(sock, LENGTH.size))
+                response = json.loads(self._recv_exactly(sock, length))
+        except OSError as e:
+            # 接続できない・タイムアウトに加え、呼び出し中のサイドカーの再起動
+            # （ConnectionResetError / BrokenPipeError）も同じく利用不可として扱う
+            raise InferenceUnavailableError(f"推論サイドカー（{self.socket_path}）に接続できません: {str(e)}")
+        except ValueError as e:
+            raise InferenceUnavailableError(f"推論サイドカー（{self.socket_path}）の応答が不正です: {str(e)}")
+        if response.get("ok"):
+            return response.get("result")
+        # サイドカー側の例外を同じ種類の例外として送出する
+        error_type = {"KeyError": KeyError, "ModelBudgetError": ModelBudgetError}.get(response.get("error_type"), InferenceError)
+        raise error_type(response.get("error"))
+
+    def check(self, model_name: str) -> None:
+        self._call({"op": "check", "model": model_name}, timeout=self.control_timeout)
+
+    def transcribe(self, audio: np.ndarray, model_name: str, device_id: Optional[str] = None) -> Dict:
+        return self._call({"op": "transcribe", "model": model_name, "device_id": device_id},
+                          np.ascontiguousarray(audio, dtype='<f4').tobytes())
+
+    def stats(self) -> Dict:
+        return self._call({"op": "stats"}, timeout=self.control_timeout)
+
+    def close(self):
+        pass
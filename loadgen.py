@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+負荷試験用のリクエスト再生ツール（ロードジェネレーター）
+
+main.pyのTRAFFIC_CAPTURE_PATHで記録したリクエスト（traffic.py）、または合成した
+リクエスト列を、記録された到着間隔のまま（--speedで速度を変えて）APIサーバーへ送信し、
+スループット・レイテンシの分布・エラー数・重複した処理の数を集計する。
+
+- --trace: 記録したJSONLファイルを再生する
+- --synthetic: デバイスごとに--interval秒おきに最新ブロックを依頼するリクエスト列を合成する。
+  --retry-rateの割合でクライアントのリトライ（同じリクエストの再送）を模す
+- --spawn-server: S3 / PostgRESTスタンドインをこのプロセス内で起動し、リクエスト列が参照する
+  音声ファイルとaudio_filesの行を生成してから、スタンドインに接続したAPIサーバーを
+  子プロセスとして起動する（--server-cmdで起動コマンドを変更可能）
+- 重複した処理は、スタンドインのvibe_whisperへのupsertのうち同じ行への2回目以降の数と、
+  S3から同じオブジェクトを2回以上転送した数で数える
+
+使用例:
+    python3 loadgen.py --synthetic --devices 20 --rounds 6 --interval 60 --speed 10 --spawn-server
+    python3 loadgen.py --trace traffic.jsonl --speed 2 --target http://127.0.0.1:8001 \\
+        --supabase-url http://127.0.0.1:9001 --s3-url http://127.0.0.1:9000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiohttp
+import numpy as np
+
+from bench_io import BUCKET, DUMMY_KEY, StandinServers, audio_file_row, write_audio
+from pipeline import parse_file_path
+from traffic import load_trace
+
+DEFAULT_SERVER_CMD = "{python} -m uvicorn main:app --host 127.0.0.1 --port {port}"
+
+
+def synthesize_trace(devices: int, rounds: int, interval: float, jitter: float, retry_rate: float,
+                     retry_after: float, interface: str, seed: int = 0) -> List[Dict]:
+    """デバイスごとに--interval秒おきに最新ブロックを依頼するリクエスト列（到着時刻順）を作成する
+
+    ブロックは当日（UTC）の00-00から30分刻み。retry_rateの割合のリクエストは
+    retry_after秒後に同じ内容で再送する（タイムアウトしたクライアントのリトライ）。
+    """
+    rng = np.random.default_rng(seed)
+    local_date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    started = time.time()
+    entries = []
+    for round_index in range(rounds):
+        time_block = f"{(round_index // 2) % 24:02d}-{(round_index % 2) * 30:02d}"
+        for device_index in range(devices):
+            device_id = f"loadgen-device-{device_index:03d}"
+            if interface == 'device':
+                payload = {"device_id": device_id, "local_date": local_date, "time_blocks": [time_block]}
+            else:
+                payload = {"file_paths": [audio_file_row(device_id, local_date, time_block)['file_path']]}
+            ts = started + round_index * interval + float(rng.uniform(0, jitter))
+            entries.append({"ts": ts, "endpoint": "/fetch-and-transcribe", "payload": payload})
+            if rng.random() < retry_rate:
+                entries.append({"ts": ts + retry_after, "endpoint": "/fetch-and-transcribe", "payload": payload, "retry": True})
+    return sorted(entries, key=lambda entry: entry['ts'])
+
+
+def referenced_rows(entries: List[Dict]) -> List[Dict]:
+    """リクエスト列が参照する音声ファイルのaudio_filesの行（time_blocksを省略したリクエストは対象外）"""
+    rows: Dict[str, Dict] = {}
+
+    def add(device_id: str, local_date: str, time_blocks: Optional[List[str]]):
+        for time_block in time_blocks or []:
+            row = audio_file_row(device_id, local_date, time_block)
+            rows.setdefault(row['file_path'], row)
+
+    for entry in entries:
+        payload = entry['payload']
+        for file_path in payload.get('file_paths') or []:
+            audio_file = parse_file_path(file_path)
+            if audio_file:
+                row = audio_file_row(audio_file['device_id'], audio_file['local_date'], audio_file['time_block'])
+                rows.setdefault(file_path, {**row, 'file_path': file_path})
+        if payload.get('device_id') and payload.get('local_date'):
+            add(payload['device_id'], payload['local_date'], payload.get('time_blocks'))
+        for selector in payload.get('selectors') or []:
+            add(selector['device_id'], selector['local_date'], selector.get('time_blocks'))
+    return list(rows.values())
+
+
+def build_trace_corpus(root: str, rows: List[Dict], seconds: float):
+    rng = np.random.default_rng(0)
+    for row in rows:
+        write_audio(root, row['file_path'], seconds, rng)
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class LoadResult:
+    """1リクエスト分の結果"""
+    __slots__ = ("latency", "status", "files", "file_errors", "error")
+
+    def __init__(self, latency: float, status: Optional[int], files: int = 0, file_errors: int = 0,
+                 error: Optional[str] = None):
+        self.latency = latency
+        self.status = status
+        self.files = files
+        self.file_errors = file_errors
+        self.error = error
+
+
+def parse_response(body: bytes, stream_format: Optional[str]) -> Dict:
+    """応答の本体から最終結果（summaryを含むJSON）を取り出す
+
+    記録したリクエストはstream（"ndjson" / "sse"）を含むことがあるため、ストリーミング応答では
+    最後のsummaryイベントを返す。errorイベントで終了した場合はValueError。
+    """
+    if not stream_format:
+        return json.loads(body)
+    events = []
+    if stream_format == "sse":
+        for block in body.decode('utf-8').split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines() if ': ' in line)
+            if 'data' in fields:
+                events.append((fields.get('event'), json.loads(fields['data'])))
+    else:
+        for line in body.decode('utf-8').splitlines():
+            if line.strip():
+                event = json.loads(line)
+                events.append((event.get('type', 'summary'), event))
+    if not events:
+        raise ValueError("ストリーミング応答にイベントがありません")
+    event, payload = events[-1]
+    if event == 'error':
+        raise ValueError(payload.get('error', 'errorイベント'))
+    if event == 'file':
+        raise ValueError("ストリーミング応答がsummaryの前に終了しました")
+    return payload
+
+
+async def send(session: aiohttp.ClientSession, target: str, entry: Dict) -> LoadResult:
+    started = time.perf_counter()
+    try:
+        async with session.post(target + entry['endpoint'], json=entry['payload']) as response:
+            # ストリーミング応答は最後のイベント（summary）まで読み終えた時点をレイテンシとする
+            body = await response.read()
+            latency = time.perf_counter() - started
+            if response.status != 200:
+                return LoadResult(latency, response.status, error=f"HTTP {response.status}: {body[:200].decode(errors='replace')}")
+            try:
+                summary = parse_response(body, entry['payload'].get('stream')).get('summary', {})
+            except ValueError as e:
+                return LoadResult(latency, 200, error=f"ストリーミング応答のエラー: {e}")
+            return LoadResult(latency, 200, summary.get('pending_processed', 0), summary.get('errors', 0))
+    except Exception as e:
+        return LoadResult(time.perf_counter() - started, None, error=f"{type(e).__name__}: {e}")
+
+
+async def replay(entries: List[Dict], target: str, speed: float, timeout: float) -> Tuple[List[LoadResult], float]:
+    """記録された到着間隔を1/speedに縮めてリクエストを送信する（応答を待たずに次を送る）"""
+    first_ts = entries[0]['ts']
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=client_timeout, connector=connector) as session:
+        started = time.perf_counter()
+
+        async def fire(entry: Dict) -> LoadResult:
+            delay = (entry['ts'] - first_ts) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return await send(session, target, entry)
+
+        results = await asyncio.gather(*(fire(entry) for entry in entries))
+        return list(results), time.perf_counter() - started
+
+
+async def fetch_json(url: str) -> Optional[Dict]:
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+            async with session.get(url) as response:
+                return await response.json() if response.status == 200 else None
+    except Exception:
+        return None
+
+
+def wait_for_server(target: str, process: subprocess.Popen, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"APIサーバーが起動中に終了しました（終了コード {process.returncode}）")
+        if asyncio.run(fetch_json(target + '/')) is not None:
+            return
+        time.sleep(0.5)
+    raise RuntimeError(f"APIサーバーが{timeout:.0f}秒以内に起動しませんでした")
+
+
+def report(entries: List[Dict], results: List[LoadResult], wall_seconds: float,
+           unique_files: Set[str], postgrest_stats: Optional[Dict], s3_stats: Optional[Dict]) -> Dict:
+    latencies = sorted(result.latency for result in results)
+    failed = [result for result in results if result.error]
+    processed = sum(result.files for result in results)
+    summary = {
+        "requests": len(results),
+        "retries": sum(1 for entry in entries if entry.get('retry')),
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_rps": round(len(results) / wall_seconds, 3) if wall_seconds else None,
+        "files_processed": processed,
+        "files_per_second": round(processed / wall_seconds, 3) if wall_seconds else None,
+        "latency_seconds": {
+            "mean": round(statistics.mean(latencies), 3),
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p95": round(percentile(latencies, 0.95), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "errors": len(failed),
+        "file_errors": sum(result.file_errors for result in results),
+        "unique_files": len(unique_files),
+    }
+    if postgrest_stats is not None:
+        summary["duplicate_upserts"] = postgrest_stats.get('duplicate_upserts')
+    if s3_stats is not None:
+        # 本体の転送（200）だけを数える。304（キャッシュの検証のみ）は転送なし、
+        # 206はプレフィルターによるヘッダーのRange読み込みのため別に数える
+        transfers = s3_stats.get('status_200', 0)
+        summary["s3_transfers"] = transfers
+        summary["duplicate_s3_transfers"] = max(transfers - len(unique_files), 0)
+        summary["s3_range_reads"] = s3_stats.get('status_206', 0)
+
+    latency = summary["latency_seconds"]
+    print(f"リクエスト: {summary['requests']}件（うちリトライ{summary['retries']}件）、"
+          f"所要時間 {summary['wall_seconds']}s、スループット {summary['throughput_rps']}件/s")
+    print(f"ファイル: 処理 {processed}件（{summary['files_per_second']}件/s）、"
+          f"対象のユニーク数 {len(unique_files)}件、ファイル単位のエラー {summary['file_errors']}件")
+    print(f"レイテンシ: 平均={latency['mean']}s  p50={latency['p50']}s  p95={latency['p95']}s  "
+          f"p99={latency['p99']}s  最大={latency['max']}s")
+    print(f"エラー: {len(failed)}件")
+    for result in failed[:5]:
+        print(f"  - {result.error}")
+    if "duplicate_upserts" in summary:
+        print(f"重複した処理: vibe_whisperへの重複upsert {summary['duplicate_upserts']}件")
+    if "s3_transfers" in summary:
+        print(f"S3転送: {summary['s3_transfers']}回（重複 {summary['duplicate_s3_transfers']}回）、"
+              f"Range読み込み {summary['s3_range_reads']}回")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録・合成したリクエストを再生する負荷試験ツール")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trace', help="TRAFFIC_CAPTURE_PATHで記録したJSONLファイル")
+    source.add_argument('--synthetic', action='store_true', help="リクエスト列を合成する")
+    parser.add_argument('--speed', type=float, default=1.0, help="再生速度（2なら到着間隔を半分にする）")
+    parser.add_argument('--target', default='http://127.0.0.1:8001', help="APIサーバーのURL（--spawn-server時は無視）")
+    parser.add_argument('--timeout', type=float, default=600.0, help="1リクエストのタイムアウト（秒）")
+    # 合成
+    parser.add_argument('--devices', type=int, default=10, help="（合成）デバイス数")
+    parser.add_argument('--rounds', type=int, default=4, help="（合成）各デバイスのリクエスト回数")
+    parser.add_argument('--interval', type=float, default=60.0, help="（合成）各デバイスのリクエスト間隔（秒）")
+    parser.add_argument('--jitter', type=float, default=5.0, help="（合成）デバイス間の到着時刻のばらつき（秒）")
+    parser.add_argument('--retry-rate', type=float, default=0.0, help="（合成）再送するリクエストの割合")
+    parser.add_argument('--retry-after', type=float, default=30.0, help="（合成）再送までの時間（秒）")
+    parser.add_argument('--interface', choices=('file_paths', 'device'), default='file_paths',
+                        help="（合成）file_paths指定 / device_id + local_date + time_blocks指定")
+    parser.add_argument('--save-trace', help="合成したリクエスト列をJSONLで保存する")
+    # スタンドインとAPIサーバーの起動
+    parser.add_argument('--spawn-server', action='store_true', help="スタンドインとAPIサーバーを起動して試験する")
+    parser.add_argument('--server-cmd', default=DEFAULT_SERVER_CMD, help="APIサーバーの起動コマンド（{python} / {port}を置換）")
+    parser.add_argument('--port', type=int, default=8011, help="起動するAPIサーバーのポート")
+    parser.add_argument('--seconds', type=float, default=10.0, help="生成する音声ファイルの長さ（秒）")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="スタンドインの応答遅延（ミリ秒）")
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help="S3スタンドインの転送帯域（Mbps、0は無制限）")
+    parser.add_argument('--startup-timeout', type=float, default=300.0, help="APIサーバーの起動を待つ時間（秒）")
+    # 既存のスタンドインの集計
+    parser.add_argument('--supabase-url', help="PostgRESTスタンドインのURL（重複upsertの集計に使用）")
+    parser.add_argument('--s3-url', help="S3スタンドインのURL（重複転送の集計に使用）")
+    parser.add_argument('--report-json', help="集計結果をJSONで保存する")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        entries = synthesize_trace(args.devices, args.rounds, args.interval, args.jitter,
+                                   args.retry_rate, args.retry_after, args.interface)
+        if args.save_trace:
+            with open(args.save_trace, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    else:
+        entries = load_trace(args.trace)
+    if not entries:
+        parser.error("再生するリクエストがありません")
+
+    rows = referenced_rows(entries)
+    unique_files = {row['file_path'] for row in rows}
+    span = (entries[-1]['ts'] - entries[0]['ts']) / args.speed
+    print(f"リクエスト{len(entries)}件（対象ファイル{len(unique_files)}件）を約{span:.0f}秒で再生（速度x{args.speed:g}）")
+
+    if not args.spawn_server:
+        results, wall = asyncio.run(replay(entries, args.target, args.speed, args.timeout))
+        postgrest_stats = asyncio.run(fetch_json(args.supabase_url + '/_stats')) if args.supabase_url else None
+        s3_stats = asyncio.run(fetch_json(args.s3_url + '/_stats')) if args.s3_url else None
+        summary = report(entries, results, wall, unique_files, postgrest_stats, s3_stats)
+    else:
+        with tempfile.TemporaryDirectory() as corpus_dir:
+            build_trace_corpus(corpus_dir, rows, args.seconds)
+            with StandinServers(corpus_dir, rows, args.latency_ms, args.bandwidth_mbps) as servers:
+                target = f"http://127.0.0.1:{args.port}"
+                env = {
+                    **os.environ,
+                    'S3_ENDPOINT_URL': servers.s3_url,
+                    'S3_BUCKET_NAME': BUCKET,
+                    'AWS_ACCESS_KEY_ID': os.getenv('AWS_ACCESS_KEY_ID', 'loadgen'),
+                    'AWS_SECRET_ACCESS_KEY': os.getenv('AWS_SECRET_ACCESS_KEY', 'loadgen'),
+                    'SUPABASE_URL': servers.supabase_url,
+                    'SUPABASE_KEY': DUMMY_KEY,
+                }
+                # 本番のS3 / Supabaseに接続しないよう、.envより環境変数を優先させる（load_dotenvは上書きしない）
+                command = shlex.split(args.server_cmd.format(python=shlex.quote(sys.executable), port=args.port))
+                process = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+                try:
+                    wait_for_server(target, process, args.startup_timeout)
+                    results, wall = asyncio.run(replay(entries, target, args.speed, args.timeout))
+                finally:
+                    process.terminate()
+                    try:
+                        process.wait(timeout=30)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                postgrest_stats = asyncio.run(fetch_json(servers.supabase_url + '/_stats'))
+                s3_stats = asyncio.run(fetch_json(servers.s3_url + '/_stats'))
+                summary = report(entries, results, wall, unique_files, postgrest_stats, s3_stats)
+
+    if args.report_json:
+        with open(args.report_json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
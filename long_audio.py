@@ -0,0 +1,166 @@
+"""
+長時間録音の分割・並列文字起こし
+
+whisper.transcribeはファイル内の30秒ウィンドウを直前のテキストを条件にして順番に処理するため、
+長い録音は1本の直列処理になり、1つのワーカーしか使えない。
+LONG_AUDIO_WORKERSを指定すると、LONG_AUDIO_MIN_SECONDSより長い録音を無音の区間で
+独立したチャンクに分割し、ワーカープロセスで並列に文字起こししてから順番通りに連結する。
+連結したテキストは通常の処理と同じくハルシネーション判定を経てvibe_whisperに保存される。
+
+- ワーカーはスレッドではなくプロセス（Whisperのkv-cacheフックがモデル単位のため、
+  同じモデルを複数スレッドから同時に使えない）
+- プロセスは起動時にforkで作成し、読み込み済みのモデルをコピーオンライトで共有する
+  （ワーカーごとにモデルを読み込み直さないため、メモリ使用量がほとんど増えない）
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import whisper
+
+import transcription
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = whisper.audio.SAMPLE_RATE
+
+# 無音区間の検出に使うフレーム長と、平滑化するフレーム数（一瞬の小さな音ではなく持続した無音で切る）
+FRAME_SECONDS = 0.03
+SMOOTHING_FRAMES = 10
+
+# ワーカープロセスで使うモデル（fork前に親プロセスで設定し、子プロセスに引き継ぐ）
+_worker_model = None
+
+
+class LongAudioConfig:
+    """長時間録音モードの設定"""
+
+    def __init__(self, workers: int = 0, min_seconds: float = 90.0, chunk_seconds: float = 30.0,
+                 min_chunk_seconds: float = 10.0, threads_per_worker: int = 1):
+        self.workers = workers
+        self.min_seconds = min_seconds
+        self.chunk_seconds = chunk_seconds
+        self.min_chunk_seconds = min_chunk_seconds
+        self.threads_per_worker = threads_per_worker
+
+    @classmethod
+    def from_env(cls) -> "LongAudioConfig":
+        return cls(
+            workers=int(os.getenv('LONG_AUDIO_WORKERS', '0')),
+            min_seconds=float(os.getenv('LONG_AUDIO_MIN_SECONDS', '90')),
+            chunk_seconds=float(os.getenv('LONG_AUDIO_CHUNK_SECONDS', '30')),
+            min_chunk_seconds=float(os.getenv('LONG_AUDIO_MIN_CHUNK_SECONDS', '10')),
+            threads_per_worker=int(os.getenv('LONG_AUDIO_THREADS_PER_WORKER', '1')),
+        )
+
+
+def split_at_silence(audio: np.ndarray, chunk_seconds: float = 30.0, min_chunk_seconds: float = 10.0) -> List[Tuple[int, int]]:
+    """音声を最長chunk_secondsのチャンクに分割し、(開始サンプル, 終了サンプル) のリストを返す
+
+    各チャンクの終わりは、開始からmin_chunk_seconds〜chunk_secondsの範囲で
+    最も静かな（平滑化したRMSが最小の）位置にする。
+    """
+    frame = int(SAMPLE_RATE * FRAME_SECONDS)
+    max_length = int(SAMPLE_RATE * chunk_seconds)
+    min_length = int(SAMPLE_RATE * min_chunk_seconds)
+    if len(audio) <= max_length or len(audio) < frame:
+        return [(0, len(audio))]
+
+    n_frames = len(audio) // frame
+    frame_rms = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    smoothed = np.convolve(frame_rms, np.ones(SMOOTHING_FRAMES) / SMOOTHING_FRAMES, mode='same')
+
+    spans = []
+    start = 0
+    while len(audio) - start > max_length:
+        first = (start + min_length) // frame
+        last = min((start + max_length) // frame, n_frames)
+        quietest = first + int(np.argmin(smoothed[first:last])) if last > first else last
+        end = min(quietest * frame + frame // 2, start + max_length)
+        spans.append((start, end))
+        start = end
+    spans.append((start, len(audio)))
+    return spans
+
+
+def _init_worker(threads: int):
+    # ワーカー数 x スレッド数がコア数を超えないようにする
+    torch.set_num_threads(threads)
+
+
+def _gating_counts() -> Tuple[int, int, float, float]:
+    stats = transcription.gating_stats
+    return stats.windows, stats.skipped, stats.probe_seconds, stats.decode_seconds
+
+
+def _transcribe_chunk(chunk: np.ndarray, no_speech_gate: Optional[float]) -> Tuple[Dict, Tuple]:
+    """（ワーカープロセス）1チャンクを文字起こしし、結果と無音ゲートの集計の増分を返す"""
+    before = _gating_counts()
+    result = transcription.run_whisper(chunk, _worker_model, no_speech_gate)
+    after = _gating_counts()
+    return result, tuple(b - a for a, b in zip(before, after))
+
+
+class LongAudioTranscriber:
+    """長時間録音を無音区間で分割し、ワーカープロセスで並列に文字起こしする"""
+
+    def __init__(self, whisper_model, config: LongAudioConfig, no_speech_gate: Optional[float] = None):
+        self.whisper_model = whisper_model
+        self.config = config
+        self.no_speech_gate = no_speech_gate
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        """ワーカープロセスを起動する（スレッドを起動する前に呼ぶこと）"""
+        global _worker_model
+        if self._pool is not None:
+            return
+        _worker_model = self.whisper_model
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.config.workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_worker,
+            initargs=(self.config.threads_per_worker,),
+        )
+        # forkは最初の投入時に全ワーカー分まとめて行われる
+        self._pool.submit(int).result()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def applies(self, audio: np.ndarray) -> bool:
+        return len(audio) > self.config.min_seconds * SAMPLE_RATE
+
+    def transcribe(self, audio: np.ndarray) -> Dict:
+        """run_whisperと同じ形式（{"text": str, "no_speech_prob": float}）で結果を返す"""
+        self.start()
+        started = time.time()
+        spans = split_at_silence(audio, self.config.chunk_seconds, self.config.min_chunk_seconds)
+        futures = [self._pool.submit(_transcribe_chunk, audio[start:end], self.no_speech_gate) for start, end in spans]
+
+        texts = []
+        no_speech_probs = []
+        for future in futures:
+            result, gating_delta = future.result()
+            texts.append(result["text"].strip())
+            if result["no_speech_prob"] is not None:
+                no_speech_probs.append(result["no_speech_prob"])
+            if gating_delta[0]:
+                transcription.gating_stats.add(*gating_delta)
+
+        logger.info(
+            f"✂️ 長時間録音: {len(audio) / SAMPLE_RATE:.0f}秒を{len(spans)}チャンクに分割し、"
+            f"{self.config.workers}ワーカーで{time.time() - started:.2f}秒"
+        )
+        return {
+            "text": "".join(texts),
+            "no_speech_prob": min(no_speech_probs) if no_speech_probs else None
+        }
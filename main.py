@@ -1,25 +1,25 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, model_validator
-import tempfile
 import os
-import whisper
 import uvicorn
 import json
-from datetime import datetime
-import aiohttp
 import asyncio
-from supabase import create_client, Client
 from dotenv import load_dotenv
 import logging
 import time
-from typing import List, Dict, Set, Optional
-import boto3
+from typing import AsyncIterator, Callable, List, Dict, Optional, Tuple
 from botocore.exceptions import ClientError
-import numpy as np
-import soundfile as sf
-import re
-from collections import Counter
+from contextlib import asynccontextmanager
+
+from aio_clients import IOConfig, AsyncS3Client, AsyncPostgrestClient, S3ObjectCache, any_of_filter
+from inference_client import InferenceClient, InferenceUnavailableError
+from model_registry import ModelBudgetError
+from pipeline import AUDIO_FILE_COLUMNS, AUDIO_FILE_KEYSET, create_s3_client_from_env, parse_file_path, save_transcriptions
+from prefilter import Prefilter, PrefilterConfig
+from scheduler import SchedulerConfig, TranscriptionScheduler
+from traffic import TrafficRecorder
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO)
@@ -28,34 +28,55 @@ logger = logging.getLogger(__name__)
 # 環境変数を読み込み
 load_dotenv()
 
-app = FastAPI(title="Whisper API for WatchMe", description="WatchMe統合システム用Whisper音声文字起こしAPI - Supabase連携専用")
+# 非同期I/Oの接続プール設定（IO_CONCURRENCY / IO_TIMEOUT_SECONDS / IO_KEEPALIVE_SECONDS）
+io_config = IOConfig.from_env()
 
-# Supabaseクライアントの初期化
+# Supabaseクライアントの初期化（PostgRESTへ非同期で接続）
 supabase_url = os.getenv('SUPABASE_URL')
 supabase_key = os.getenv('SUPABASE_KEY')
 
 if not supabase_url or not supabase_key:
     raise ValueError("SUPABASE_URLおよびSUPABASE_KEYが設定されていません")
 
-supabase: Client = create_client(supabase_url, supabase_key)
+supabase = AsyncPostgrestClient(supabase_url, supabase_key, io_config)
 print(f"Supabase接続設定完了: {supabase_url}")
 
-# AWS S3クライアントの初期化
-aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
-aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+# AWS S3クライアントの初期化（AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY / AWS_REGION / S3_ENDPOINT_URL）
 s3_bucket_name = os.getenv('S3_BUCKET_NAME', 'watchme-vault')
 aws_region = os.getenv('AWS_REGION', 'us-east-1')
+s3_client = create_s3_client_from_env()
+# ダウンロードはboto3で生成した署名付きURLを使い、aiohttpの接続プール経由で行う
+# S3_CACHE_DIRを指定した場合は、ダウンロードした音声をローカルにキャッシュし、ETagで検証して再利用する
+s3_cache = S3ObjectCache.from_env()
+s3 = AsyncS3Client(s3_client, s3_bucket_name, io_config, cache=s3_cache)
+if s3_cache:
+    print(f"S3キャッシュ有効: {s3_cache.cache_dir}（上限{s3_cache.max_bytes // (1024 * 1024)}MB、{s3_cache.snapshot()['entries']}件）")
+print(f"AWS S3接続設定完了: バケット={s3_bucket_name}, リージョン={aws_region}")
 
-if not aws_access_key_id or not aws_secret_access_key:
-    raise ValueError("AWS_ACCESS_KEY_IDおよびAWS_SECRET_ACCESS_KEYが設定されていません")
+# プレフィルター（オプション）: PREFILTER_MIN_SECONDSを指定すると、S3の一覧（サイズ）とヘッダーのRange取得で
+# 空・ヘッダーのみ・短すぎるファイルをダウンロードせずに確定させる（無音の判定はダウンロード後に音声全体で行う）
+prefilter_config = PrefilterConfig.from_env()
+prefilter = Prefilter(s3, prefilter_config) if prefilter_config.enabled else None
+if prefilter:
+    print(f"プレフィルター有効: {prefilter_config.min_seconds:g}秒未満の録音をスキップ")
 
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name=aws_region
-)
-print(f"AWS S3接続設定完了: バケット={s3_bucket_name}, リージョン={aws_region}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # aiohttpのセッションはイベントループ上で作成・破棄する
+    await s3.start()
+    await supabase.start()
+    try:
+        yield
+    finally:
+        await s3.close()
+        await supabase.close()
+        inference.close()
+        if traffic_recorder:
+            traffic_recorder.close()
+
+
+app = FastAPI(title="Whisper API for WatchMe", description="WatchMe統合システム用Whisper音声文字起こしAPI - Supabase連携専用", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -66,15 +87,34 @@ app.add_middleware(
 )
 
 # Whisperモデルをグローバルで管理
-print("Whisperモデルを読み込み中...")
-models = {}
-# ⚠️ 警告: baseモデル以外を使用すると、EC2（t4g.small）のメモリ上限を超えてクラッシュします！
-# モデル変更時は必ずEC2インスタンスのスケールアップとセットで実施してください
-# - small以上: t3.medium（4GB RAM）以上が必要
-# - medium以上: t3.large（8GB RAM）以上が必要
-# - large: t3.xlarge（16GB RAM）以上が必要
-models["base"] = whisper.load_model("base")
-print("Whisper baseモデル読み込み完了（サーバーリソース制約により固定）")
+# INFERENCE_SOCKETを指定した場合は、モデルを読み込まずに推論サイドカー（inference.py）へ推論を依頼する。
+# サイドカーはAPIサーバーの再起動・再デプロイとは独立して動き続けるため、モデルは読み込み済みのまま残る
+inference_socket = os.getenv('INFERENCE_SOCKET', '')
+if inference_socket:
+    inference = InferenceClient(inference_socket)
+    print(f"推論サイドカーを使用: {inference_socket}")
+else:
+    # Whisper / torchはここで初めて読み込む（サイドカーを使う場合、APIサーバーはtorchを読み込まない）
+    from inference import InferenceEngine
+
+    # 長時間録音モードのワーカーはforkで作成するため、サーバーがスレッドを起動する前に読み込む
+    inference = InferenceEngine.from_env()
+
+# 推論の実行順を決めるスケジューラー: 締め切り（recorded_atからの経過時間）内のブロックを優先し、
+# 同じ優先度の中ではデバイス間で公平に推論枠を割り当てる
+scheduler = TranscriptionScheduler(SchedulerConfig.from_env())
+
+# トラフィックの記録（オプション）: TRAFFIC_CAPTURE_PATHを指定すると、受け付けたリクエストを
+# 到着時刻付きでJSONLファイルに追記する（loadgen.pyで再生できる）
+traffic_recorder = TrafficRecorder.from_env()
+if traffic_recorder:
+    print(f"トラフィック記録有効: {traffic_recorder.path}")
+
+# ストリーミング応答の形式とContent-Type
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
 
 # リクエストボディのモデル
 class FetchAndTranscribeRequest(BaseModel):
@@ -87,10 +127,14 @@ class FetchAndTranscribeRequest(BaseModel):
     file_paths: Optional[List[str]] = None  # 直接file_pathを指定
     
     # 共通パラメータ
-    model: str = "base"  # baseモデルのみサポート
+    model: str = "base"  # WHISPER_MODELSのいずれか。初回利用時に読み込み、MODEL_MEMORY_BUDGET_MBを超える分は古いモデルから削除（空きを作れない場合は400）
+    stream: Optional[str] = None  # ストリーミング応答（"ndjson" または "sse"）。省略時は従来通り一括応答
     
     @model_validator(mode='after')
     def validate_request(self):
+        if self.stream is not None and self.stream not in STREAM_FORMATS:
+            raise ValueError(f"streamには {', '.join(STREAM_FORMATS)} のいずれかを指定してください")
+        
         # どちらかのインターフェースが必要
         if self.device_id and self.local_date:
             # 新インターフェース
@@ -102,27 +146,300 @@ class FetchAndTranscribeRequest(BaseModel):
             raise ValueError("device_id + local_date または file_paths のどちらかを指定してください")
 
 
-@app.post("/fetch-and-transcribe")
-async def fetch_and_transcribe(request: FetchAndTranscribeRequest):
-    """WatchMeシステムのメイン処理エンドポイント（device_id/local_date/time_blocks対応版）"""
-    start_time = time.time()
+class TranscriptionSelector(BaseModel):
+    """バッチ処理の対象（1デバイス・1日分、time_blocksで絞り込み可）"""
+    device_id: str
+    local_date: str  # 日付（YYYY-MM-DD形式）
+    time_blocks: Optional[List[str]] = None  # 指定しない場合は全時間帯
+
+
+class BatchFetchAndTranscribeRequest(BaseModel):
+    selectors: List[TranscriptionSelector]
+    model: str = "base"  # WHISPER_MODELSのいずれか。初回利用時に読み込み、MODEL_MEMORY_BUDGET_MBを超える分は古いモデルから削除（空きを作れない場合は400）
+    stream: Optional[str] = None  # ストリーミング応答（"ndjson" または "sse"）
+    
+    @model_validator(mode='after')
+    def validate_request(self):
+        if self.stream is not None and self.stream not in STREAM_FORMATS:
+            raise ValueError(f"streamには {', '.join(STREAM_FORMATS)} のいずれかを指定してください")
+        if not self.selectors:
+            raise ValueError("selectorsを1件以上指定してください")
+        return self
+
+
+# 1リクエスト内で同時に処理するファイル数
+# 推論は1件ずつだが、次のファイルのダウンロードや前のファイルの保存を推論と並行して行う
+pipeline_concurrency = int(os.getenv('PIPELINE_CONCURRENCY', '2'))
+
+# audio_filesの検索で1ページあたりに取得する件数（keysetページネーション）
+audio_files_page_size = int(os.getenv('AUDIO_FILES_PAGE_SIZE', '25'))
+
+# バッチ処理で1回のクエリにまとめるselectorの数（URL長の上限対策）
+BATCH_SELECTORS_PER_QUERY = 30
+
+
+async def save_transcription(file_path: str, device_id: str, local_date: str, time_block: str, transcription: str):
+    """vibe_whisperテーブルへ保存し、audio_filesのステータスをcompletedに更新"""
+    audio_file = {'file_path': file_path, 'device_id': device_id, 'local_date': local_date, 'time_block': time_block}
+    await save_transcriptions(supabase, [(audio_file, transcription)])
+
+
+async def process_audio_file(audio_file: Dict, model_name: str) -> Dict:
+    """1ファイル分のダウンロード・文字起こし・保存を行い、処理結果を返す
+    
+    例外は送出せず、失敗した場合は status="error" の結果を返す。
+    """
+    file_start_time = time.time()
+    file_path = audio_file['file_path']
+    result = {
+        "file_path": file_path,
+        "time_block": audio_file['time_block'],
+        "status": "success",
+        "silent": False,
+        "hallucinated": False
+    }
+    
+    try:
+        # 新インターフェースの場合は既に情報があるので、抽出不要
+        time_block = audio_file['time_block']
+        local_date = audio_file['local_date']
+        device_id = audio_file['device_id']
+        
+        # ダウンロードせずに確定できるファイル（空・ヘッダーのみ・短すぎる）は空の文字起こし結果を保存する
+        skip_reason = await prefilter.check(file_path) if prefilter else None
+        if skip_reason:
+            analysis = {"transcription": "", "silent": True, "hallucinated": False, "resolved_by": "prefilter"}
+            result["prefilter"] = skip_reason
+        else:
+            # S3から受信しながらWhisperの入力形式（16kHzモノラル）にデコード（WAV / FLAC / Opus等、中間ファイルなし）
+            audio = await s3.download_audio(file_path)
+            
+            # 音声を分析・文字起こし（推論はスレッドで実行しイベントループを止めない）
+            # 推論枠はスケジューラーが優先度順に割り当てる
+            async with scheduler.slot(audio_file) as ticket:
+                analysis = await asyncio.to_thread(inference.transcribe, audio, model_name, device_id)
+            result["priority"] = ticket["priority"]
+            result["queue_wait_seconds"] = ticket["queue_wait_seconds"]
+        result["silent"] = analysis["silent"]
+        result["hallucinated"] = analysis["hallucinated"]
+        result["resolved_by"] = analysis["resolved_by"]
+        
+        await save_transcription(file_path, device_id, local_date, time_block, analysis["transcription"])
+        logger.info(f"✅ {file_path}: 文字起こし完了・Supabase保存済み")
+    
+    except ClientError as e:
+        error_msg = f"{file_path}: S3エラー - {str(e)}"
+        logger.error(f"❌ {error_msg}")
+        result["status"] = "error"
+        result["error"] = error_msg
+    
+    except Exception as e:
+        logger.error(f"❌ {file_path}: エラー - {str(e)}")
+        result["status"] = "error"
+        result["error"] = str(e)
+    
+    result["duration_seconds"] = round(time.time() - file_start_time, 2)
+    return result
+
+
+async def run_pipeline(file_source: AsyncIterator[Dict], model_name: str) -> AsyncIterator[Tuple[int, Dict]]:
+    """file_sourceから届いたファイルを処理し、完了したものから (投入順の番号, 処理結果) をyieldする
+    
+    同時に処理するファイル数はpipeline_concurrencyで制限し、file_sourceはその空きに合わせて
+    読み進める（ページ単位のDB取得と処理が重なり、全件の取得を待たずに処理が始まる）。
+    file_sourceで発生した例外（DBエラー等）は呼び出し元に送出する。
+    """
+    semaphore = asyncio.Semaphore(pipeline_concurrency)
+    results = asyncio.Queue()
+    tasks = set()
+    
+    async def run(index: int, audio_file: Dict):
+        try:
+            await results.put((index, await process_audio_file(audio_file, model_name)))
+        finally:
+            semaphore.release()
+    
+    async def produce() -> int:
+        count = 0
+        async for audio_file in file_source:
+            await semaphore.acquire()
+            tasks.add(asyncio.create_task(run(count, audio_file)))
+            count += 1
+        return count
+    
+    producer = asyncio.create_task(produce())
+    received = 0
+    try:
+        while not (producer.done() and received == producer.result()):
+            next_result = asyncio.create_task(results.get())
+            # 投入が終わっていれば結果だけを待ち、そうでなければ投入側の終了（またはエラー）も待つ
+            waiting = {next_result} if producer.done() else {next_result, producer}
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if next_result in done:
+                received += 1
+                yield next_result.result()
+            else:
+                next_result.cancel()
+    finally:
+        # クライアントの切断やDBエラーで中断した場合は未完了のタスクを取り消す
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def iter_files(files_to_process: List[Dict]) -> AsyncIterator[Dict]:
+    """処理対象のリストをrun_pipelineに渡すための非同期イテレータ"""
+    for audio_file in files_to_process:
+        yield audio_file
+
+
+async def iter_pending_files(first_page: List[Dict], pages: AsyncIterator[List[Dict]]) -> AsyncIterator[Dict]:
+    """取得済みの最初のページに続けて、残りのページを取得しながら1件ずつ返す"""
+    for audio_file in first_page:
+        yield audio_file
+    async for page in pages:
+        logger.info(f"audio_filesテーブルから次のページ{len(page)}件を取得")
+        for audio_file in page:
+            yield audio_file
+
+
+def build_response(request: FetchAndTranscribeRequest, total_files: int, file_results: List[Dict], start_time: float) -> Dict:
+    """処理結果からレスポンス（サマリー）を構築"""
+    successfully_transcribed = [r for r in file_results if r["status"] == "success"]
+    error_files = [r for r in file_results if r["status"] != "success"]
+    execution_time = time.time() - start_time
     
-    # サポートされているモデルの確認
-    if request.model not in ["base"]:
+    # レスポンスの構築（インターフェースによって異なる）
+    if request.device_id and request.local_date:
+        # 新インターフェースのレスポンス
+        return {
+            "status": "success",
+            "summary": {
+                "total_files": total_files,
+                "pending_processed": len(successfully_transcribed),
+                "errors": len(error_files)
+            },
+            "device_id": request.device_id,
+            "local_date": request.local_date,
+            "time_blocks_requested": request.time_blocks,
+            "processed_time_blocks": [f['time_block'] for f in successfully_transcribed],
+            "error_time_blocks": [f['time_block'] for f in error_files] if error_files else None,
+            "execution_time_seconds": round(execution_time, 1),
+            "message": f"{total_files}件中{len(successfully_transcribed)}件を正常に処理しました"
+        }
+    else:
+        # 既存インターフェースのレスポンス（後方互換性）
+        return {
+            "status": "success",
+            "summary": {
+                "total_files": total_files,
+                "pending_processed": len(successfully_transcribed),
+                "errors": len(error_files)
+            },
+            "processed_files": [f['file_path'] for f in successfully_transcribed],
+            "processed_time_blocks": [f['time_block'] for f in successfully_transcribed],
+            "error_files": [f['file_path'] for f in error_files] if error_files else None,
+            "execution_time_seconds": round(execution_time, 1),
+            "message": f"{total_files}件中{len(successfully_transcribed)}件を正常に処理しました"
+        }
+
+
+def build_empty_response(request: FetchAndTranscribeRequest, start_time: float) -> Dict:
+    """新インターフェースで処理対象のファイルがなかった場合のレスポンス"""
+    execution_time = time.time() - start_time
+    return {
+        "status": "success",
+        "summary": {
+            "total_files": 0,
+            "already_completed": 0,
+            "pending_processed": 0,
+            "errors": 0
+        },
+        "device_id": request.device_id,
+        "local_date": request.local_date,
+        "time_blocks_requested": request.time_blocks,
+        "processed_time_blocks": [],
+        "execution_time_seconds": round(execution_time, 1),
+        "message": "処理対象のファイルがありません（全て処理済みまたは該当なし）"
+    }
+
+
+def format_stream_event(stream_format: str, event: str, payload: Dict) -> str:
+    """ストリーミング応答の1イベント分の文字列を生成"""
+    body = json.dumps(payload, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {body}\n\n"
+    return body + "\n"
+
+
+def stream_response(stream_format: str, file_source: AsyncIterator[Dict], model_name: str,
+                    build_summary: Callable[[List[Dict]], Dict]) -> StreamingResponse:
+    """1ファイル完了ごとに結果を1行ずつ送信し、最後にサマリーを送信するストリーミング応答
+    
+    build_summaryは全ファイルの処理結果を受け取り、最後に送信するサマリーを返す。
+    """
+    async def event_generator():
+        file_results = []
+        try:
+            # 完了したファイルから順に送信
+            async for _, file_result in run_pipeline(file_source, model_name):
+                file_results.append(file_result)
+                yield format_stream_event(stream_format, "file", {"type": "file", **file_result})
+        except Exception as e:
+            # 応答ヘッダーは送信済みのため、エラーはイベントとして通知して終了する
+            logger.error(f"audio_filesテーブルのクエリエラー: {str(e)}")
+            yield format_stream_event(stream_format, "error", {"type": "error", "error": f"データベースクエリエラー: {str(e)}"})
+            return
+        
+        yield format_stream_event(stream_format, "summary", build_summary(file_results))
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type=STREAM_FORMATS[stream_format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def check_whisper_model(model_name: str) -> str:
+    """リクエストで指定されたWhisperモデルを使えるか確認する（未対応・予算超過の場合はHTTPException）
+
+    モデルの読み込みは最初のファイルの推論時にレジストリが行う。
+    """
+    try:
+        inference.check(model_name)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=e.args[0] if e.args else str(e))
+    except ModelBudgetError as e:
         raise HTTPException(
             status_code=400,
-            detail=f"サポートされていないモデル: {request.model}. 対応モデル: base. "
-                   f"⚠️ 警告: 他のモデルを使用するとメモリ不足でEC2がクラッシュします！"
-                   f"モデル変更にはEC2インスタンスのスケールアップが必要です。"
+            detail=f"{str(e)}. "
+                   f"⚠️ 警告: メモリ予算を超えるモデルを使用するとメモリ不足でEC2がクラッシュします！"
+                   f"モデル変更にはEC2インスタンスのスケールアップとMODEL_MEMORY_BUDGET_MBの変更が必要です。"
         )
+    except InferenceUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return model_name
+
+
+def get_inference_stats_or_503() -> Dict:
+    """推論エンジン（またはサイドカー）の集計を取得する（サイドカーに接続できない場合は503）"""
+    try:
+        return inference.stats()
+    except InferenceUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.post("/fetch-and-transcribe")
+async def fetch_and_transcribe(request: FetchAndTranscribeRequest):
+    """WatchMeシステムのメイン処理エンドポイント（device_id/local_date/time_blocks対応版）"""
+    start_time = time.time()
+    if traffic_recorder:
+        # ファイルへの書き込みでイベントループを止めないよう、スレッドで記録する（到着時刻は受付時に取得）
+        await asyncio.to_thread(traffic_recorder.record, "/fetch-and-transcribe", request.model_dump(exclude_none=True), time.time())
     
     # Whisperモデルを選択
-    whisper_model = models.get(request.model)
-    if not whisper_model:
-        raise HTTPException(
-            status_code=500,
-            detail=f"モデル {request.model} が読み込まれていません"
-        )
+    # サイドカーへの問い合わせ（ソケットの送受信）でイベントループを止めないよう、スレッドで確認する
+    model_name = await asyncio.to_thread(check_whisper_model, request.model)
     
     # リクエストの処理
     if request.device_id and request.local_date:
@@ -130,51 +447,57 @@ async def fetch_and_transcribe(request: FetchAndTranscribeRequest):
         logger.info(f"新インターフェース使用: device_id={request.device_id}, local_date={request.local_date}, time_blocks={request.time_blocks}")
         
         # audio_filesテーブルから該当するファイルを検索
-        query = supabase.table('audio_files') \
-            .select('file_path, device_id, recorded_at, local_date, time_block, transcriptions_status') \
-            .eq('device_id', request.device_id) \
-            .eq('local_date', request.local_date) \
-            .eq('transcriptions_status', 'pending')
+        filters = [
+            ('device_id', 'eq', request.device_id),
+            ('local_date', 'eq', request.local_date),
+            ('transcriptions_status', 'eq', 'pending')
+        ]
         
         # time_blocksが指定されている場合はフィルタを追加
         if request.time_blocks:
-            query = query.in_('time_block', request.time_blocks)
+            filters.append(('time_block', 'in', request.time_blocks))
+        
+        # recorded_at順にkeysetページネーションで取得し、ページが届き次第処理を開始する
+        pages = supabase.select_pages('audio_files', AUDIO_FILE_COLUMNS, filters, AUDIO_FILE_KEYSET, audio_files_page_size)
         
-        # クエリ実行
+        # 最初のページだけ先に取得（処理対象の有無の判定とクエリエラーの検出のため）
         try:
-            response = query.execute()
-            audio_files = response.data
-            logger.info(f"audio_filesテーブルから{len(audio_files)}件のファイルを取得")
+            first_page = await anext(pages, [])
+            logger.info(f"audio_filesテーブルから{len(first_page)}件のファイルを取得（最初のページ）")
         except Exception as e:
             logger.error(f"audio_filesテーブルのクエリエラー: {str(e)}")
             raise HTTPException(status_code=500, detail=f"データベースクエリエラー: {str(e)}")
         
-        # file_pathsリストを構築
-        file_paths = [file['file_path'] for file in audio_files]
+        if not first_page:
+            empty_response = build_empty_response(request, start_time)
+            if request.stream:
+                return stream_response(request.stream, iter_files([]), model_name, lambda _: empty_response)
+            return empty_response
         
-        if not file_paths:
-            execution_time = time.time() - start_time
-            return {
-                "status": "success",
-                "summary": {
-                    "total_files": 0,
-                    "already_completed": 0,
-                    "pending_processed": 0,
-                    "errors": 0
-                },
-                "device_id": request.device_id,
-                "local_date": request.local_date,
-                "time_blocks_requested": request.time_blocks,
-                "processed_time_blocks": [],
-                "execution_time_seconds": round(execution_time, 1),
-                "message": "処理対象のファイルがありません（全て処理済みまたは該当なし）"
-            }
+        # 取得したページの行をそのまま処理対象とする（file_path, device_id, local_date, time_block）
+        file_source = iter_pending_files(first_page, pages)
+        total_files = None  # 全ページを処理し終えた件数を総数とする
     
     elif request.file_paths:
         # 既存のインターフェース: file_pathsを直接指定
         logger.info(f"既存インターフェース使用: file_paths={len(request.file_paths)}件")
         file_paths = request.file_paths
-        audio_files = None  # 後方互換性のため
+        
+        # 処理対象ファイルの情報を構築（file_pathからdevice_id / local_date / time_blockを抽出）
+        files_to_process = [audio_file for audio_file in map(parse_file_path, file_paths) if audio_file]
+        
+        # スケジューラーの優先度判定に使うrecorded_atを補う（取得できない場合も処理は続行）
+        try:
+            rows = await supabase.select('audio_files', 'file_path, recorded_at', [('file_path', 'in', file_paths)])
+            recorded_at_by_path = {row['file_path']: row.get('recorded_at') for row in rows}
+            for audio_file in files_to_process:
+                audio_file['recorded_at'] = recorded_at_by_path.get(audio_file['file_path'])
+        except Exception as e:
+            logger.warning(f"⚠️ recorded_atの取得に失敗（受付時刻を基準に優先度を判定）: {str(e)}")
+        
+        logger.info(f"処理対象: {len(file_paths)}件のファイル")
+        file_source = iter_files(files_to_process)
+        total_files = len(file_paths)
     
     else:
         # ここに来ることはない（model_validatorで検証済み）
@@ -183,247 +506,201 @@ async def fetch_and_transcribe(request: FetchAndTranscribeRequest):
             detail="device_id + local_dateまたはfile_pathsのどちらかを指定してください"
         )
     
-    if not file_paths:
-        # file_pathsが空の場合は、処理対象なしとして正常終了
-        execution_time = time.time() - start_time
-        
-        return {
-            "status": "success",
-            "summary": {
-                "total_files": 0,
-                "already_completed": 0,
-                "pending_processed": 0,
-                "errors": 0
-            },
-            "processed_files": [],
-            "execution_time_seconds": round(execution_time, 1),
-            "message": "処理対象のファイルがありません"
-        }
-    
-    logger.info(f"処理対象: {len(file_paths)}件のファイル")
-    
-    # 処理対象ファイルの情報を構築
-    files_to_process = []
-    device_ids = set()
-    dates = set()
-    
-    # 新インターフェースの場合
-    if audio_files:
-        for audio_file in audio_files:
-            files_to_process.append({
-                'file_path': audio_file['file_path'],
-                'device_id': audio_file['device_id'],
-                'local_date': audio_file['local_date'],
-                'time_block': audio_file['time_block']
-            })
-            device_ids.add(audio_file['device_id'])
-            dates.add(audio_file['local_date'])
-    
-    # 既存インターフェースの場合（file_pathから情報を抽出）
-    else:
-        for file_path in file_paths:
-            # file_pathから情報を抽出
-            # 例: files/d067d407-cf73-4174-a9c1-d91fb60d64d0/2025-07-19/14-30/audio.wav
-            parts = file_path.split('/')
-            if len(parts) >= 5:
-                device_id = parts[1]  # d067d407-cf73-4174-a9c1-d91fb60d64d0
-                date_part = parts[2]  # 2025-07-19
-                time_part = parts[3]  # 14-30
-                
-                device_ids.add(device_id)
-                dates.add(date_part)
-                
-                files_to_process.append({
-                    'file_path': file_path,
-                    'device_id': device_id,
-                    'local_date': date_part,
-                    'time_block': time_part
-                })
+    # ストリーミング応答が指定されている場合は、1ファイル完了ごとに結果を送信
+    if request.stream:
+        return stream_response(
+            request.stream, file_source, model_name,
+            lambda file_results: build_response(
+                request, total_files if total_files is not None else len(file_results), file_results, start_time
+            )
+        )
     
     # 実際の音声ダウンロードと文字起こし処理
-    # 処理結果を記録
-    successfully_transcribed = []
-    error_files = []
-    
-    for audio_file in files_to_process:
-        try:
-            file_path = audio_file['file_path']
-            # 新インターフェースの場合は既に情報があるので、抽出不要
-            time_block = audio_file['time_block']
-            local_date = audio_file['local_date']
-            device_id = audio_file['device_id']
-            
-            # 一時ファイルに音声データをダウンロード
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
-                tmp_file_path = tmp_file.name
-                
-                try:
-                    # S3からファイルをダウンロード（file_pathをそのまま使用）
-                    s3_client.download_file(s3_bucket_name, file_path, tmp_file_path)
-                    
-                    # 音声ファイルを読み込んで分析
-                    try:
-                        audio_data, sample_rate = sf.read(tmp_file_path)
-                        
-                        # 音声のRMS（Root Mean Square）を計算して無音判定
-                        rms = np.sqrt(np.mean(audio_data**2))
-                        
-                        # 無音の閾値（実験的に調整が必要）
-                        silence_threshold = 0.0005  # より厳しい閾値に変更
-                        
-                        if rms < silence_threshold:
-                            logger.info(f"🔇 無音検出: RMS={rms:.6f} < {silence_threshold}")
-                            transcription = ""  # 無音の場合は空文字
-                        else:
-                            # Whisperで文字起こし
-                            result = whisper_model.transcribe(tmp_file_path, language="ja")
-                            transcription = result["text"].strip()
-                            
-                            # ハルシネーション検出（同じフレーズの繰り返し）
-                            if transcription:
-                                # 句読点で分割してセグメントを抽出
-                                segments = re.split(r'[、。，．,.]', transcription)
-                                segments = [s.strip() for s in segments if s.strip()]
-                                
-                                if segments:
-                                    # セグメントの繰り返しを検出
-                                    segment_counts = Counter(segments)
-                                    most_common_segment, count = segment_counts.most_common(1)[0]
-                                    
-                                    # 同じセグメントが10回以上繰り返される場合はハルシネーション
-                                    if count >= 10:
-                                        logger.warning(f"⚠️ ハルシネーション検出: '{most_common_segment}'が{count}回繰り返し")
-                                        transcription = ""  # ハルシネーションの場合は空文字
-                                    # 同じセグメントが全体の70%以上を占める場合もハルシネーション
-                                    elif len(segments) >= 5 and count >= len(segments) * 0.7:
-                                        logger.warning(f"⚠️ ハルシネーション検出: '{most_common_segment}'が全体の{count/len(segments)*100:.1f}%")
-                                        transcription = ""  # ハルシネーションの場合は空文字
-                                
-                                # 短いフレーズパターンの検出（日本語対応）
-                                if transcription:  # まだ空でない場合
-                                    # 日本語のフレーズパターンを抽出
-                                    pattern = r'([\u3040-\u309f\u30a0-\u30ff\u4e00-\u9faf]+[がのはをにでと]*)'
-                                    phrases = re.findall(pattern, transcription)
-                                    if phrases:
-                                        phrase_counts = Counter(phrases)
-                                        for phrase, count in phrase_counts.items():
-                                            if len(phrase) >= 2 and count >= 10:
-                                                logger.warning(f"⚠️ フレーズの過度な繰り返し検出: '{phrase}'が{count}回")
-                                                transcription = ""  # 繰り返しの場合は空文字
-                                                break
-                            
-                            # ログレベルの確認（no_speech_probが高い場合）
-                            if 'no_speech_prob' in result and result['no_speech_prob'] > 0.9:
-                                logger.info(f"📊 高い無音確率: no_speech_prob={result['no_speech_prob']:.2f}")
-                                if not transcription or len(transcription) < 5:
-                                    transcription = ""  # 無音確率が高く短いテキストは無視
-                    
-                    except Exception as audio_error:
-                        logger.error(f"音声分析エラー: {str(audio_error)}")
-                        # 音声分析に失敗した場合は通常のWhisper処理にフォールバック
-                        result = whisper_model.transcribe(tmp_file_path, language="ja")
-                        transcription = result["text"].strip()
-                    
-                    # vibe_whisperテーブルに保存（空の文字起こし結果も保存）
-                    data = {
-                        "device_id": device_id,
-                        "date": local_date,  # リクエストから受け取った日付をそのまま使用
-                        "time_block": time_block,
-                        "transcription": transcription if transcription else ""
-                    }
-                    
-                    # upsert（既存データは更新、新規データは挿入）
-                    response = supabase.table('vibe_whisper').upsert(data).execute()
-                    
-                    # ■■■ START: 詳細なデバッグログを追加 ■■■
-                    # Supabaseからの応答を詳細にログ出力
-                    logger.info(f"Supabase upsert response data: {response.data}")
-                    logger.info(f"Supabase upsert response count: {response.count}")
-                    
-                    # 応答にエラーが含まれていないか、データが空でないかを確認
-                    if not response.data:
-                        logger.error("❌ Supabase returned an empty response or an error.")
-                        logger.error(f"   - Full response object: {response}")
-                        # エラーとして扱い、処理を中断
-                        raise Exception("Supabase upsert failed with empty response.")
-                    # ■■■ END: 詳細なデバッグログを追加 ■■■
-                    
-                    # audio_filesテーブルのtranscriptions_statusをcompletedに更新
-                    # file_pathで直接更新する（シンプルで正確）
-                    try:
-                        update_response = supabase.table('audio_files') \
-                            .update({'transcriptions_status': 'completed'}) \
-                            .eq('file_path', file_path) \
-                            .execute()
-                        
-                        # 更新が成功したかチェック
-                        if update_response.data:
-                            logger.info(f"✅ audio_filesテーブルのステータス更新成功: {len(update_response.data)}件更新")
-                            logger.info(f"   file_path: {file_path}")
-                        else:
-                            logger.warning(f"⚠️ audio_filesテーブルのステータス更新: 対象レコードが見つかりません")
-                            logger.warning(f"   file_path: {file_path}")
-                            
-                    except Exception as update_error:
-                        logger.error(f"❌ audio_filesテーブルのステータス更新エラー: {str(update_error)}")
-                        logger.error(f"   file_path: {file_path}")
-                    
-                    successfully_transcribed.append({
-                        'file_path': file_path,
-                        'time_block': time_block
-                    })
-                    logger.info(f"✅ {file_path}: 文字起こし完了・Supabase保存済み")
-                
-                finally:
-                    # 一時ファイルを削除
-                    if os.path.exists(tmp_file_path):
-                        os.unlink(tmp_file_path)
-        
-        except ClientError as e:
-            error_msg = f"{audio_file['file_path']}: S3エラー - {str(e)}"
-            logger.error(f"❌ {error_msg}")
-            error_files.append(audio_file)
-        
-        except Exception as e:
-            logger.error(f"❌ {audio_file['file_path']}: エラー - {str(e)}")
-            error_files.append(audio_file)
+    # 処理結果を記録（完了順に届くため、投入順に並べ直す）
+    try:
+        indexed_results = [item async for item in run_pipeline(file_source, model_name)]
+    except Exception as e:
+        logger.error(f"audio_filesテーブルのクエリエラー: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"データベースクエリエラー: {str(e)}")
+    file_results = [file_result for _, file_result in sorted(indexed_results, key=lambda item: item[0])]
     
     # 処理結果を返す
-    execution_time = time.time() - start_time
+    return build_response(
+        request, total_files if total_files is not None else len(file_results), file_results, start_time
+    )
+
+
+def selector_filters(selector: TranscriptionSelector) -> List[Tuple[str, str, object]]:
+    """selectorをaudio_filesの検索条件に変換"""
+    filters = [
+        ('device_id', 'eq', selector.device_id),
+        ('local_date', 'eq', selector.local_date)
+    ]
+    if selector.time_blocks:
+        filters.append(('time_block', 'in', selector.time_blocks))
+    return filters
+
+
+def selector_matches(selector: TranscriptionSelector, audio_file: Dict) -> bool:
+    return (
+        audio_file['device_id'] == selector.device_id
+        and audio_file['local_date'] == selector.local_date
+        and (not selector.time_blocks or audio_file['time_block'] in selector.time_blocks)
+    )
+
+
+@app.post("/fetch-and-transcribe/batch")
+async def fetch_and_transcribe_batch(request: BatchFetchAndTranscribeRequest):
+    """複数のdevice_id/local_dateをまとめて処理するバッチエンドポイント
     
-    # レスポンスの構築（インターフェースによって異なる）
-    if request.device_id and request.local_date:
-        # 新インターフェースのレスポンス
-        return {
-            "status": "success",
-            "summary": {
-                "total_files": len(file_paths),
-                "pending_processed": len(successfully_transcribed),
-                "errors": len(error_files)
-            },
-            "device_id": request.device_id,
-            "local_date": request.local_date,
-            "time_blocks_requested": request.time_blocks,
-            "processed_time_blocks": [f['time_block'] for f in successfully_transcribed],
-            "error_time_blocks": [f['time_block'] for f in error_files] if error_files else None,
-            "execution_time_seconds": round(execution_time, 1),
-            "message": f"{len(file_paths)}件中{len(successfully_transcribed)}件を正常に処理しました"
-        }
-    else:
-        # 既存インターフェースのレスポンス（後方互換性）
+    全selectorの未処理ファイルをまとめたクエリで取得し、1つの処理パイプラインで
+    デバイスをまたいでrecorded_at順に処理する。結果はselectorごとに
+    /fetch-and-transcribe（新インターフェース）と同じ形式で返す。
+    """
+    start_time = time.time()
+    if traffic_recorder:
+        # ファイルへの書き込みでイベントループを止めないよう、スレッドで記録する（到着時刻は受付時に取得）
+        await asyncio.to_thread(traffic_recorder.record, "/fetch-and-transcribe/batch", request.model_dump(exclude_none=True), time.time())
+    model_name = await asyncio.to_thread(check_whisper_model, request.model)
+    
+    selectors = request.selectors
+    logger.info(f"バッチ処理: {len(selectors)}件のselector")
+    
+    # selectorごとのレスポンスは既存のリクエストモデルを使って組み立てる
+    selector_requests = [
+        FetchAndTranscribeRequest(
+            device_id=selector.device_id,
+            local_date=selector.local_date,
+            time_blocks=selector.time_blocks,
+            model=request.model
+        )
+        for selector in selectors
+    ]
+    # file_path -> 担当するselectorの番号（複数のselectorに該当する場合は先頭のselector）
+    selector_of_file: Dict[str, int] = {}
+    
+    def page_iterators() -> List[AsyncIterator[List[Dict]]]:
+        iterators = []
+        for offset in range(0, len(selectors), BATCH_SELECTORS_PER_QUERY):
+            chunk = selectors[offset:offset + BATCH_SELECTORS_PER_QUERY]
+            filters = [
+                ('transcriptions_status', 'eq', 'pending'),
+                any_of_filter([selector_filters(selector) for selector in chunk])
+            ]
+            iterators.append(supabase.select_pages(
+                'audio_files', AUDIO_FILE_COLUMNS, filters, AUDIO_FILE_KEYSET, audio_files_page_size
+            ))
+        return iterators
+    
+    async def file_source() -> AsyncIterator[Dict]:
+        for pages in page_iterators():
+            async for page in pages:
+                logger.info(f"audio_filesテーブルから{len(page)}件のファイルを取得（バッチ）")
+                for audio_file in page:
+                    if audio_file['file_path'] in selector_of_file:
+                        continue
+                    index = next((i for i, selector in enumerate(selectors) if selector_matches(selector, audio_file)), None)
+                    if index is None:
+                        continue
+                    selector_of_file[audio_file['file_path']] = index
+                    yield audio_file
+    
+    def build_batch_response(file_results: List[Dict]) -> Dict:
+        grouped: List[List[Dict]] = [[] for _ in selectors]
+        for file_result in file_results:
+            grouped[selector_of_file[file_result['file_path']]].append(file_result)
+        
+        results = [
+            build_response(selector_request, len(selector_results), selector_results, start_time)
+            if selector_results else build_empty_response(selector_request, start_time)
+            for selector_request, selector_results in zip(selector_requests, grouped)
+        ]
+        processed = sum(result["summary"]["pending_processed"] for result in results)
+        errors = sum(result["summary"]["errors"] for result in results)
+        execution_time = time.time() - start_time
         return {
             "status": "success",
             "summary": {
-                "total_files": len(file_paths),
-                "pending_processed": len(successfully_transcribed),
-                "errors": len(error_files)
+                "selectors": len(selectors),
+                "total_files": len(file_results),
+                "pending_processed": processed,
+                "errors": errors
             },
-            "processed_files": [f['file_path'] for f in successfully_transcribed],
-            "processed_time_blocks": [f['time_block'] for f in successfully_transcribed],
-            "error_files": [f['file_path'] for f in error_files] if error_files else None,
+            "results": results,
             "execution_time_seconds": round(execution_time, 1),
-            "message": f"{len(file_paths)}件中{len(successfully_transcribed)}件を正常に処理しました"
+            "message": f"{len(selectors)}件のselector、{len(file_results)}件中{processed}件を正常に処理しました"
         }
+    
+    if request.stream:
+        return stream_response(request.stream, file_source(), model_name, build_batch_response)
+    
+    try:
+        indexed_results = [item async for item in run_pipeline(file_source(), model_name)]
+    except Exception as e:
+        logger.error(f"audio_filesテーブルのクエリエラー: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"データベースクエリエラー: {str(e)}")
+    file_results = [file_result for _, file_result in sorted(indexed_results, key=lambda item: item[0])]
+    
+    return build_batch_response(file_results)
+
+
+@app.get("/cascade/stats")
+def get_cascade_stats():
+    """カスケード（軽量モデルによる一次判定）の集計"""
+    return get_inference_stats_or_503()["cascade"]
+
+
+@app.get("/gating/stats")
+def get_gating_stats():
+    """無音ゲート（30秒ウィンドウごとのデコード省略）の集計"""
+    return get_inference_stats_or_503()["gating"]
+
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """S3オブジェクトのローカルキャッシュの集計"""
+    return {
+        "enabled": s3_cache is not None,
+        **(s3_cache.snapshot() if s3_cache else {})
+    }
+
+
+@app.get("/prefilter/stats")
+def get_prefilter_stats():
+    """プレフィルター（ダウンロード前のメタデータによる判定）の集計"""
+    return {
+        "enabled": prefilter is not None,
+        "min_seconds": prefilter_config.min_seconds,
+        **(prefilter.stats.snapshot() if prefilter else {})
+    }
+
+
+@app.get("/models")
+def get_models():
+    """読み込み済みのモデル、メモリ予算、読み込み・削除イベントの履歴"""
+    return get_inference_stats_or_503()["models"]
+
+
+@app.get("/noise-profile/stats")
+def get_noise_profile_stats():
+    """デバイスごとのノイズプロファイル（学習件数・判定率・監査での誤判定率・省略した推論時間の推定）"""
+    return get_inference_stats_or_503()["noise_profile"]
+
+
+@app.get("/inference/stats")
+def get_inference_stats():
+    """推論を行うプロセス（サイドカー使用時はサイドカー）のpidと稼働時間"""
+    return {
+        "sidecar": inference_socket or None,
+        **get_inference_stats_or_503()["engine"]
+    }
+
+
+@app.get("/scheduler/stats")
+async def get_scheduler_stats():
+    """スケジューラーの待ち行列と優先度クラスごとの待ち時間（イベントループ上で集計する）"""
+    return scheduler.snapshot()
+
 
 @app.get("/")
 def read_root():
@@ -433,6 +710,7 @@ def read_root():
         "description": "音声文字起こしAPI - Supabase統合版（local_date/time_block対応）",
         "endpoints": {
             "main": "/fetch-and-transcribe",
+            "batch": "/fetch-and-transcribe/batch",
             "docs": "/docs"
         },
         "parameters": {
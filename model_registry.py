@@ -0,0 +1,229 @@
+"""
+Whisperモデルのレジストリ（初回利用時の読み込み + メモリ予算に基づくLRU削除）
+
+モデルは最初に使われた時点で読み込み、実際のパラメータ・バッファのサイズを記録する。
+新しいモデルを読み込むと予算（MODEL_MEMORY_BUDGET_MB）を超える場合は、最後に使ってから
+最も時間が経ったモデルから削除して空きを作る。推論中のモデルと固定（pin）したモデルは
+削除しない。空きを作れない場合は読み込まずにModelBudgetErrorを送出する。
+
+デフォルトの予算はt4g.small（2GB RAM）でbase + tinyまで読み込める値にしている。
+大きなインスタンスでは予算を増やすとsmall / medium等を必要に応じて読み込める。
+
+whisperはModelRegistryを作成した時点で読み込む（ModelBudgetErrorだけを使う推論サイドカーの
+クライアントがtorchを読み込まないようにするため）。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 読み込み前の見積もりに使うパラメータ数（fp32で読み込むため1パラメータ4バイト）
+MODEL_PARAMETERS = {
+    "tiny": 39_000_000,
+    "base": 74_000_000,
+    "small": 244_000_000,
+    "medium": 769_000_000,
+    "turbo": 809_000_000,
+    "large": 1_550_000_000,
+}
+
+# 記録する読み込み・削除イベントの数
+EVENT_HISTORY = 100
+
+MB = 1024 * 1024
+
+
+def estimate_model_bytes(name: str) -> int:
+    """モデル名（tiny.en / large-v3 等を含む）から読み込み後のサイズを見積もる"""
+    base_name = name.split('.')[0].split('-')[0]
+    return MODEL_PARAMETERS[base_name] * 4
+
+
+def measure_model_bytes(model) -> int:
+    """読み込んだモデルのパラメータとバッファの合計バイト数"""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelBudgetError(Exception):
+    """メモリ予算内にモデルを読み込めない場合の例外"""
+
+
+class _Entry:
+    __slots__ = ("model", "size_bytes", "loaded_at", "last_used", "in_use", "pinned", "uses")
+
+    def __init__(self, model, size_bytes: int, pinned: bool):
+        self.model = model
+        self.size_bytes = size_bytes
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.in_use = 0
+        self.pinned = pinned
+        self.uses = 0
+
+
+class ModelRegistry:
+    """Whisperモデルを名前で管理するレジストリ（スレッドセーフ）
+
+    使用例:
+        with registry.use("base") as whisper_model:
+            whisper_model.transcribe(...)
+    """
+
+    def __init__(self, budget_bytes: int, allowed: Optional[Iterable[str]] = None,
+                 loader: Optional[Callable] = None):
+        import whisper
+
+        self.budget_bytes = budget_bytes
+        self.allowed = set(allowed) if allowed else set(whisper.available_models())
+        self._loader = loader or whisper.load_model
+        self._lock = threading.Lock()
+        # 読み込みは時間がかかるため1件ずつ行う（同じモデルの二重読み込みを防ぐ）
+        self._load_lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()  # 最後に使った順（古い順）
+        self._events = deque(maxlen=EVENT_HISTORY)
+
+    @classmethod
+    def from_env(cls) -> "ModelRegistry":
+        allowed = [name.strip() for name in os.getenv('WHISPER_MODELS', '').split(',') if name.strip()]
+        return cls(int(float(os.getenv('MODEL_MEMORY_BUDGET_MB', '600')) * MB), allowed or None)
+
+    def _event(self, event: str, name: str, size_bytes: int, **fields):
+        self._events.append({
+            "event": event,
+            "model": name,
+            "size_mb": round(size_bytes / MB, 1),
+            "at": time.time(),
+            **fields
+        })
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def check(self, name: str) -> None:
+        """リクエストで指定されたモデルを使えるかを読み込まずに確認する
+
+        許可されていないモデルはKeyError、固定済みのモデルと合わせて予算を超える場合はModelBudgetError。
+        """
+        if name not in self.allowed:
+            raise KeyError(name)
+        self._check_budget(name)
+
+    def _check_budget(self, name: str) -> None:
+        with self._lock:
+            if name in self._entries:
+                return
+            reserved = sum(entry.size_bytes for entry in self._entries.values() if entry.pinned)
+        if estimate_model_bytes(name) + reserved > self.budget_bytes:
+            raise ModelBudgetError(
+                f"モデル {name}（約{estimate_model_bytes(name) // MB}MB）はメモリ予算"
+                f"（{self.budget_bytes // MB}MB、固定済み{reserved // MB}MB）に収まりません"
+            )
+
+    def _make_room(self, name: str, needed: int):
+        """（_lockを保持して呼ぶ）neededバイト分の空きができるまでLRUで削除する"""
+        for victim in list(self._entries):
+            if self.used_bytes + needed <= self.budget_bytes:
+                return
+            entry = self._entries[victim]
+            if entry.pinned or entry.in_use:
+                continue
+            del self._entries[victim]
+            logger.info(f"🗑️ モデル{victim}を削除（{entry.size_bytes // MB}MB、{name}の読み込みのため）")
+            self._event("evict", victim, entry.size_bytes, reason=f"load {name}")
+        if self.used_bytes + needed > self.budget_bytes:
+            self._event("reject", name, needed)
+            raise ModelBudgetError(
+                f"モデル {name}（約{needed // MB}MB）を読み込む空きがありません"
+                f"（予算{self.budget_bytes // MB}MB、使用中{self.used_bytes // MB}MB）"
+            )
+
+    def _acquire(self, name: str, pin: bool) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.in_use += 1
+                entry.pinned = entry.pinned or pin
+                return entry
+
+        self._check_budget(name)
+        with self._load_lock:
+            with self._lock:
+                # 待っている間に他のスレッドが読み込んだ場合
+                entry = self._entries.get(name)
+                if entry is not None:
+                    entry.in_use += 1
+                    entry.pinned = entry.pinned or pin
+                    return entry
+                self._make_room(name, estimate_model_bytes(name))
+
+            started = time.time()
+            logger.info(f"Whisper {name}モデルを読み込み中...")
+            model = self._loader(name)
+            size_bytes = measure_model_bytes(model)
+            load_seconds = time.time() - started
+
+            with self._lock:
+                entry = _Entry(model, size_bytes, pin)
+                entry.in_use = 1
+                self._entries[name] = entry
+                self._event("load", name, size_bytes, seconds=round(load_seconds, 2))
+                try:
+                    # 実際のサイズが見積もりより大きかった場合は、他のモデルを削除して予算内に戻す
+                    self._make_room(name, 0)
+                except ModelBudgetError:
+                    logger.warning(f"⚠️ モデル{name}の読み込み後、使用量が予算を超えています（{self.used_bytes // MB}MB）")
+            logger.info(f"Whisper {name}モデル読み込み完了（{size_bytes // MB}MB、{load_seconds:.1f}秒）")
+            return entry
+
+    def _release(self, name: str, entry: _Entry):
+        with self._lock:
+            entry.in_use -= 1
+            entry.uses += 1
+            entry.last_used = time.time()
+            if self._entries.get(name) is entry:
+                self._entries.move_to_end(name)
+
+    @contextmanager
+    def use(self, name: str):
+        """モデルを（必要なら読み込んで）取得し、ブロックを抜けるまで削除されないようにする"""
+        entry = self._acquire(name, pin=False)
+        try:
+            yield entry.model
+        finally:
+            self._release(name, entry)
+
+    def get(self, name: str, pin: bool = False):
+        """モデルを取得する（pin=Trueの場合は以後削除しない。起動時の読み込み用）"""
+        entry = self._acquire(name, pin)
+        self._release(name, entry)
+        return entry.model
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            resident: List[Dict] = [
+                {
+                    "model": name,
+                    "size_mb": round(entry.size_bytes / MB, 1),
+                    "pinned": entry.pinned,
+                    "in_use": entry.in_use,
+                    "uses": entry.uses,
+                    "loaded_at": entry.loaded_at,
+                    "last_used": entry.last_used,
+                }
+                for name, entry in reversed(self._entries.items())
+            ]
+            return {
+                "budget_mb": round(self.budget_bytes / MB, 1),
+                "used_mb": round(self.used_bytes / MB, 1),
+                "allowed": sorted(self.allowed),
+                "resident": resident,
+                "events": list(self._events),
+            }
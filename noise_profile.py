@@ -0,0 +1,292 @@
+"""
+デバイスごとの環境ノイズのプロファイル（ノイズフロアの学習）
+
+無音判定は全デバイス共通の閾値（transcription.SILENCE_THRESHOLD）で行うため、マイクの感度や
+設置環境の違いにより、発話のない騒がしい部屋のブロックは必ずWhisperに送られ、空文字や
+ハルシネーションとして戻ってくる。このモジュールは、Whisperが空の結果を返したブロックから
+デバイスごとにノイズの特徴量の指数移動平均・分散を学習し、新しいブロックがそのデバイスの
+ノイズの範囲内であれば推論の前に発話なしと判定する。
+
+特徴量（16kHzモノラルの配列から25msフレーム単位で計算）:
+- floor: フレームRMS（log10）の中央値（ノイズフロア）
+- peak: フレームRMS（log10）の95パーセンタイル（発話があると上がる）
+- speech_band: 300〜3400Hzのパワーの割合（発話があると上がる）
+- flatness: スペクトル平坦度の平均（発話があると下がる）
+
+判定: 学習済みのブロックがNOISE_PROFILE_MIN_SAMPLES件以上あり、floorがプロファイルの
+±NOISE_PROFILE_Z標準偏差以内、かつpeak / speech_band / flatnessが発話の方向に
+NOISE_PROFILE_Z標準偏差を超えていない場合に発話なしとする。
+
+発話なしと判定したブロックのうちNOISE_PROFILE_AUDIT_RATEの割合はWhisperでも処理し（監査）、
+テキストが得られた割合（誤判定率）がNOISE_PROFILE_MAX_MISS_RATEを超えたデバイスは判定を停止する。
+プロファイルはNOISE_PROFILE_PATHのJSONファイルに保存し、再起動後も引き継ぐ。
+"""
+
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 400  # 25ms
+SPEECH_BAND_HZ = (300, 3400)
+
+# 特徴量 -> 発話があると変化する方向（+1: 上がる、-1: 下がる、0: どちらにも外れない）
+FEATURE_DIRECTIONS = {
+    "floor": 0,
+    "peak": 1,
+    "speech_band": 1,
+    "flatness": -1,
+}
+# 標準偏差の下限（同じような無音が続いて分散が0に近づいても、わずかな差で外れないようにする）
+MIN_STD = {
+    "floor": 0.05,
+    "peak": 0.05,
+    "speech_band": 0.02,
+    "flatness": 0.02,
+}
+
+
+class NoiseProfileConfig:
+    """ノイズプロファイルの設定"""
+
+    def __init__(self, path: Optional[str] = None, min_samples: int = 20, z: float = 3.0, half_life: float = 200.0,
+                 audit_rate: float = 0.05, max_miss_rate: float = 0.1, min_audits: int = 10,
+                 save_interval_seconds: float = 30.0):
+        self.path = path
+        self.min_samples = min_samples
+        self.z = z
+        self.half_life = half_life
+        self.audit_rate = audit_rate
+        self.max_miss_rate = max_miss_rate
+        self.min_audits = min_audits
+        self.save_interval_seconds = save_interval_seconds
+
+    @classmethod
+    def from_env(cls) -> "NoiseProfileConfig":
+        return cls(
+            path=os.getenv('NOISE_PROFILE_PATH') or None,
+            min_samples=int(os.getenv('NOISE_PROFILE_MIN_SAMPLES', '20')),
+            z=float(os.getenv('NOISE_PROFILE_Z', '3.0')),
+            half_life=float(os.getenv('NOISE_PROFILE_HALF_LIFE', '200')),
+            audit_rate=float(os.getenv('NOISE_PROFILE_AUDIT_RATE', '0.05')),
+            max_miss_rate=float(os.getenv('NOISE_PROFILE_MAX_MISS_RATE', '0.1')),
+            min_audits=int(os.getenv('NOISE_PROFILE_MIN_AUDITS', '10')),
+            save_interval_seconds=float(os.getenv('NOISE_PROFILE_SAVE_INTERVAL_SECONDS', '30')),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    @property
+    def alpha(self) -> float:
+        """指数移動平均の重み（half_life件前のブロックの重みが半分になる）"""
+        return 1 - 0.5 ** (1 / self.half_life)
+
+
+def extract_features(audio: np.ndarray) -> Optional[Dict[str, float]]:
+    """16kHzモノラルの配列からノイズの特徴量を計算する（1フレームに満たない場合はNone）"""
+    frames = len(audio) // FRAME_SAMPLES
+    if frames == 0:
+        return None
+    framed = audio[:frames * FRAME_SAMPLES].reshape(frames, FRAME_SAMPLES).astype(np.float32)
+    log_rms = np.log10(np.sqrt(np.mean(framed ** 2, axis=1)) + 1e-10)
+
+    power = np.abs(np.fft.rfft(framed * np.hanning(FRAME_SAMPLES).astype(np.float32), axis=1)) ** 2 + 1e-20
+    freqs = np.fft.rfftfreq(FRAME_SAMPLES, 1 / SAMPLE_RATE)
+    power = power[:, freqs >= 50]  # 直流成分と低周波のハムを除く
+    freqs = freqs[freqs >= 50]
+    band = (freqs >= SPEECH_BAND_HZ[0]) & (freqs <= SPEECH_BAND_HZ[1])
+    mean_power = power.mean(axis=0)
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+
+    return {
+        "floor": float(np.median(log_rms)),
+        "peak": float(np.percentile(log_rms, 95)),
+        "speech_band": float(mean_power[band].sum() / mean_power.sum()),
+        "flatness": float(np.mean(flatness)),
+    }
+
+
+class DeviceProfile:
+    """1デバイス分のプロファイル（特徴量ごとの指数移動平均・分散）と判定の集計"""
+
+    def __init__(self, samples: int = 0, mean: Optional[Dict[str, float]] = None, var: Optional[Dict[str, float]] = None):
+        self.samples = samples
+        self.mean = mean or {}
+        self.var = var or {}
+        # 集計（プロセスの起動ごとにリセット）
+        self.blocks = 0
+        self.hits = 0
+        self.audited = 0
+        self.audit_misses = 0
+        self.whisper_blocks = 0
+        self.whisper_seconds = 0.0
+
+    def update(self, features: Dict[str, float], alpha: float):
+        # 学習の初期は単純平均と同じ重みにし、件数が増えたら指数移動平均にする
+        weight = max(alpha, 1 / (self.samples + 1))
+        for name, value in features.items():
+            if name not in self.mean:
+                self.mean[name] = value
+                self.var[name] = 0.0
+                continue
+            delta = value - self.mean[name]
+            self.mean[name] += weight * delta
+            self.var[name] = (1 - weight) * (self.var[name] + weight * delta ** 2)
+        self.samples += 1
+
+    def matches(self, features: Dict[str, float], z: float) -> bool:
+        """特徴量がすべてこのデバイスのノイズの範囲内か"""
+        for name, direction in FEATURE_DIRECTIONS.items():
+            if name not in self.mean:
+                return False
+            score = (features[name] - self.mean[name]) / max(math.sqrt(self.var[name]), MIN_STD[name])
+            if (direction == 0 and abs(score) > z) or (direction != 0 and score * direction > z):
+                return False
+        return True
+
+    @property
+    def miss_rate(self) -> Optional[float]:
+        return self.audit_misses / self.audited if self.audited else None
+
+    def to_json(self) -> Dict:
+        return {"samples": self.samples, "mean": self.mean, "var": self.var}
+
+    def snapshot(self, config: NoiseProfileConfig) -> Dict:
+        avg_whisper_seconds = self.whisper_seconds / self.whisper_blocks if self.whisper_blocks else None
+        return {
+            "samples": self.samples,
+            "ready": self.samples >= config.min_samples,
+            "suspended": suspended(self, config),
+            "blocks": self.blocks,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.blocks, 3) if self.blocks else None,
+            "audited": self.audited,
+            "audit_misses": self.audit_misses,
+            "miss_rate": round(self.miss_rate, 3) if self.miss_rate is not None else None,
+            "avg_whisper_seconds": round(avg_whisper_seconds, 3) if avg_whisper_seconds is not None else None,
+            # 監査でWhisperに送ったブロックは省略していないため除く
+            "estimated_saved_seconds": round((self.hits - self.audited) * avg_whisper_seconds, 1)
+            if avg_whisper_seconds is not None else None,
+            "profile": {
+                name: {"mean": round(self.mean[name], 4), "std": round(math.sqrt(self.var[name]), 4)}
+                for name in self.mean
+            },
+        }
+
+
+def suspended(profile: DeviceProfile, config: NoiseProfileConfig) -> bool:
+    """監査での誤判定が多いデバイスは判定を停止する"""
+    return profile.audited >= config.min_audits and profile.miss_rate > config.max_miss_rate
+
+
+class NoiseProfiles:
+    """デバイスごとのノイズプロファイル（スレッドセーフ）
+
+    使用例:
+        decision = profiles.classify(device_id, features)
+        if decision == "skip": ...                    # Whisperを使わずに空の結果とする
+        analysis = transcribe_audio(...)
+        profiles.observe(device_id, features, analysis, transcribe_seconds, audited=decision == "audit")
+    """
+
+    def __init__(self, config: NoiseProfileConfig, rng: Optional[random.Random] = None):
+        self.config = config
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, DeviceProfile] = {}
+        # 監査の抽選に使う乱数（テストではシードを固定したものを渡す）
+        self._random = rng or random.Random()
+        self._dirty = False
+        self._saved_at = time.time()
+        self._load()
+
+    def _load(self):
+        if not self.config.path or not os.path.exists(self.config.path):
+            return
+        try:
+            with open(self.config.path, encoding='utf-8') as f:
+                data = json.load(f)
+            for device_id, entry in data.get("devices", {}).items():
+                self._profiles[device_id] = DeviceProfile(entry["samples"], entry["mean"], entry["var"])
+            logger.info(f"ノイズプロファイル読み込み: {len(self._profiles)}デバイス（{self.config.path}）")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ ノイズプロファイルを読み込めません（新規に学習します）: {str(e)}")
+
+    def save(self):
+        """プロファイルをJSONファイルに書き込む（一時ファイルに書いてから置き換える）"""
+        with self._lock:
+            data = {"devices": {device_id: profile.to_json() for device_id, profile in self._profiles.items()}}
+            self._dirty = False
+            self._saved_at = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(self.config.path)), exist_ok=True)
+        tmp_path = f'{self.config.path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.config.path)
+
+    def _profile(self, device_id: str) -> DeviceProfile:
+        profile = self._profiles.get(device_id)
+        if profile is None:
+            profile = self._profiles[device_id] = DeviceProfile()
+        return profile
+
+    def classify(self, device_id: str, features: Dict[str, float]) -> Optional[str]:
+        """発話なしと判定した場合は"skip"（監査の対象にした場合は"audit"）、それ以外はNone"""
+        with self._lock:
+            profile = self._profile(device_id)
+            profile.blocks += 1
+            if profile.samples < self.config.min_samples or suspended(profile, self.config):
+                return None
+            if not profile.matches(features, self.config.z):
+                return None
+            profile.hits += 1
+            if self._random.random() < self.config.audit_rate:
+                profile.audited += 1
+                return "audit"
+            return "skip"
+
+    def observe(self, device_id: str, features: Dict[str, float], analysis: Dict, transcribe_seconds: float,
+                audited: bool = False):
+        """Whisperの結果を記録し、空の結果であればプロファイルを更新する"""
+        empty = not analysis["transcription"]
+        with self._lock:
+            profile = self._profile(device_id)
+            profile.whisper_blocks += 1
+            profile.whisper_seconds += transcribe_seconds
+            if audited and not empty:
+                profile.audit_misses += 1
+                logger.warning(f"⚠️ ノイズプロファイルの誤判定（監査）: device={device_id}")
+            if empty:
+                profile.update(features, self.config.alpha)
+                self._dirty = True
+            save = self._dirty and time.time() - self._saved_at >= self.config.save_interval_seconds
+        if save:
+            self.save()
+
+    def close(self):
+        if self._dirty:
+            self.save()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            devices = {device_id: profile.snapshot(self.config) for device_id, profile in self._profiles.items()}
+        blocks = sum(device["blocks"] for device in devices.values())
+        hits = sum(device["hits"] for device in devices.values())
+        return {
+            "devices_ready": sum(1 for device in devices.values() if device["ready"]),
+            "blocks": blocks,
+            "hits": hits,
+            "hit_rate": round(hits / blocks, 3) if blocks else None,
+            "estimated_saved_seconds": round(sum(device["estimated_saved_seconds"] or 0.0 for device in devices.values()), 1),
+            "devices": devices,
+        }
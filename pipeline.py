@@ -0,0 +1,124 @@
+"""
+APIサーバー（main.py）とバックフィル（backfill.py）で共有する処理
+
+- 環境変数からのS3クライアントの作成
+- audio_filesの検索に使う列とkeyset
+- S3のキー（file_path）からのdevice_id / local_date / time_blockの抽出
+- 文字起こし結果のvibe_whisperへの保存とaudio_filesのステータス更新（複数件をまとめて書き込む）
+"""
+
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import boto3
+from botocore.config import Config
+
+from aio_clients import AsyncPostgrestClient
+
+logger = logging.getLogger(__name__)
+
+# audio_filesから取得する列
+AUDIO_FILE_COLUMNS = 'file_path, device_id, local_date, time_block, recorded_at'
+# keysetページネーションの並び順（recorded_at順、同時刻はfile_pathで一意に並べる）
+AUDIO_FILE_KEYSET = ('recorded_at', 'file_path')
+
+
+def create_s3_client_from_env():
+    """環境変数からboto3のS3クライアントを作成する（署名付きURLの生成に使用）"""
+    aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
+    aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+    # ローカルのS3互換サーバー（standins.py等）を使う場合のみ指定
+    s3_endpoint_url = os.getenv('S3_ENDPOINT_URL')
+
+    if not aws_access_key_id or not aws_secret_access_key:
+        raise ValueError("AWS_ACCESS_KEY_IDおよびAWS_SECRET_ACCESS_KEYが設定されていません")
+
+    return boto3.client(
+        's3',
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        region_name=os.getenv('AWS_REGION', 'us-east-1'),
+        endpoint_url=s3_endpoint_url,
+        config=Config(s3={'addressing_style': 'path'}) if s3_endpoint_url else None
+    )
+
+
+def parse_file_path(file_path: str) -> Optional[Dict]:
+    """S3のキーから処理対象ファイルの情報を抽出する（形式が異なる場合はNone）
+
+    例: files/d067d407-cf73-4174-a9c1-d91fb60d64d0/2025-07-19/14-30/audio.wav
+    """
+    parts = file_path.split('/')
+    if len(parts) < 5:
+        return None
+    return {
+        'file_path': file_path,
+        'device_id': parts[1],  # d067d407-cf73-4174-a9c1-d91fb60d64d0
+        'local_date': parts[2],  # 2025-07-19
+        'time_block': parts[3]  # 14-30
+    }
+
+
+def transcription_row(audio_file: Dict, transcription: str) -> Dict:
+    """vibe_whisperテーブルの1行を作成（空の文字起こし結果も保存する）"""
+    return {
+        "device_id": audio_file['device_id'],
+        "date": audio_file['local_date'],  # リクエストから受け取った日付をそのまま使用
+        "time_block": audio_file['time_block'],
+        "transcription": transcription if transcription else ""
+    }
+
+
+async def save_transcriptions(supabase: AsyncPostgrestClient, results: Sequence[Tuple[Dict, str]]) -> List[str]:
+    """(audio_file, 文字起こし結果) のリストをvibe_whisperへまとめて保存し、
+    audio_filesのステータスをcompletedに更新する
+
+    upsertに失敗した場合は例外を送出する。ステータス更新の失敗はログのみ。
+    戻り値: ステータスを更新したfile_pathのリスト
+    """
+    # 同じ行（device_id, date, time_block）が1回のupsertに複数含まれるとエラーになるため、後のものを残す
+    rows = {}
+    for audio_file, transcription in results:
+        row = transcription_row(audio_file, transcription)
+        rows[(row['device_id'], row['date'], row['time_block'])] = row
+
+    # upsert（既存データは更新、新規データは挿入）
+    response_data = await supabase.upsert('vibe_whisper', list(rows.values()))
+
+    # ■■■ START: 詳細なデバッグログを追加 ■■■
+    # Supabaseからの応答を詳細にログ出力
+    logger.info(f"Supabase upsert response data: {response_data}")
+    logger.info(f"Supabase upsert response count: {len(response_data)}")
+
+    # 応答にエラーが含まれていないか、データが空でないかを確認
+    if not response_data:
+        logger.error("❌ Supabase returned an empty response or an error.")
+        logger.error(f"   - Full response object: {response_data}")
+        # エラーとして扱い、処理を中断
+        raise Exception("Supabase upsert failed with empty response.")
+    # ■■■ END: 詳細なデバッグログを追加 ■■■
+
+    # audio_filesテーブルのtranscriptions_statusをcompletedに更新
+    # file_pathで直接更新する（シンプルで正確）
+    file_paths = [audio_file['file_path'] for audio_file, _ in results]
+    try:
+        updated_rows = await supabase.update(
+            'audio_files',
+            {'transcriptions_status': 'completed'},
+            [('file_path', 'in', file_paths) if len(file_paths) > 1 else ('file_path', 'eq', file_paths[0])]
+        )
+
+        # 更新が成功したかチェック
+        if updated_rows:
+            logger.info(f"✅ audio_filesテーブルのステータス更新成功: {len(updated_rows)}件更新")
+            logger.info(f"   file_path: {', '.join(file_paths)}")
+        else:
+            logger.warning("⚠️ audio_filesテーブルのステータス更新: 対象レコードが見つかりません")
+            logger.warning(f"   file_path: {', '.join(file_paths)}")
+        return [row['file_path'] for row in updated_rows if 'file_path' in row]
+
+    except Exception as update_error:
+        logger.error(f"❌ audio_filesテーブルのステータス更新エラー: {str(update_error)}")
+        logger.error(f"   file_path: {', '.join(file_paths)}")
+        return []
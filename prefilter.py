@@ -0,0 +1,210 @@
+"""
+ダウンロード前のメタデータによる事前判定（プレフィルター）
+
+一部のデバイスは、空のファイル・ヘッダーだけのWAV・数百ミリ秒しかない録音を大量に
+アップロードする。これらも従来は全体をダウンロードしてから無音と判定していた。
+PREFILTER_MIN_SECONDSを指定すると、ダウンロードの前に次の順で判定し、該当するファイルは
+ダウンロードせずに空の文字起こし結果として確定させる。
+
+1. サイズ（ListObjectsV2でdevice_id / local_dateのプレフィックスごとに一括取得）:
+   0バイト（empty）、WAVヘッダー以下のサイズ（header_only）
+2. ヘッダー（先頭HEADER_BYTESバイトのRange取得。最高ビットレートでもPREFILTER_MIN_SECONDSに
+   満たないサイズのオブジェクトのみ）: WAV / FLACのヘッダーから求めた長さが
+   PREFILTER_MIN_SECONDS未満（too_short）
+
+無音の判定は行わない。ファイルの一部の標本では標本の間の発話を見落とすため、無音かどうかは
+ダウンロード後に16kHzモノラルに変換した音声全体で判定する（transcription.transcribe_audio）。
+
+一覧は PREFILTER_LIST_TTL_SECONDS の間再利用する。一覧にないキー（一覧の取得後にアップロードされた
+ファイル等）は判定せずに通常通り処理する。一覧の取得に失敗した場合（s3:ListBucketの権限がない等）も
+失敗をTTLの間記録しておき、そのプレフィックスのファイルは一覧を取り直さずに通常通り処理する。
+"""
+
+import asyncio
+import logging
+import os
+import struct
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from aio_clients import AsyncS3Client
+
+logger = logging.getLogger(__name__)
+
+# ヘッダーの判定に取得する先頭のバイト数
+HEADER_BYTES = 4096
+# RIFF / fmt / dataチャンクだけの標準的なWAVヘッダーのサイズ
+WAV_HEADER_BYTES = 44
+# 長さの判定に使う最大のビットレート（48kHz / ステレオ / 16bit = 192000バイト/秒）
+MAX_BYTES_PER_SECOND = 192000
+
+
+class PrefilterConfig:
+    """プレフィルターの設定"""
+
+    def __init__(self, min_seconds: Optional[float] = None, list_ttl_seconds: float = 60.0):
+        self.min_seconds = min_seconds
+        self.list_ttl_seconds = list_ttl_seconds
+
+    @classmethod
+    def from_env(cls) -> "PrefilterConfig":
+        return cls(
+            min_seconds=float(os.environ['PREFILTER_MIN_SECONDS']) if os.getenv('PREFILTER_MIN_SECONDS') else None,
+            list_ttl_seconds=float(os.getenv('PREFILTER_LIST_TTL_SECONDS', '60')),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_seconds is not None
+
+
+class AudioHeader:
+    """ヘッダーから読み取った音声の情報"""
+    __slots__ = ("duration",)
+
+    def __init__(self, duration: Optional[float]):
+        self.duration = duration
+
+
+def parse_wav_header(header: bytes, total_size: int) -> Optional[AudioHeader]:
+    """WAVのfmt / dataチャンクから長さを読み取る（WAVでない・不完全な場合はNone）"""
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    position = 12
+    fmt = None
+    while position + 8 <= len(header):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', header, position)
+        if chunk_id == b'fmt ' and position + 24 <= len(header):
+            fmt = struct.unpack_from('<HHIIHH', header, position + 8)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            byte_rate = fmt[3]
+            data_offset = position + 8
+            # 録音中に書き出したWAVはdataのサイズが0や最大値のことがあるため、オブジェクトのサイズで補う
+            data_size = total_size - data_offset if chunk_size in (0, 0xFFFFFFFF) else min(chunk_size, total_size - data_offset)
+            duration = max(data_size, 0) / byte_rate if byte_rate else None
+            return AudioHeader(duration)
+        position += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def parse_flac_header(header: bytes) -> Optional[AudioHeader]:
+    """FLACのSTREAMINFOから長さを読み取る（総サンプル数が不明な場合はNone）"""
+    if header[:4] != b'fLaC' or len(header) < 8 + 18 or header[4] & 0x7F != 0:
+        return None
+    packed = int.from_bytes(header[8 + 10:8 + 18], 'big')
+    sample_rate = packed >> 44
+    total_samples = packed & ((1 << 36) - 1)
+    if not sample_rate or not total_samples:
+        return None
+    return AudioHeader(total_samples / sample_rate)
+
+
+class PrefilterStats:
+    """プレフィルターの集計（判定した件数・確定した理由ごとの件数・省略した転送量）"""
+
+    def __init__(self):
+        self.checked = 0
+        self.resolved = Counter()
+        self.list_requests = 0
+        self.list_errors = 0
+        self.range_requests = 0
+        self.range_bytes = 0
+        self.bytes_skipped = 0
+
+    def snapshot(self) -> Dict:
+        resolved = sum(self.resolved.values())
+        return {
+            "checked": self.checked,
+            "resolved": resolved,
+            "resolved_by_reason": dict(self.resolved),
+            "resolved_ratio": round(resolved / self.checked, 3) if self.checked else None,
+            "list_requests": self.list_requests,
+            "list_errors": self.list_errors,
+            "range_requests": self.range_requests,
+            "range_bytes": self.range_bytes,
+            "bytes_skipped": self.bytes_skipped,
+        }
+
+
+class Prefilter:
+    """ダウンロードせずに空の文字起こし結果として確定できるファイルを判定する"""
+
+    def __init__(self, s3: AsyncS3Client, config: PrefilterConfig):
+        self.s3 = s3
+        self.config = config
+        self.stats = PrefilterStats()
+        # prefix -> (取得時刻, key -> size)。取得に失敗した一覧はNone
+        self._listings: Dict[str, Tuple[float, Optional[Dict[str, int]]]] = {}
+        self._listing_locks: Dict[str, asyncio.Lock] = {}
+
+    async def _object_size(self, key: str) -> Optional[int]:
+        """キーのサイズを、同じプレフィックス（files/<device>/<date>/）の一覧から取得する"""
+        prefix = '/'.join(key.split('/')[:3]) + '/'
+        lock = self._listing_locks.setdefault(prefix, asyncio.Lock())
+        # 同時に届いた同じプレフィックスのファイルは1回の一覧取得を待ち合わせる
+        async with lock:
+            cached = self._listings.get(prefix)
+            if cached is None or time.time() - cached[0] > self.config.list_ttl_seconds:
+                self.stats.list_requests += 1
+                try:
+                    sizes = await self.s3.list_objects(prefix)
+                except Exception as e:
+                    # ファイルごとに失敗する一覧取得を繰り返さないよう、失敗もTTLの間は再利用する
+                    self.stats.list_errors += 1
+                    logger.warning(f"⚠️ プレフィルター: {prefix} の一覧を取得できません"
+                                   f"（{self.config.list_ttl_seconds:g}秒間は判定せずに通常通り処理）: {str(e)}")
+                    sizes = None
+                cached = (time.time(), sizes)
+                self._listings[prefix] = cached
+                # 期限切れの一覧を削除する
+                for stale in [p for p, (at, _) in self._listings.items() if time.time() - at > self.config.list_ttl_seconds]:
+                    del self._listings[stale]
+                    self._listing_locks.pop(stale, None)
+        return cached[1].get(key) if cached[1] is not None else None
+
+    async def _read_range(self, key: str, start: int, end: int) -> bytes:
+        self.stats.range_requests += 1
+        data = await self.s3.read_range(key, start, end)
+        self.stats.range_bytes += len(data)
+        return data
+
+    async def check(self, key: str) -> Optional[str]:
+        """ダウンロードせずに確定できる場合はその理由（empty / header_only / too_short）を返す
+
+        判定に失敗した場合（一覧やRange取得のエラー等）はNoneを返し、通常通り処理させる。
+        """
+        self.stats.checked += 1
+        try:
+            reason, size = await self._check(key)
+        except Exception as e:
+            logger.warning(f"⚠️ プレフィルターの判定に失敗（通常通り処理）: {key}: {str(e)}")
+            return None
+        if reason:
+            self.stats.resolved[reason] += 1
+            self.stats.bytes_skipped += size
+            logger.info(f"⏭️ プレフィルター: {key} をダウンロードせずに確定（{reason}、{size}バイト）")
+        return reason
+
+    async def _check(self, key: str) -> Tuple[Optional[str], int]:
+        size = await self._object_size(key)
+        if size is None:
+            return None, 0
+        if size == 0:
+            return "empty", size
+        if key.lower().endswith('.wav') and size <= WAV_HEADER_BYTES:
+            return "header_only", size
+
+        # 最高のビットレートでもPREFILTER_MIN_SECONDS以上の長さになるサイズなら、ヘッダーは読まない
+        if size >= self.config.min_seconds * MAX_BYTES_PER_SECOND:
+            return None, size
+
+        head = await self._read_range(key, 0, min(size, HEADER_BYTES) - 1)
+        header = parse_wav_header(head, size) or parse_flac_header(head)
+        if header is None:
+            return None, size
+        if header.duration is not None and header.duration < self.config.min_seconds:
+            return ("header_only" if header.duration == 0 else "too_short"), size
+        return None, size
@@ -0,0 +1,237 @@
+"""
+推論の実行順を決めるスケジューラー（デバイス間の公平性 + 締め切り）
+
+同時に届いた複数のリクエストのファイルを、推論（Whisper）の直前で待ち合わせ、
+次に推論するファイルを以下の順で選ぶ。
+
+1. 優先度クラス: recorded_atから締め切り（SCHEDULER_DEADLINE_MINUTES）以内の
+   ブロックは "realtime"、それより古いブロックは "backfill"。realtimeが待っている間は
+   backfillを実行しない（backfillは空いている推論枠を埋める）
+2. デバイス間の公平性: 同じクラスの中では、これまでに推論枠を割り当てた回数が
+   最も少ないデバイスを選ぶ（仮想時刻による公平キューイング）。しばらく待ちのなかった
+   デバイスが戻ってきても、過去の未使用分をまとめて使うことはできない
+3. 締め切り順: 同じデバイスの中では締め切りが近い（recorded_atが古い）ものから選ぶ
+
+ダウンロードや保存はスケジューラーを通さずに並行して進む。
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+# 優先度クラス（先頭ほど優先）
+PRIORITY_CLASSES = ("realtime", "backfill")
+
+# 待ち時間のパーセンタイル計算に使う直近のサンプル数
+WAIT_SAMPLES = 1000
+
+
+def parse_recorded_at(value) -> Optional[datetime]:
+    """audio_files.recorded_at（ISO 8601）をタイムゾーン付きのdatetimeに変換（タイムゾーンなしはUTCとみなす）"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class SchedulerConfig:
+    """スケジューラーの設定"""
+
+    def __init__(self, deadline_minutes: float = 60.0, concurrency: int = 1):
+        self.deadline_minutes = deadline_minutes
+        self.concurrency = concurrency
+
+    @classmethod
+    def from_env(cls) -> "SchedulerConfig":
+        return cls(
+            deadline_minutes=float(os.getenv('SCHEDULER_DEADLINE_MINUTES', '60')),
+            concurrency=int(os.getenv('SCHEDULER_CONCURRENCY', '1')),
+        )
+
+
+class _Job:
+    __slots__ = ("device_id", "priority", "deadline", "enqueued_at", "future")
+
+    def __init__(self, device_id: str, priority: str, deadline: float, future: asyncio.Future):
+        self.device_id = device_id
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.future = future
+
+
+class _FairQueue:
+    """1つの優先度クラス内のデバイス別キュー（仮想時刻による公平キューイング）"""
+
+    def __init__(self):
+        self.jobs: Dict[str, List] = {}  # device_id -> [(deadline, seq, job)] のヒープ
+        self.virtual_time: Dict[str, float] = defaultdict(float)  # デバイスごとの割り当て済み仮想時刻
+        self.clock = 0.0  # 最後に割り当てたデバイスの仮想時刻
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return sum(len(heap) for heap in self.jobs.values())
+
+    def push(self, job: _Job):
+        heap = self.jobs.get(job.device_id)
+        if heap is None:
+            # 待ちのなかったデバイスは現在の仮想時刻から再開する（過去の未使用分は持ち越さない）
+            heap = self.jobs[job.device_id] = []
+            self.virtual_time[job.device_id] = max(self.virtual_time[job.device_id], self.clock)
+        heapq.heappush(heap, (job.deadline, next(self._seq), job))
+
+    def remove(self, job: _Job):
+        heap = self.jobs.get(job.device_id)
+        if heap is None:
+            return
+        remaining = [entry for entry in heap if entry[2] is not job]
+        heapq.heapify(remaining)
+        if remaining:
+            self.jobs[job.device_id] = remaining
+        else:
+            del self.jobs[job.device_id]
+
+    def pop(self) -> Optional[_Job]:
+        if not self.jobs:
+            return None
+        # 仮想時刻が最も小さいデバイス（同じ場合は締め切りが近い方）から1件取り出す
+        device_id = min(self.jobs, key=lambda d: (self.virtual_time[d], self.jobs[d][0][0]))
+        heap = self.jobs[device_id]
+        _, _, job = heapq.heappop(heap)
+        if not heap:
+            del self.jobs[device_id]
+        self.clock = self.virtual_time[device_id]
+        self.virtual_time[device_id] += 1
+        return job
+
+
+class _WaitStats:
+    """優先度クラスごとの待ち時間の集計"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.deadline_missed = 0  # realtimeのうち推論開始時点で締め切りを過ぎていた件数
+        self.samples = deque(maxlen=WAIT_SAMPLES)
+
+    def record(self, wait_seconds: float, missed: bool):
+        self.count += 1
+        self.total_seconds += wait_seconds
+        self.max_seconds = max(self.max_seconds, wait_seconds)
+        self.deadline_missed += int(missed)
+        self.samples.append(wait_seconds)
+
+    def snapshot(self) -> Dict:
+        ordered = sorted(self.samples)
+
+        def percentile(p: float):
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 3) if ordered else None
+
+        return {
+            "scheduled": self.count,
+            "avg_wait_seconds": round(self.total_seconds / self.count, 3) if self.count else None,
+            "p50_wait_seconds": percentile(0.5),
+            "p95_wait_seconds": percentile(0.95),
+            "max_wait_seconds": round(self.max_seconds, 3),
+            "deadline_missed": self.deadline_missed,
+        }
+
+
+class TranscriptionScheduler:
+    """推論枠（同時に実行できる推論の数）をファイルに割り当てるスケジューラー
+
+    使用例:
+        async with scheduler.slot(audio_file) as ticket:
+            await asyncio.to_thread(transcribe_audio, ...)
+        ticket["priority"], ticket["queue_wait_seconds"]
+    """
+
+    def __init__(self, config: Optional[SchedulerConfig] = None):
+        self.config = config or SchedulerConfig.from_env()
+        self._queues = {priority: _FairQueue() for priority in PRIORITY_CLASSES}
+        self._running = 0
+        # 待ち行列と統計はイベントループ上でのみ読み書きする（snapshotもイベントループ上で呼ぶ）
+        self._wait_stats = {priority: _WaitStats() for priority in PRIORITY_CLASSES}
+        self._device_counts = defaultdict(lambda: defaultdict(int))
+
+    def classify(self, audio_file: Dict, now: Optional[datetime] = None) -> Tuple[str, float]:
+        """(優先度クラス, 締め切りのUNIX時刻) を返す
+
+        recorded_atがない場合（file_pathsインターフェースで行が見つからなかった等）は
+        受け付けた時刻に録音されたものとみなす。
+        """
+        now = now or datetime.now(timezone.utc)
+        recorded_at = parse_recorded_at(audio_file.get('recorded_at')) or now
+        deadline = recorded_at + timedelta(minutes=self.config.deadline_minutes)
+        priority = "realtime" if deadline > now else "backfill"
+        return priority, deadline.timestamp()
+
+    def _dispatch(self):
+        while self._running < self.config.concurrency:
+            job = next((queue.pop() for queue in self._queues.values() if len(queue)), None)
+            if job is None:
+                return
+            if job.future.done():
+                continue
+            self._running += 1
+            job.future.set_result(None)
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, audio_file: Dict):
+        priority, deadline = self.classify(audio_file)
+        job = _Job(audio_file.get('device_id', ''), priority, deadline, asyncio.get_running_loop().create_future())
+        ticket = {"priority": priority, "queue_wait_seconds": None}
+
+        self._queues[priority].push(job)
+        self._dispatch()
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            # 待機中に取り消された場合はキューから外す（割り当て直後に取り消された場合は枠を返す）
+            if job.future.done() and not job.future.cancelled():
+                self._release()
+            else:
+                self._queues[priority].remove(job)
+            raise
+
+        wait_seconds = time.monotonic() - job.enqueued_at
+        ticket["queue_wait_seconds"] = round(wait_seconds, 3)
+        self._wait_stats[priority].record(wait_seconds, priority == "realtime" and time.time() > deadline)
+        self._device_counts[priority][job.device_id] += 1
+        try:
+            yield ticket
+        finally:
+            self._release()
+
+    def snapshot(self) -> Dict:
+        """待ち行列と統計の集計（待ち行列を変更するslotと同じイベントループ上で呼ぶ）"""
+        classes = {}
+        for priority in PRIORITY_CLASSES:
+            classes[priority] = {
+                "queued": len(self._queues[priority]),
+                **self._wait_stats[priority].snapshot(),
+                "scheduled_by_device": dict(self._device_counts[priority]),
+            }
+        return {
+            "deadline_minutes": self.config.deadline_minutes,
+            "concurrency": self.config.concurrency,
+            "running": self._running,
+            "classes": classes,
+        }
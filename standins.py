@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+ローカル検証用のS3 / Supabase(PostgREST) スタンドインサーバー
+
+本番のS3・Supabaseに接続せずに、ベンチマークや負荷試験を行うための簡易サーバー。
+main.pyからは環境変数で接続先を切り替えて利用する。
+
+    S3_ENDPOINT_URL=http://127.0.0.1:9000
+    SUPABASE_URL=http://127.0.0.1:9001
+    SUPABASE_KEY=local.standin.key
+
+起動例:
+    python3 standins.py --audio-dir ./corpus --seed ./corpus/audio_files.json --latency-ms 20
+
+- S3: GET/HEAD /{bucket}/{key} で audio-dir 配下のファイルを返す（Range / ETag / If-None-Match対応）。
+  GET /{bucket}?list-type=2&prefix=... でキーとサイズの一覧を返す（ListObjectsV2）。
+  --bandwidth-mbps を指定すると本体の転送時間を模した遅延を加える（304応答には加えない）
+- PostgREST: /rest/v1/{table} に対する select（eq/in/gt/gte/lt/lte/is/not/or/and/order/limit）、
+  upsert（POST）、update（PATCH）をメモリ上のテーブルで処理する
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+# upsert時に重複判定に使う列（PostgRESTの主キー相当）
+PRIMARY_KEYS = {
+    'audio_files': ('file_path',),
+    'vibe_whisper': ('device_id', 'date', 'time_block'),
+}
+
+
+def _latency_middleware(latency_ms: float):
+    @web.middleware
+    async def middleware(request, handler):
+        # ネットワーク往復を模した固定遅延
+        if latency_ms > 0:
+            await asyncio.sleep(latency_ms / 1000)
+        return await handler(request)
+    return middleware
+
+
+def create_s3_app(audio_dir: str, latency_ms: float = 0.0, bandwidth_mbps: float = 0.0) -> web.Application:
+    """audio_dir をバケットとみなして配信するS3スタンドイン"""
+    root = Path(audio_dir).resolve()
+    stats = Counter()
+
+    async def get_object(request: web.Request):
+        key = request.match_info['key']
+        path = (root / key).resolve()
+        stats[request.method] += 1
+        if root not in path.parents or not path.is_file():
+            body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code><Key>{key}</Key></Error>'
+            return web.Response(status=404, text=body, content_type='application/xml')
+        stats['bytes'] += path.stat().st_size
+        return web.FileResponse(path)
+
+    async def list_objects(request: web.Request):
+        # ListObjectsV2（1000件ごとにContinuationTokenで続きを返す）
+        stats['LIST'] += 1
+        prefix = request.query.get('prefix', '')
+        start_after = request.query.get('continuation-token', '')
+        max_keys = int(request.query.get('max-keys', '1000'))
+        keys = sorted(
+            path.relative_to(root).as_posix() for path in root.rglob('*')
+            if path.is_file() and path.relative_to(root).as_posix().startswith(prefix)
+        )
+        keys = [key for key in keys if key > start_after]
+        page, truncated = keys[:max_keys], len(keys) > max_keys
+        contents = ''.join(
+            f'<Contents><Key>{escape(key)}</Key><Size>{(root / key).stat().st_size}</Size></Contents>' for key in page
+        )
+        token = f'<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>' if truncated else ''
+        body = (f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f'<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount><IsTruncated>{str(truncated).lower()}</IsTruncated>'
+                f'{token}{contents}</ListBucketResult>')
+        return web.Response(text=body, content_type='application/xml')
+
+    async def get_stats(request: web.Request):
+        return web.json_response(dict(stats))
+
+    async def throttle(request: web.Request, response: web.StreamResponse):
+        # 本体を返す応答だけ、サイズに応じた転送時間を待つ
+        if bandwidth_mbps > 0 and request.method == 'GET' and response.status in (200, 206) and response.content_length:
+            stats['throttled_bytes'] += response.content_length
+            await asyncio.sleep(response.content_length * 8 / (bandwidth_mbps * 1_000_000))
+        if request.method == 'GET' and response.status in (200, 206) and response.content_length:
+            stats['bytes_sent'] += response.content_length
+        stats[f'status_{response.status}'] += 1
+
+    app = web.Application(middlewares=[_latency_middleware(latency_ms)])
+    app['stats'] = stats
+    app.on_response_prepare.append(throttle)
+    app.router.add_get('/_stats', get_stats)
+    app.router.add_get('/{bucket}', list_objects)
+    app.router.add_route('*', '/{bucket}/{key:.+}', get_object)
+    return app
+
+
+def _parse_value(op_value: str):
+    op, _, value = op_value.partition('.')
+    if op == 'in':
+        items = value.strip('()')
+        return op, [v.strip().strip('"') for v in items.split(',')] if items else []
+    return op, value
+
+
+def _match(row: Dict, column: str, op: str, value) -> bool:
+    current = row.get(column)
+    current_str = None if current is None else str(current)
+    if op == 'eq':
+        return current_str == value
+    if op == 'neq':
+        return current_str != value
+    if op == 'in':
+        return current_str in value
+    if op == 'is':
+        return current is None if value == 'null' else current_str == value
+    if current_str is None:
+        return False
+    if op == 'gt':
+        return current_str > value
+    if op == 'gte':
+        return current_str >= value
+    if op == 'lt':
+        return current_str < value
+    if op == 'lte':
+        return current_str <= value
+    raise web.HTTPBadRequest(text=f'unsupported operator: {op}')
+
+
+def _split_terms(expr: str) -> List[str]:
+    """論理式の中身をトップレベルのカンマで分割（括弧・ダブルクォート内は分割しない）"""
+    terms, depth, quoted, current = [], 0, False, ''
+    for ch in expr:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == '(':
+            depth += 1
+        elif not quoted and ch == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and ch == ',':
+            terms.append(current)
+            current = ''
+            continue
+        current += ch
+    if current:
+        terms.append(current)
+    return terms
+
+
+def _match_logic(row: Dict, operator: str, expr: str) -> bool:
+    """or=(a.eq.1,and(b.gt.2,c.lt.3)) 形式の論理式を評価"""
+    results = []
+    for term in _split_terms(expr.strip()[1:-1]):
+        if term.startswith(('and(', 'or(')):
+            nested, _, inner = term.partition('(')
+            results.append(_match_logic(row, nested, '(' + inner))
+            continue
+        column, _, op_value = term.partition('.')
+        op, value = _parse_value(op_value)
+        if isinstance(value, str):
+            value = value.strip('"')
+        results.append(_match(row, column, op, value))
+    return any(results) if operator == 'or' else all(results)
+
+
+class PostgrestStandin:
+    """メモリ上のテーブルでPostgRESTの最小限のAPIを模倣する"""
+
+    RESERVED_PARAMS = {'select', 'order', 'limit', 'offset', 'on_conflict'}
+
+    def __init__(self, tables: Optional[Dict[str, List[Dict]]] = None):
+        self.tables: Dict[str, List[Dict]] = {name: list(rows) for name, rows in (tables or {}).items()}
+        self.stats = Counter()
+        # 同じ行へのupsert回数（重複処理の検出用）
+        self.upsert_counts = Counter()
+
+    def _filtered(self, table: str, request: web.Request) -> List[Dict]:
+        rows = self.tables.setdefault(table, [])
+        for column, op_value in request.query.items():
+            if column in self.RESERVED_PARAMS:
+                continue
+            if column in ('or', 'and'):
+                rows = [row for row in rows if _match_logic(row, column, op_value)]
+                continue
+            negate = op_value.startswith('not.')
+            op, value = _parse_value(op_value[4:] if negate else op_value)
+            rows = [row for row in rows if _match(row, column, op, value) != negate]
+        return rows
+
+    @staticmethod
+    def _project(rows: List[Dict], select: Optional[str]) -> List[Dict]:
+        if not select or select.strip() == '*':
+            return [dict(row) for row in rows]
+        columns = [c.strip() for c in select.split(',') if c.strip()]
+        return [{c: row.get(c) for c in columns} for row in rows]
+
+    async def handle(self, request: web.Request):
+        table = request.match_info['table']
+        self.stats[f'{request.method} {table}'] += 1
+
+        if request.method == 'GET':
+            rows = self._filtered(table, request)
+            for order in reversed(request.query.get('order', '').split(',')):
+                if order:
+                    column, _, direction = order.partition('.')
+                    # PostgreSQLと同じく、昇順ではNULLを最後に並べる
+                    rows = sorted(rows, key=lambda r: (r.get(column) is None, str(r.get(column))),
+                                  reverse=direction.startswith('desc'))
+            offset = int(request.query.get('offset', 0))
+            rows = rows[offset:]
+            if 'limit' in request.query:
+                rows = rows[:int(request.query['limit'])]
+            return web.json_response(self._project(rows, request.query.get('select')))
+
+        if request.method == 'POST':
+            payload = await request.json()
+            payload = payload if isinstance(payload, list) else [payload]
+            keys = PRIMARY_KEYS.get(table)
+            if 'on_conflict' in request.query:
+                keys = tuple(c.strip() for c in request.query['on_conflict'].split(','))
+            rows = self.tables.setdefault(table, [])
+            for item in payload:
+                existing = None
+                if keys:
+                    key = tuple(item.get(k) for k in keys)
+                    self.upsert_counts[(table,) + key] += 1
+                    existing = next((r for r in rows if tuple(r.get(k) for k in keys) == key), None)
+                if existing is not None:
+                    existing.update(item)
+                else:
+                    rows.append(dict(item))
+            return web.json_response(payload, status=201)
+
+        if request.method == 'PATCH':
+            values = await request.json()
+            updated = self._filtered(table, request)
+            for row in updated:
+                row.update(values)
+            return web.json_response([dict(row) for row in updated])
+
+        raise web.HTTPMethodNotAllowed(request.method, ['GET', 'POST', 'PATCH'])
+
+    async def get_stats(self, request: web.Request):
+        duplicated = {'|'.join(map(str, key)): count for key, count in self.upsert_counts.items() if count > 1}
+        return web.json_response({
+            'requests': dict(self.stats),
+            'upserts': sum(self.upsert_counts.values()),
+            'duplicate_upserts': sum(count - 1 for count in self.upsert_counts.values() if count > 1),
+            'duplicated_rows': duplicated,
+        })
+
+
+def create_postgrest_app(tables: Optional[Dict[str, List[Dict]]] = None, latency_ms: float = 0.0) -> web.Application:
+    standin = PostgrestStandin(tables)
+    app = web.Application(middlewares=[_latency_middleware(latency_ms)])
+    app['standin'] = standin
+    app.router.add_get('/_stats', standin.get_stats)
+    app.router.add_route('*', '/rest/v1/{table}', standin.handle)
+    return app
+
+
+async def start_app(app: web.Application, host: str, port: int) -> web.AppRunner:
+    """アプリケーションを起動し、実際に割り当てられたポートをapp['port']に設定する"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    app['port'] = runner.addresses[0][1]
+    return runner
+
+
+def load_seed(seed_path: Optional[str]) -> Dict[str, List[Dict]]:
+    """シードファイル（{"audio_files": [...]} 形式のJSON）を読み込む"""
+    if not seed_path:
+        return {}
+    with open(seed_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+async def main(args):
+    s3_app = create_s3_app(args.audio_dir, args.latency_ms, args.bandwidth_mbps)
+    postgrest_app = create_postgrest_app(load_seed(args.seed), args.latency_ms)
+    runners = [
+        await start_app(s3_app, args.host, args.s3_port),
+        await start_app(postgrest_app, args.host, args.postgrest_port),
+    ]
+    print(f"S3スタンドイン: http://{args.host}:{s3_app['port']} (audio_dir={os.path.abspath(args.audio_dir)})")
+    print(f"PostgRESTスタンドイン: http://{args.host}:{postgrest_app['port']}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ローカル検証用のS3 / PostgRESTスタンドイン")
+    parser.add_argument('--audio-dir', required=True, help="バケットの中身として配信するディレクトリ")
+    parser.add_argument('--seed', help="PostgRESTの初期データ（JSON）")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--s3-port', type=int, default=9000)
+    parser.add_argument('--postgrest-port', type=int, default=9001)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="各リクエストに加える遅延（ミリ秒）")
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help="S3の転送帯域（Mbps、0は無制限）")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
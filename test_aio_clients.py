@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+aio_clients.py - テストスクリプト
+- PostgRESTのkeysetページネーションで、recorded_atがNULLの行を含むテーブルを
+  取りこぼし・重複なく最後まで取得できること
+- S3オブジェクトキャッシュが、If-None-Matchで検証して304ならキャッシュから返し、
+  サイズ上限を超えたら最も古く使われたオブジェクトを削除し、再起動後も索引を復元すること
+
+standins.pyのS3 / PostgRESTスタンドインを起動して使う。
+    python3 test_aio_clients.py    （pytestでも実行可能）
+"""
+
+import asyncio
+import os
+import tempfile
+
+import boto3
+from botocore.config import Config
+
+from aio_clients import AsyncPostgrestClient, AsyncS3Client, IOConfig, S3ObjectCache
+from pipeline import AUDIO_FILE_KEYSET
+from standins import create_postgrest_app, create_s3_app, start_app
+
+BUCKET = "test-bucket"
+OBJECT_BYTES = 1000
+
+
+def audio_file(minute: int, recorded_at):
+    return {
+        "file_path": f"files/test-device/2025-01-01/10-{minute:02d}/audio.wav",
+        "device_id": "test-device",
+        "recorded_at": recorded_at,
+        "transcriptions_status": "pending",
+    }
+
+
+async def select_all_pages(rows, page_size):
+    app = create_postgrest_app({"audio_files": rows})
+    runner = await start_app(app, "127.0.0.1", 0)
+    client = AsyncPostgrestClient(f"http://127.0.0.1:{app['port']}", "local.standin.key", IOConfig())
+    try:
+        pages = client.select_pages(
+            "audio_files", "file_path,recorded_at", [("transcriptions_status", "eq", "pending")],
+            AUDIO_FILE_KEYSET, page_size,
+        )
+        return [[row["file_path"] for row in page] async for page in pages]
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+def test_select_pages_includes_null_recorded_at():
+    """ページの境界がrecorded_atのNULLの行にかかっても、NULLの行を最後にすべて取得する"""
+    rows = [
+        audio_file(0, "2025-01-01T10:00:00+00:00"),
+        audio_file(10, None),
+        audio_file(20, "2025-01-01T10:20:00+00:00"),
+        audio_file(30, None),
+        audio_file(40, "2025-01-01T10:40:00+00:00"),
+        audio_file(50, None),
+    ]
+    pages = asyncio.run(select_all_pages(rows, page_size=2))
+    file_paths = [file_path for page in pages for file_path in page]
+    expected = [rows[i]["file_path"] for i in (0, 2, 4, 1, 3, 5)]
+    assert file_paths == expected, file_paths
+    print(f"✅ 成功: recorded_atがNULLの行を含む{len(rows)}件を{len(pages)}ページで取得")
+
+
+async def check_object_cache(audio_dir: str, cache_dir: str):
+    app = create_s3_app(audio_dir)
+    runner = await start_app(app, "127.0.0.1", 0)
+    s3_client = boto3.client(
+        "s3", aws_access_key_id="x", aws_secret_access_key="y", region_name="us-east-1",
+        endpoint_url=f"http://127.0.0.1:{app['port']}", config=Config(s3={"addressing_style": "path"}),
+    )
+    stats = app["stats"]
+
+    async def download(cache, key):
+        client = AsyncS3Client(s3_client, BUCKET, IOConfig(), cache=cache)
+        try:
+            path = os.path.join(tempfile.mkdtemp(), "audio.wav")
+            await client.download_file(key, path)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            await client.close()
+
+    def expected(key):
+        with open(os.path.join(audio_dir, key), "rb") as f:
+            return f.read()
+
+    try:
+        # 2件分の上限: a, b をキャッシュし、a は304で検証してキャッシュから返す
+        cache = S3ObjectCache(cache_dir, max_bytes=OBJECT_BYTES * 2)
+        for key in ("a.wav", "b.wav", "a.wav"):
+            assert await download(cache, key) == expected(key)
+        assert stats["status_304"] == 1
+        assert cache.snapshot()["hits"] == 1 and cache.snapshot()["misses"] == 2
+        print("✅ 成功: ETagが変わらないオブジェクトは304で検証してキャッシュから返す")
+
+        # c を保存すると、最も古く使われた b が削除される
+        assert await download(cache, "c.wav") == expected("c.wav")
+        snapshot = cache.snapshot()
+        assert (snapshot["evictions"], snapshot["entries"], snapshot["total_bytes"]) == (1, 2, OBJECT_BYTES * 2)
+        assert cache.etag("b.wav") is None and cache.etag("a.wav") and cache.etag("c.wav")
+        print("✅ 成功: サイズ上限を超えると最も古く使われたオブジェクトを削除")
+
+        # 再起動後（同じディレクトリで作り直す）も索引を復元し、a は304でキャッシュから返す
+        restarted = S3ObjectCache(cache_dir, max_bytes=OBJECT_BYTES * 2)
+        assert restarted.snapshot()["entries"] == 2
+        assert await download(restarted, "a.wav") == expected("a.wav")
+        assert stats["status_304"] == 2 and restarted.snapshot()["hits"] == 1
+
+        # 上限を下げて再起動すると、LRUの順序（最後に使った a を残す）も復元されている
+        smaller = S3ObjectCache(cache_dir, max_bytes=OBJECT_BYTES)
+        assert smaller.etag("a.wav") and smaller.etag("c.wav") is None
+        # 削除したオブジェクトは本体とメタデータの両方をディレクトリから消す
+        assert len(os.listdir(cache_dir)) == 2
+        print("✅ 成功: 再起動後に索引とLRUの順序を復元")
+    finally:
+        await runner.cleanup()
+
+
+def test_object_cache_revalidation_eviction_and_restart():
+    # スタンドインはaudio_dirの中身をバケットの中身として配信する
+    audio_dir = tempfile.mkdtemp()
+    for key in ("a.wav", "b.wav", "c.wav"):
+        with open(os.path.join(audio_dir, key), "wb") as f:
+            f.write(os.urandom(OBJECT_BYTES))
+    asyncio.run(check_object_cache(audio_dir, tempfile.mkdtemp()))
+
+
+if __name__ == "__main__":
+    test_select_pages_includes_null_recorded_at()
+    test_object_cache_revalidation_eviction_and_restart()
@@ -92,6 +92,66 @@ def test_legacy_interface():
     except Exception as e:
         print(f"❌ リクエストエラー: {str(e)}")
 
+def test_streaming_interface():
+    """ストリーミング応答のテスト: stream="ndjson" """
+    print("\n\n=== ストリーミング応答のテスト ===")
+    
+    payload = {
+        "device_id": "d067d407-cf73-4174-a9c1-d91fb60d64d0",
+        "local_date": "2025-07-19",
+        "time_blocks": ["14-30", "15-00"],
+        "model": "base",
+        "stream": "ndjson"
+    }
+    
+    print(f"リクエスト: {json.dumps(payload, indent=2)}")
+    
+    try:
+        with requests.post(f"{API_BASE_URL}{ENDPOINT}", json=payload, stream=True) as response:
+            print(f"ステータスコード: {response.status_code}")
+            print(f"Content-Type: {response.headers.get('content-type')}")
+            
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("type") == "file":
+                    # ファイル単位の結果は完了次第届く
+                    print(f"📄 {event['time_block']}: {event['status']} ({event['duration_seconds']}秒)")
+                else:
+                    # 最後の行は従来と同じサマリー
+                    print(f"✅ サマリー: {event['summary']['pending_processed']}件処理")
+    except Exception as e:
+        print(f"❌ リクエストエラー: {str(e)}")
+
+def test_batch_interface():
+    """バッチエンドポイントのテスト: 複数のdevice_id/local_dateをまとめて処理"""
+    print("\n\n=== バッチエンドポイントのテスト ===")
+    
+    payload = {
+        "selectors": [
+            {"device_id": "d067d407-cf73-4174-a9c1-d91fb60d64d0", "local_date": "2025-07-19", "time_blocks": ["14-30"]},
+            {"device_id": "d067d407-cf73-4174-a9c1-d91fb60d64d0", "local_date": "2025-07-20"}
+        ],
+        "model": "base"
+    }
+    
+    print(f"リクエスト: {json.dumps(payload, indent=2)}")
+    
+    try:
+        response = requests.post(f"{API_BASE_URL}{ENDPOINT}/batch", json=payload)
+        print(f"ステータスコード: {response.status_code}")
+        print(f"レスポンス: {json.dumps(response.json(), indent=2, ensure_ascii=False)}")
+        
+        if response.status_code == 200:
+            result = response.json()
+            for selector_result in result['results']:
+                print(f"✅ {selector_result['device_id']} {selector_result['local_date']}: {selector_result['summary']['pending_processed']}件処理")
+        else:
+            print(f"❌ エラー: {response.text}")
+    except Exception as e:
+        print(f"❌ リクエストエラー: {str(e)}")
+
 def test_error_cases():
     """エラーケースのテスト"""
     print("\n\n=== エラーケースのテスト ===")
@@ -167,6 +227,8 @@ if __name__ == "__main__":
     # 各種テストの実行
     test_new_interface()
     test_legacy_interface()
+    test_streaming_interface()
+    test_batch_interface()
     test_error_cases()
     
     print("\n\nテスト完了")
\ No newline at end of file
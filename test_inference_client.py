@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+inference_client.py - テストスクリプト
+推論サイドカーが呼び出しの途中で終了・再起動した場合（接続のリセット、要求・応答の途中での切断、
+不正な応答）に、InferenceClientがInferenceUnavailableError（APIでは503）を送出すること、
+応答しないサイドカーへのモデルの確認・集計は推論より短いタイムアウトで打ち切ることを確認する
+
+サイドカーの代わりに、要求を読んだ後に異常な応答をするUnixソケットのサーバーを使う。
+    python3 test_inference_client.py    （pytestでも実行可能）
+"""
+
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from inference_client import LENGTH, InferenceClient, InferenceUnavailableError, encode_frame
+
+
+def recv_exactly(connection: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        data += connection.recv(size - len(data))
+    return data
+
+
+def read_request(connection: socket.socket):
+    length, = LENGTH.unpack(recv_exactly(connection, LENGTH.size))
+    header = json.loads(recv_exactly(connection, length))
+    recv_exactly(connection, header["payload_bytes"])
+
+
+def misbehaving_sidecar(behavior: str) -> str:
+    """1回だけ接続を受け付け、behaviorに従って応答するサーバーを起動し、ソケットのパスを返す"""
+    socket_path = os.path.join(tempfile.mkdtemp(), "inference.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+
+    def run():
+        connection, _ = server.accept()
+        with connection, server:
+            if behavior == "closed_mid_request":
+                # 要求の受信中に終了する（クライアントの送信はBrokenPipeError）
+                return
+            read_request(connection)
+            if behavior == "reset":
+                # SO_LINGER=0で閉じるとクライアントにはRST（ConnectionResetError）が届く
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            elif behavior == "truncated":
+                frame = encode_frame({"ok": True, "result": {"transcription": ""}})
+                connection.sendall(frame[:len(frame) // 2])
+            elif behavior == "garbage":
+                connection.sendall(LENGTH.pack(5) + b"{oops")
+            elif behavior == "hang":
+                # 要求を読んだまま応答しない（推論が詰まっているサイドカー）
+                connection.recv(1)
+
+    threading.Thread(target=run, daemon=True).start()
+    return socket_path
+
+
+def assert_unavailable(behavior: str):
+    client = InferenceClient(misbehaving_sidecar(behavior), timeout=10)
+    try:
+        client.transcribe(np.zeros(16000 * 60, dtype=np.float32), "base")
+    except InferenceUnavailableError as e:
+        print(f"✅ 成功: {behavior} -> InferenceUnavailableError（{e}）")
+        return
+    raise AssertionError(f"{behavior}: InferenceUnavailableErrorが送出されません")
+
+
+def test_connection_reset_during_call():
+    assert_unavailable("reset")
+
+
+def test_closed_while_sending_request():
+    assert_unavailable("closed_mid_request")
+
+
+def test_truncated_response():
+    assert_unavailable("truncated")
+
+
+def test_invalid_response():
+    assert_unavailable("garbage")
+
+
+def test_missing_socket():
+    client = InferenceClient(os.path.join(tempfile.mkdtemp(), "missing.sock"), timeout=1)
+    try:
+        client.stats()
+    except InferenceUnavailableError:
+        print("✅ 成功: ソケットがない場合もInferenceUnavailableError")
+        return
+    raise AssertionError("ソケットがない場合にInferenceUnavailableErrorが送出されません")
+
+
+def test_control_calls_use_short_timeout():
+    """check / statsは推論のタイムアウト（600秒）ではなくcontrol_timeoutで打ち切る"""
+    client = InferenceClient(misbehaving_sidecar("hang"), timeout=600, control_timeout=0.5)
+    started = time.monotonic()
+    try:
+        client.check("base")
+    except InferenceUnavailableError:
+        elapsed = time.monotonic() - started
+        assert elapsed < 5, elapsed
+        print(f"✅ 成功: 応答しないサイドカーへのモデルの確認を{elapsed:.1f}秒で打ち切り")
+        return
+    raise AssertionError("応答しないサイドカーでInferenceUnavailableErrorが送出されません")
+
+
+if __name__ == "__main__":
+    test_connection_reset_during_call()
+    test_closed_while_sending_request()
+    test_truncated_response()
+    test_invalid_response()
+    test_missing_socket()
+    test_control_calls_use_short_timeout()
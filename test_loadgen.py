@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+loadgen.py - テストスクリプト
+stream（ndjson / sse）を含むリクエストを記録したトラフィックを再生し、
+ストリーミング応答のsummaryから処理件数を集計できることを確認する
+
+APIサーバーの代わりに、main.pyと同じ形式でストリーミング応答を返す小さなサーバーを起動する。
+    python3 test_loadgen.py    （pytestでも実行可能）
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+
+from aiohttp import web
+
+from loadgen import parse_response, replay
+from traffic import TrafficRecorder, load_trace
+
+
+def stream_event(stream_format: str, event: str, payload: dict) -> str:
+    """main.format_stream_eventと同じ形式"""
+    body = json.dumps(payload, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {body}\n\n"
+    return body + "\n"
+
+
+async def fake_fetch_and_transcribe(request: web.Request) -> web.StreamResponse:
+    payload = await request.json()
+    file_paths = payload.get("file_paths", [])
+    summary = {
+        "status": "success",
+        "summary": {"total_files": len(file_paths), "pending_processed": len(file_paths), "errors": 0},
+    }
+    stream_format = payload.get("stream")
+    if not stream_format:
+        return web.json_response(summary)
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream" if stream_format == "sse" else "application/x-ndjson"})
+    await response.prepare(request)
+    for file_path in file_paths:
+        await response.write(stream_event(stream_format, "file", {"type": "file", "file_path": file_path, "status": "success"}).encode())
+    if payload.get("fail"):
+        await response.write(stream_event(stream_format, "error", {"type": "error", "error": "データベースクエリエラー"}).encode())
+    else:
+        await response.write(stream_event(stream_format, "summary", summary).encode())
+    await response.write_eof()
+    return response
+
+
+async def replay_capture(payloads):
+    """payloadsをTrafficRecorderで記録し、そのファイルを再生した結果を返す"""
+    capture_path = os.path.join(tempfile.mkdtemp(), "traffic.jsonl")
+    recorder = TrafficRecorder(capture_path)
+    for payload in payloads:
+        recorder.record("/fetch-and-transcribe", payload)
+    entries = load_trace(capture_path)
+
+    app = web.Application()
+    app.router.add_post("/fetch-and-transcribe", fake_fetch_and_transcribe)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        results, _ = await replay(entries, f"http://127.0.0.1:{port}", speed=1000.0, timeout=30.0)
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def test_replay_streaming_capture():
+    """ndjson / sse / 一括応答のリクエストを含む記録を再生し、すべてのファイルを処理件数に数える"""
+    payloads = [
+        {"file_paths": ["files/a/2025-01-01/00-00/audio.wav", "files/a/2025-01-01/00-30/audio.wav"], "stream": "ndjson"},
+        {"file_paths": ["files/b/2025-01-01/00-00/audio.wav"], "stream": "sse"},
+        {"file_paths": ["files/c/2025-01-01/00-00/audio.wav"]},
+    ]
+    results = asyncio.run(replay_capture(payloads))
+    assert [result.error for result in results] == [None, None, None]
+    assert sum(result.files for result in results) == 4
+    print("✅ 成功: ストリーミング応答を含む記録を再生し、4件の処理を集計")
+
+
+def test_replay_streaming_error_event():
+    """errorイベントで終了したストリーミング応答はエラーとして数える"""
+    payloads = [
+        {"file_paths": ["files/a/2025-01-01/00-00/audio.wav"], "stream": "ndjson", "fail": True},
+        {"file_paths": ["files/b/2025-01-01/00-00/audio.wav"], "stream": "sse", "fail": True},
+    ]
+    results = asyncio.run(replay_capture(payloads))
+    assert all(result.error and "データベースクエリエラー" in result.error for result in results)
+    assert sum(result.files for result in results) == 0
+    print("✅ 成功: errorイベントをエラーとして集計")
+
+
+def test_parse_response_requires_summary():
+    """summaryの前に切断されたストリーミング応答はエラー"""
+    body = stream_event("ndjson", "file", {"type": "file", "file_path": "x", "status": "success"}).encode()
+    try:
+        parse_response(body, "ndjson")
+    except ValueError:
+        print("✅ 成功: summaryのない応答を検出")
+        return
+    raise AssertionError("summaryのない応答がエラーになりません")
+
+
+if __name__ == "__main__":
+    test_replay_streaming_capture()
+    test_replay_streaming_error_event()
+    test_parse_response_requires_summary()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+noise_profile.py - テストスクリプト
+1台のデバイスの空の結果からノイズフロアを学習し、ノイズフロア付近のブロックを発話なしと判定すること、
+そのうち監査の割合はWhisperにも送ること、監査での誤判定が多いデバイスは判定を停止すること、
+プロファイルが保存・読み込みで引き継がれることを確認する
+
+音声は乱数のシードを固定して合成する（部屋のノイズ: 白色雑音、発話: 声の帯域の倍音）。
+    python3 test_noise_profile.py    （pytestでも実行可能）
+"""
+
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from noise_profile import NoiseProfileConfig, NoiseProfiles, extract_features
+
+DEVICE_ID = "test-device"
+SAMPLE_RATE = 16000
+EMPTY = {"transcription": ""}
+
+
+def room_noise(rng: np.random.Generator, seconds: float = 10.0) -> np.ndarray:
+    """エアコンの音のような一定レベルの雑音（発話なし）"""
+    return rng.normal(0, 0.003, int(SAMPLE_RATE * seconds)).astype(np.float32)
+
+
+def speech(rng: np.random.Generator, seconds: float = 10.0) -> np.ndarray:
+    """部屋のノイズに、0.5秒ごとに区切れる声の帯域の倍音を重ねたもの"""
+    audio = room_noise(rng, seconds)
+    t = np.arange(len(audio)) / SAMPLE_RATE
+    voiced = sum(np.sin(2 * np.pi * 180 * k * t) / k for k in range(1, 8)) * (np.sin(2 * np.pi * t) > 0)
+    return audio + 0.05 * voiced.astype(np.float32)
+
+
+def trained_profiles(path: str, audit_rate: float = 0.2, blocks: int = 30):
+    config = NoiseProfileConfig(path=path, min_samples=20, audit_rate=audit_rate, save_interval_seconds=3600)
+    profiles = NoiseProfiles(config, rng=random.Random(1))
+    rng = np.random.default_rng(0)
+    for _ in range(blocks):
+        profiles.observe(DEVICE_ID, extract_features(room_noise(rng)), EMPTY, transcribe_seconds=1.0)
+    return profiles
+
+
+def test_near_floor_blocks_are_silent_and_audited():
+    profiles = trained_profiles(os.path.join(tempfile.mkdtemp(), "noise_profiles.json"))
+    rng = np.random.default_rng(1)
+    decisions = [profiles.classify(DEVICE_ID, extract_features(room_noise(rng))) for _ in range(100)]
+    skipped, audited = decisions.count("skip"), decisions.count("audit")
+    # ノイズフロア付近のブロックはほぼすべて発話なしと判定し、約2割（audit_rate）をWhisperでも処理する
+    assert skipped + audited >= 95, decisions
+    assert 10 <= audited <= 30, audited
+    # 発話のあるブロック・学習していないデバイスは判定しない
+    assert profiles.classify(DEVICE_ID, extract_features(speech(rng))) is None
+    assert profiles.classify("other-device", extract_features(room_noise(rng))) is None
+    device = profiles.snapshot()["devices"][DEVICE_ID]
+    assert (device["samples"], device["hits"], device["audited"]) == (30, skipped + audited, audited)
+    print(f"✅ 成功: ノイズフロア付近の100件中{skipped + audited}件を発話なしと判定（うち監査{audited}件）")
+
+
+def test_audit_misses_suspend_the_device():
+    """監査でテキストが得られた割合がNOISE_PROFILE_MAX_MISS_RATEを超えたら判定を停止する"""
+    profiles = trained_profiles(os.path.join(tempfile.mkdtemp(), "noise_profiles.json"), audit_rate=1.0)
+    rng = np.random.default_rng(2)
+    for _ in range(profiles.config.min_audits):
+        features = extract_features(room_noise(rng))
+        assert profiles.classify(DEVICE_ID, features) == "audit"
+        profiles.observe(DEVICE_ID, features, {"transcription": "こんにちは"}, transcribe_seconds=1.0, audited=True)
+    assert profiles.classify(DEVICE_ID, extract_features(room_noise(rng))) is None
+    assert profiles.snapshot()["devices"][DEVICE_ID]["suspended"]
+    print("✅ 成功: 監査での誤判定が多いデバイスは判定を停止")
+
+
+def test_profiles_survive_save_and_load():
+    path = os.path.join(tempfile.mkdtemp(), "state", "noise_profiles.json")
+    profiles = trained_profiles(path)
+    profiles.close()
+    restored = NoiseProfiles(profiles.config, rng=random.Random(1))
+    before = profiles.snapshot()["devices"][DEVICE_ID]
+    after = restored.snapshot()["devices"][DEVICE_ID]
+    assert (after["samples"], after["ready"], after["profile"]) == (before["samples"], True, before["profile"])
+    assert restored.classify(DEVICE_ID, extract_features(room_noise(np.random.default_rng(3)))) in ("skip", "audit")
+    print(f"✅ 成功: {after['samples']}件分のプロファイルを保存し、読み込み後も判定に使用")
+
+
+if __name__ == "__main__":
+    test_near_floor_blocks_are_silent_and_audited()
+    test_audit_misses_suspend_the_device()
+    test_profiles_survive_save_and_load()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+prefilter.py - テストスクリプト
+ダウンロード前の判定（empty / header_only / too_short）と、無音に見える長い録音を
+ダウンロードに回すこと（標本の間にだけ発話がある録音を無音として確定しない）、
+一覧の取得に失敗した場合にファイルごとに取り直さないことを確認する
+
+S3の代わりに、一覧とRange取得だけを持つメモリ上のクライアントを使う。
+    python3 test_prefilter.py    （pytestでも実行可能）
+"""
+
+import asyncio
+import io
+
+import numpy as np
+import soundfile as sf
+
+from prefilter import Prefilter, PrefilterConfig
+
+PREFIX = "files/test-device/2025-01-01"
+
+
+class InMemoryS3:
+    """Prefilterが使うAsyncS3Clientのメソッド（list_objects / read_range）だけを持つクライアント"""
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    async def list_objects(self, prefix):
+        return {key: len(data) for key, data in self.objects.items() if key.startswith(prefix)}
+
+    async def read_range(self, key, start, end):
+        return self.objects[key][start:end + 1]
+
+
+class ListDeniedS3(InMemoryS3):
+    """一覧の取得が拒否される（IAMロールにs3:ListBucketがない）クライアント"""
+
+    async def list_objects(self, prefix):
+        raise PermissionError("AccessDenied: s3:ListBucket")
+
+
+def wav_bytes(samples, sample_rate=16000, subtype='PCM_16'):
+    buffer = io.BytesIO()
+    sf.write(buffer, samples, sample_rate, format='WAV', subtype=subtype)
+    return buffer.getvalue()
+
+
+def speech_between_samples():
+    """ほぼ無音の60秒の録音で、10〜11秒にだけ発話（倍音）がある
+
+    等間隔の標本（0秒・20秒・40秒・60秒付近）のRMSはすべて無音の閾値未満になる。
+    """
+    rng = np.random.default_rng(0)
+    audio = rng.normal(0, 0.0001, 16000 * 60)
+    t = np.arange(16000) / 16000
+    audio[16000 * 10:16000 * 11] += 0.2 * sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 6))
+    return wav_bytes(audio)
+
+
+def run_checks(objects, min_seconds=1.0, client=InMemoryS3):
+    prefilter = Prefilter(client(objects), PrefilterConfig(min_seconds=min_seconds))
+
+    async def check_all():
+        return {key: await prefilter.check(key) for key in objects}
+
+    return asyncio.run(check_all()), prefilter.stats.snapshot()
+
+
+def test_resolves_empty_header_only_and_short_files():
+    rng = np.random.default_rng(1)
+    objects = {
+        f"{PREFIX}/10-00/audio.wav": b"",
+        f"{PREFIX}/10-30/audio.wav": wav_bytes(np.zeros(0)),
+        f"{PREFIX}/11-00/audio.wav": wav_bytes(rng.normal(0, 0.1, 4800)),
+        f"{PREFIX}/11-30/audio.wav": wav_bytes(rng.normal(0, 0.1, (24000, 2)), sample_rate=48000),
+    }
+    reasons, stats = run_checks(objects)
+    assert list(reasons.values()) == ["empty", "header_only", "too_short", "too_short"], reasons
+    assert stats["list_requests"] == 1
+    print("✅ 成功: empty / header_only / too_short をダウンロードせずに確定")
+
+
+def test_speech_between_sampled_offsets_is_downloaded():
+    """発話が標本の間にしかない録音も、無音の録音も、プレフィルターでは確定しない"""
+    objects = {
+        f"{PREFIX}/12-00/audio.wav": speech_between_samples(),
+        f"{PREFIX}/12-30/audio.wav": wav_bytes(np.zeros(16000 * 60, dtype=np.float32), subtype='FLOAT'),
+    }
+    reasons, stats = run_checks(objects)
+    assert list(reasons.values()) == [None, None], reasons
+    # 1分のブロックはヘッダーも読まない
+    assert stats["range_requests"] == 0
+    print("✅ 成功: 標本の間にだけ発話がある録音はダウンロードに回す")
+
+
+def test_list_failure_is_not_retried_per_file():
+    """一覧の取得に失敗したプレフィックスは、TTLの間は取り直さずにすべてダウンロードに回す"""
+    objects = {f"{PREFIX}/{minute:02d}-00/audio.wav": b"" for minute in range(10, 15)}
+    reasons, stats = run_checks(objects, client=ListDeniedS3)
+    assert set(reasons.values()) == {None}, reasons
+    assert (stats["list_requests"], stats["list_errors"]) == (1, 1), stats
+    print(f"✅ 成功: 一覧の取得の失敗は{len(objects)}件のファイルで1回だけ")
+
+
+if __name__ == "__main__":
+    test_resolves_empty_header_only_and_short_files()
+    test_speech_between_sampled_offsets_is_downloaded()
+    test_list_failure_is_not_retried_per_file()
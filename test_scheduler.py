@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+scheduler.py - テストスクリプト
+推論枠の割り当て順（realtimeをbackfillより先に、1台のデバイスから大量に届いても
+デバイス間で交互に）と、待機中・割り当て直後に取り消された場合の扱いを確認する
+
+推論枠を1つにしたスケジューラーに、推論の代わりに実行順を記録するだけのファイルを渡す。
+    python3 test_scheduler.py    （pytestでも実行可能）
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from scheduler import SchedulerConfig, TranscriptionScheduler
+
+
+def audio_file(device_id: str, minutes_ago: float):
+    recorded_at = datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)
+    return {"device_id": device_id, "recorded_at": recorded_at.isoformat()}
+
+
+async def hold_slot(scheduler, release: asyncio.Event):
+    """推論枠を1つ占有し、releaseが設定されるまで返さない"""
+    async with scheduler.slot(audio_file("holder", 0)):
+        await release.wait()
+
+
+async def run_in_slot(scheduler, label: str, file: dict, order: list):
+    async with scheduler.slot(file) as ticket:
+        order.append((label, ticket["priority"]))
+
+
+async def check_dispatch_order():
+    scheduler = TranscriptionScheduler(SchedulerConfig(deadline_minutes=60, concurrency=1))
+    release = asyncio.Event()
+    holder = asyncio.create_task(hold_slot(scheduler, release))
+    await asyncio.sleep(0)
+
+    order = []
+    # backfillを先に積み、その後にデバイスAから6件、デバイスBから2件のrealtimeを積む
+    files = [(f"C{i}", audio_file("C", 180 - i)) for i in range(2)]
+    files += [(f"A{i}", audio_file("A", 30 - i)) for i in range(6)]
+    files += [(f"B{i}", audio_file("B", 20 - i)) for i in range(2)]
+    tasks = [asyncio.create_task(run_in_slot(scheduler, label, file, order)) for label, file in files]
+    await asyncio.sleep(0)
+    queued = scheduler.snapshot()["classes"]
+    assert (queued["realtime"]["queued"], queued["backfill"]["queued"]) == (8, 2), queued
+
+    release.set()
+    await asyncio.gather(holder, *tasks)
+    return order, scheduler.snapshot()
+
+
+def test_realtime_first_and_devices_alternate():
+    """realtimeはbackfillより先に、realtimeの中ではデバイスAの大量のファイルとBが交互に割り当てられる"""
+    order, snapshot = asyncio.run(check_dispatch_order())
+    labels = [label for label, _ in order]
+    assert labels == ["A0", "B0", "A1", "B1", "A2", "A3", "A4", "A5", "C0", "C1"], labels
+    assert [priority for _, priority in order] == ["realtime"] * 8 + ["backfill"] * 2
+    assert snapshot["running"] == 0
+    assert snapshot["classes"]["realtime"]["scheduled_by_device"] == {"holder": 1, "A": 6, "B": 2}
+    print(f"✅ 成功: 割り当て順 {' → '.join(labels)}")
+
+
+async def check_cancelled_waiters():
+    scheduler = TranscriptionScheduler(SchedulerConfig(deadline_minutes=60, concurrency=1))
+    order = []
+    async with scheduler.slot(audio_file("holder", 0)):
+        queued = asyncio.create_task(run_in_slot(scheduler, "queued", audio_file("X", 10), order))
+        granted = asyncio.create_task(run_in_slot(scheduler, "granted", audio_file("Y", 20), order))
+        await asyncio.sleep(0)
+
+        # 待機中に取り消されたファイルはキューから外れる
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert scheduler.snapshot()["classes"]["realtime"]["queued"] == 1
+
+    # 推論枠が割り当てられた直後（実行前）に取り消されたファイルは枠を返す
+    assert scheduler.snapshot()["running"] == 1
+    granted.cancel()
+    await asyncio.gather(granted, return_exceptions=True)
+    assert queued.cancelled() and granted.cancelled()
+
+    await asyncio.wait_for(run_in_slot(scheduler, "next", audio_file("Z", 0), order), timeout=1)
+    return order, scheduler.snapshot()
+
+
+def test_cancelled_waiters_release_their_place():
+    order, snapshot = asyncio.run(check_cancelled_waiters())
+    assert order == [("next", "realtime")], order
+    assert snapshot["running"] == 0
+    assert snapshot["classes"]["realtime"]["queued"] == 0
+    print("✅ 成功: 取り消されたファイルは待ち行列から外れ、割り当て済みの枠は返される")
+
+
+if __name__ == "__main__":
+    test_realtime_first_and_devices_alternate()
+    test_cancelled_waiters_release_their_place()
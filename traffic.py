@@ -0,0 +1,66 @@
+"""
+リクエストの記録（トラフィックキャプチャ）
+
+TRAFFIC_CAPTURE_PATHを指定すると、/fetch-and-transcribe（/batchを含む）が受け付けた
+リクエストのペイロードを到着時刻付きでJSONLファイルに追記する。記録したファイルは
+loadgen.pyで同じ間隔（または速度を変えて）再生できる。
+
+1行の形式:
+    {"ts": 1721370600.123, "endpoint": "/fetch-and-transcribe", "payload": {...}}
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class TrafficRecorder:
+    """受け付けたリクエストをJSONLファイルに追記する（スレッドセーフ）
+
+    ファイルへの書き込みはイベントループを止めないよう、asyncio.to_threadから呼ぶ。
+    ファイルは最初の記録時に開き、close()まで開いたままにする。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self.recorded = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["TrafficRecorder"]:
+        path = os.getenv('TRAFFIC_CAPTURE_PATH', '')
+        return cls(path) if path else None
+
+    def record(self, endpoint: str, payload: Dict, ts: Optional[float] = None):
+        """tsは到着時刻（省略時は現在時刻）。スレッドから呼ぶ場合は受付時に取得した時刻を渡す"""
+        line = json.dumps({"ts": ts or time.time(), "endpoint": endpoint, "payload": payload}, ensure_ascii=False)
+        with self._lock:
+            # 記録に失敗してもリクエストの処理は続ける（ディスクフル等）
+            try:
+                if self._file is None:
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                self._file.write(line + '\n')
+                self._file.flush()
+                self.recorded += 1
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load_trace(path: str) -> List[Dict]:
+    """記録したJSONLファイルを到着時刻順に読み込む"""
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return sorted(entries, key=lambda entry: entry['ts'])
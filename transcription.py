@@ -0,0 +1,395 @@
+"""
+音声の分析とWhisperによる文字起こし
+
+main.pyの処理パイプラインから呼び出す推論まわりの処理をまとめたモジュール。
+
+- RMSによる無音判定
+- ハルシネーション（同じフレーズの繰り返し）の検出
+- tinyモデルによる一次判定（カスケード）: 発話がなさそうなブロックはbaseモデルを使わずに空文字とする
+- 30秒ウィンドウごとの無音ゲート: エンコーダーとno_speechトークンの確率だけを先に計算し、
+  無音と判定したウィンドウはデコード（CPUで最も重い処理）を行わない
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import whisper
+
+logger = logging.getLogger(__name__)
+
+# Whisperモデルは同時実行に対応していないため、推論は1件ずつ実行する
+# （推論はイベントループを止めないようにスレッドプールから呼び出すため必須）
+whisper_lock = threading.Lock()
+
+# 無音の閾値（実験的に調整が必要）
+SILENCE_THRESHOLD = 0.0005  # より厳しい閾値に変更
+
+
+def detect_hallucination(transcription: str) -> bool:
+    """同じフレーズの繰り返しなど、Whisperのハルシネーションと思われる結果かを判定"""
+    # 句読点で分割してセグメントを抽出
+    segments = re.split(r'[、。，．,.]', transcription)
+    segments = [s.strip() for s in segments if s.strip()]
+
+    if segments:
+        # セグメントの繰り返しを検出
+        segment_counts = Counter(segments)
+        most_common_segment, count = segment_counts.most_common(1)[0]
+
+        # 同じセグメントが10回以上繰り返される場合はハルシネーション
+        if count >= 10:
+            logger.warning(f"⚠️ ハルシネーション検出: '{most_common_segment}'が{count}回繰り返し")
+            return True
+        # 同じセグメントが全体の70%以上を占める場合もハルシネーション
+        if len(segments) >= 5 and count >= len(segments) * 0.7:
+            logger.warning(f"⚠️ ハルシネーション検出: '{most_common_segment}'が全体の{count/len(segments)*100:.1f}%")
+            return True
+
+    # 短いフレーズパターンの検出（日本語対応）
+    pattern = r'([\u3040-\u309f\u30a0-\u30ff\u4e00-\u9faf]+[がのはをにでと]*)'
+    phrases = re.findall(pattern, transcription)
+    if phrases:
+        phrase_counts = Counter(phrases)
+        for phrase, count in phrase_counts.items():
+            if len(phrase) >= 2 and count >= 10:
+                logger.warning(f"⚠️ フレーズの過度な繰り返し検出: '{phrase}'が{count}回")
+                return True
+
+    return False
+
+
+class CascadeConfig:
+    """tinyモデルによる一次判定の設定
+
+    30秒ウィンドウごとにtinyモデルで1回だけデコードし、no_speech_probが高いか
+    avg_logprobが低い（自信がない）ウィンドウ、テキストが空またはハルシネーションの
+    ウィンドウを「発話なし」とみなす。全ウィンドウが発話なしのブロックは
+    baseモデルを使わずに空文字として確定する。
+    """
+
+    def __init__(self, model_name: str = "tiny", no_speech_threshold: float = 0.6, logprob_threshold: float = -1.0):
+        self.model_name = model_name
+        self.no_speech_threshold = no_speech_threshold
+        self.logprob_threshold = logprob_threshold
+
+
+class CascadeStats:
+    """カスケードの判定結果の集計（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.screened = 0  # tinyモデルで判定したブロック数
+        self.resolved = 0  # tinyモデルの判定だけで確定したブロック数
+        self.escalated = 0  # baseモデルに回したブロック数
+        self.screen_seconds = 0.0  # tinyモデルの判定にかかった時間の合計
+        self.escalated_seconds = 0.0  # baseモデルでの文字起こしにかかった時間の合計
+
+    def record(self, resolved: bool, screen_seconds: float, escalated_seconds: float = 0.0):
+        with self._lock:
+            self.screened += 1
+            self.screen_seconds += screen_seconds
+            if resolved:
+                self.resolved += 1
+            else:
+                self.escalated += 1
+                self.escalated_seconds += escalated_seconds
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stats = {
+                "screened_blocks": self.screened,
+                "resolved_by_cascade": self.resolved,
+                "escalated_to_base": self.escalated,
+                "resolved_ratio": round(self.resolved / self.screened, 3) if self.screened else None,
+                "avg_screen_seconds": round(self.screen_seconds / self.screened, 3) if self.screened else None,
+                "avg_base_seconds": round(self.escalated_seconds / self.escalated, 3) if self.escalated else None,
+                "estimated_throughput_gain": None
+            }
+            if self.escalated:
+                # カスケードなしの場合は全ブロックをbaseモデルで処理していたとみなして比較
+                avg_base = self.escalated_seconds / self.escalated
+                with_cascade = self.screen_seconds + self.escalated_seconds
+                if with_cascade > 0:
+                    stats["estimated_throughput_gain"] = round(self.screened * avg_base / with_cascade, 2)
+            return stats
+
+
+cascade_stats = CascadeStats()
+
+
+class GatingStats:
+    """無音ゲートの集計（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.windows = 0  # 判定した30秒ウィンドウ数
+        self.skipped = 0  # デコードを省略したウィンドウ数
+        self.probe_seconds = 0.0  # エンコーダー + no_speech判定にかかった時間の合計
+        self.decode_seconds = 0.0  # デコードにかかった時間の合計
+
+    def record(self, skipped: bool, probe_seconds: float, decode_seconds: float = 0.0):
+        with self._lock:
+            self.windows += 1
+            self.probe_seconds += probe_seconds
+            if skipped:
+                self.skipped += 1
+            else:
+                self.decode_seconds += decode_seconds
+
+    def add(self, windows: int, skipped: int, probe_seconds: float, decode_seconds: float):
+        """別プロセス（長時間録音のワーカー）で集計した値を加算する"""
+        with self._lock:
+            self.windows += windows
+            self.skipped += skipped
+            self.probe_seconds += probe_seconds
+            self.decode_seconds += decode_seconds
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            decoded = self.windows - self.skipped
+            return {
+                "windows": self.windows,
+                "skipped_windows": self.skipped,
+                "skipped_ratio": round(self.skipped / self.windows, 3) if self.windows else None,
+                "avg_probe_seconds": round(self.probe_seconds / self.windows, 3) if self.windows else None,
+                "avg_decode_seconds": round(self.decode_seconds / decoded, 3) if decoded else None,
+                # 省略したウィンドウをデコードしていた場合に比べて削減できた推定時間
+                "estimated_saved_seconds": round(self.skipped * self.decode_seconds / decoded, 1) if decoded else None
+            }
+
+
+gating_stats = GatingStats()
+
+# デコード結果が不自然な場合に温度を上げて再試行する（whisper.transcribeと同じ基準）
+FALLBACK_TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+
+
+def iter_mel_windows(audio: np.ndarray, n_mels: int):
+    """16kHzの音声を30秒ウィンドウごとのlog-Melスペクトログラム（Whisperの入力形式）に変換"""
+    for start in range(0, max(len(audio), 1), whisper.audio.N_SAMPLES):
+        window = whisper.pad_or_trim(audio[start:start + whisper.audio.N_SAMPLES])
+        yield whisper.log_mel_spectrogram(window, n_mels=n_mels)
+
+
+def screen_with_cascade(audio: np.ndarray, cascade_model, config: CascadeConfig) -> bool:
+    """tinyモデルで発話の有無を判定し、baseモデルでの文字起こしが必要ならTrueを返す"""
+    options = whisper.DecodingOptions(language="ja", without_timestamps=True, fp16=False)
+    for window_index, mel in enumerate(iter_mel_windows(audio, cascade_model.dims.n_mels)):
+        with torch.no_grad():
+            result = whisper.decode(cascade_model, mel.to(cascade_model.device), options)
+        text = result.text.strip()
+        if result.no_speech_prob > config.no_speech_threshold:
+            continue
+        if result.avg_logprob < config.logprob_threshold:
+            continue
+        if not text or detect_hallucination(text):
+            continue
+        logger.info(
+            f"🔼 カスケード: ウィンドウ{window_index}に発話の可能性あり"
+            f"（no_speech_prob={result.no_speech_prob:.2f}, avg_logprob={result.avg_logprob:.2f}）"
+        )
+        return True
+    return False
+
+
+def probe_no_speech(whisper_model, audio_features: torch.Tensor, tokenizer, prompt: Optional[List[int]] = None) -> float:
+    """エンコード済みの特徴量に対して、SOTトークン位置のno_speechトークンの確率を返す
+
+    decode_windowと同じ初期トークン列（プロンプト + SOT / 言語 / タスク / タイムスタンプなし）を
+    デコーダーに1回だけ通し、whisper.decodeが最初のステップで計算するno_speech_probと同じ値を求める。
+    プロンプト（前のウィンドウのテキスト）によって確率が変わるため、デコード時と同じpromptを渡す。
+    """
+    initial_tokens = list(tokenizer.sot_sequence_including_notimestamps)
+    if prompt:
+        # whisper.decodingと同じく、プロンプトはテキストのコンテキスト長の半分までに切り詰める
+        initial_tokens = [tokenizer.sot_prev] + prompt[-(whisper_model.dims.n_text_ctx // 2 - 1):] + initial_tokens
+    tokens = torch.tensor([initial_tokens], device=audio_features.device)
+    logits = whisper_model.logits(tokens, audio_features)
+    probs = logits[:, initial_tokens.index(tokenizer.sot)].float().softmax(dim=-1)
+    return probs[0, tokenizer.no_speech].item()
+
+
+def decode_window(whisper_model, audio_features: torch.Tensor, prompt: Optional[List[int]] = None):
+    """エンコード済みの1ウィンドウをデコードする（結果が不自然な場合は温度を上げて再試行）"""
+    result = None
+    for temperature in FALLBACK_TEMPERATURES:
+        options = whisper.DecodingOptions(
+            language="ja",
+            task="transcribe",
+            temperature=temperature,
+            best_of=5 if temperature > 0 else None,
+            prompt=prompt,
+            without_timestamps=True,
+            fp16=False
+        )
+        # audio_featuresは (1, n_audio_ctx, n_audio_state) のため、エンコーダーは再実行されない
+        result = whisper.decode(whisper_model, audio_features, options)[0]
+        if result.compression_ratio <= COMPRESSION_RATIO_THRESHOLD and result.avg_logprob >= LOGPROB_THRESHOLD:
+            break
+    return result
+
+
+def transcribe_with_gating(audio: np.ndarray, whisper_model, no_speech_threshold: float) -> Dict:
+    """30秒ウィンドウごとに無音判定を行い、発話がありそうなウィンドウだけデコードする
+
+    各ウィンドウのエンコーダーは1回だけ実行し、その特徴量を無音判定とデコードの両方に使う。
+    戻り値: {"text": str, "no_speech_prob": 判定したウィンドウの最小値, "windows": int, "skipped_windows": int}
+    """
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        whisper_model.is_multilingual,
+        num_languages=whisper_model.num_languages,
+        language="ja",
+        task="transcribe"
+    )
+    texts = []
+    prompt_tokens: List[int] = []
+    no_speech_probs = []
+    skipped = 0
+
+    for window_index, mel in enumerate(iter_mel_windows(audio, whisper_model.dims.n_mels)):
+        probe_start = time.time()
+        with torch.no_grad():
+            audio_features = whisper_model.embed_audio(mel.unsqueeze(0).to(whisper_model.device))
+            # デコード時と同じプロンプトで判定する（プロンプトの有無で無音確率が変わるため）
+            no_speech_prob = probe_no_speech(whisper_model, audio_features, tokenizer, prompt_tokens or None)
+        probe_seconds = time.time() - probe_start
+        no_speech_probs.append(no_speech_prob)
+
+        if no_speech_prob > no_speech_threshold:
+            logger.info(f"⏭️ ウィンドウ{window_index}: no_speech_prob={no_speech_prob:.2f}のためデコードを省略")
+            gating_stats.record(skipped=True, probe_seconds=probe_seconds)
+            skipped += 1
+            continue
+
+        decode_start = time.time()
+        with torch.no_grad():
+            # それまでにデコードしたトークンをプロンプトにして文脈を引き継ぐ（whisper.transcribeと同様）
+            result = decode_window(whisper_model, audio_features, prompt=prompt_tokens or None)
+        gating_stats.record(skipped=False, probe_seconds=probe_seconds, decode_seconds=time.time() - decode_start)
+        texts.append(result.text.strip())
+        prompt_tokens.extend(result.tokens)
+
+    return {
+        "text": "".join(texts),
+        "no_speech_prob": min(no_speech_probs) if no_speech_probs else 1.0,
+        "windows": len(no_speech_probs),
+        "skipped_windows": skipped
+    }
+
+
+def run_whisper(audio: np.ndarray, whisper_model, no_speech_gate: Optional[float] = None) -> Dict:
+    """Whisperで文字起こしし、{"text": str, "no_speech_prob": float} を返す
+
+    no_speech_gateを指定した場合はウィンドウ単位の無音ゲートを使う。
+    no_speech_probはブロック全体の無音確率（各セグメント・ウィンドウの最小値）。
+    """
+    if no_speech_gate is not None:
+        return transcribe_with_gating(audio, whisper_model, no_speech_gate)
+
+    result = whisper_model.transcribe(audio, language="ja")
+    # whisper.transcribeはno_speech_probをセグメント単位でのみ返す
+    segment_probs = [segment["no_speech_prob"] for segment in result.get("segments", []) if "no_speech_prob" in segment]
+    return {
+        "text": result["text"],
+        "no_speech_prob": min(segment_probs) if segment_probs else None
+    }
+
+
+def transcribe_audio_file(tmp_file_path: str, whisper_model, cascade_model=None,
+                          cascade_config: Optional[CascadeConfig] = None,
+                          no_speech_gate: Optional[float] = None, long_audio=None) -> Dict:
+    """音声ファイルをWhisperの入力形式（16kHzモノラル）に変換して、transcribe_audioで分析・文字起こしする"""
+    audio = whisper.load_audio(tmp_file_path)
+    return transcribe_audio(audio, whisper_model, cascade_model, cascade_config, no_speech_gate, long_audio)
+
+
+def transcribe_audio(audio: np.ndarray, whisper_model, cascade_model=None,
+                     cascade_config: Optional[CascadeConfig] = None,
+                     no_speech_gate: Optional[float] = None, long_audio=None) -> Dict:
+    """音声（16kHzモノラルのfloat32配列）を分析して文字起こしする
+
+    cascade_modelを指定した場合は、baseモデルの前にtinyモデルで発話の有無を判定する。
+    no_speech_gateを指定した場合は、30秒ウィンドウごとに無音確率がこの値を超える
+    ウィンドウのデコードを省略する。
+    long_audio（long_audio.LongAudioTranscriber）を指定した場合、対象となる長さの録音は
+    無音区間で分割してワーカープロセスで並列に文字起こしする。
+    戻り値: {"transcription": str, "silent": bool, "hallucinated": bool, "resolved_by": str}
+    resolved_by は結果を確定させた段階（"rms" / "cascade" / "whisper"）。
+    """
+    silent = False
+    hallucinated = False
+    resolved_by = "whisper"
+
+    try:
+        # 音声のRMS（Root Mean Square）を計算して無音判定
+        rms = np.sqrt(np.mean(audio**2)) if len(audio) else 0.0
+
+        if rms < SILENCE_THRESHOLD:
+            logger.info(f"🔇 無音検出: RMS={rms:.6f} < {SILENCE_THRESHOLD}")
+            transcription = ""  # 無音の場合は空文字
+            silent = True
+            resolved_by = "rms"
+        else:
+            escalate = True
+            screen_seconds = 0.0
+            if cascade_model is not None:
+                with whisper_lock:
+                    screen_start = time.time()
+                    escalate = screen_with_cascade(audio, cascade_model, cascade_config or CascadeConfig())
+                    screen_seconds = time.time() - screen_start
+
+            if not escalate:
+                logger.info(f"🔽 カスケード: 発話なしと判定（{screen_seconds:.2f}秒）、baseモデルをスキップ")
+                cascade_stats.record(resolved=True, screen_seconds=screen_seconds)
+                transcription = ""
+                resolved_by = "cascade"
+            else:
+                # Whisperで文字起こし
+                if long_audio is not None and long_audio.applies(audio):
+                    # ワーカープロセスはそれぞれモデルのコピーを使うため、ロックは不要
+                    transcribe_start = time.time()
+                    result = long_audio.transcribe(audio)
+                    transcribe_seconds = time.time() - transcribe_start
+                else:
+                    with whisper_lock:
+                        transcribe_start = time.time()
+                        result = run_whisper(audio, whisper_model, no_speech_gate)
+                        transcribe_seconds = time.time() - transcribe_start
+                if cascade_model is not None:
+                    cascade_stats.record(resolved=False, screen_seconds=screen_seconds,
+                                         escalated_seconds=transcribe_seconds)
+                transcription = result["text"].strip()
+
+                # ハルシネーション検出（同じフレーズの繰り返し）
+                if transcription and detect_hallucination(transcription):
+                    transcription = ""  # ハルシネーションの場合は空文字
+                    hallucinated = True
+
+                # ログレベルの確認（no_speech_probが高い場合）
+                if result['no_speech_prob'] is not None and result['no_speech_prob'] > 0.9:
+                    logger.info(f"📊 高い無音確率: no_speech_prob={result['no_speech_prob']:.2f}")
+                    if not transcription or len(transcription) < 5:
+                        transcription = ""  # 無音確率が高く短いテキストは無視
+
+    except Exception as audio_error:
+        logger.error(f"音声分析エラー: {str(audio_error)}")
+        # 音声分析に失敗した場合は通常のWhisper処理にフォールバック
+        with whisper_lock:
+            result = whisper_model.transcribe(audio, language="ja")
+        transcription = result["text"].strip()
+        resolved_by = "whisper"
+
+    return {
+        "transcription": transcription,
+        "silent": silent,
+        "hallucinated": hallucinated,
+        "resolved_by": resolved_by
+    }